@@ -0,0 +1,235 @@
+"""
+End-to-end check of a cluster on loopback. Starts the server with --workers and a freshly generated self-signed
+certificate (needs the openssl command line tool and Linux) and connects clients one by one until every worker
+serves some of them. Which worker took a connection is read from the connected clients gauge on the admin port
+of every worker.
+
+Checked:
+- every client gets the same roster version, whichever worker it is on
+- a message to clients of every worker reaches all of them and only them
+- a message to a client of another worker that disconnected is reported as failed to the sender
+- a room message sent right behind the join reaches a member on another worker
+
+Exits with status 1 if a check fails.
+
+Usage: python cluster_check.py [--workers N] [-- server options]
+"""
+import argparse
+import asyncio
+import itertools
+import os
+import socket
+import ssl
+import sys
+import tempfile
+import time
+import urllib.request
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..', 'Common'))
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..', 'ChatServer'))
+
+import Utils  # noqa: E402
+from load_benchmark import ServerProcess, create_certificate  # noqa: E402
+
+RECEIVE_TIMEOUT = 5.0
+MAX_CONNECTIONS = 64
+MAX_DATA_SIZE = 16 * 1024 * 1024
+
+
+class CheckClient:
+    """
+    One connection speaking the chat protocol, it keeps every frame it receives
+    """
+    client_id: int = None
+    worker: int = None
+    codec: str = None
+    writer: asyncio.StreamWriter = None
+    frames: list = None
+    arrived: asyncio.Event = None
+    read_task: asyncio.Task = None
+
+    def __init__(self):
+        self.codec = Utils.JSON_CODEC
+        self.frames = []
+        self.arrived = asyncio.Event()
+
+    async def connect(self, port: int, ssl_context: ssl.SSLContext, hello: dict):
+        reader, self.writer = await asyncio.open_connection('127.0.0.1', port, ssl=ssl_context)
+        self.send({'hello': dict(hello, codecs=Utils.CODECS)})
+        self.read_task = asyncio.create_task(self.read(reader))
+        first = await self.wait_for(lambda data: 'id' in data and 'info' not in data)
+        self.client_id = first['id']
+        self.codec = first.get('codec', Utils.JSON_CODEC)
+
+    async def read(self, reader: asyncio.StreamReader):
+        frame_reader = Utils.FrameReader(MAX_DATA_SIZE)
+        while True:
+            received = await reader.read(Utils.RECEIVE_BUFFER_SIZE)
+            messages = frame_reader.feed(received) if received else None
+            if messages is None:
+                return
+            self.frames.extend(messages)
+            self.arrived.set()
+
+    async def wait_for(self, predicate, timeout: float = RECEIVE_TIMEOUT) -> dict:
+        """
+        :return: the first received frame predicate accepts, it is taken from the received frames
+        """
+        async with asyncio.timeout(timeout):
+            while True:
+                for position, data in enumerate(self.frames):
+                    if predicate(data):
+                        return self.frames.pop(position)
+                self.arrived.clear()
+                await self.arrived.wait()
+
+    def take_all(self, predicate) -> list:
+        taken = [data for data in self.frames if predicate(data)]
+        self.frames = [data for data in self.frames if not predicate(data)]
+        return taken
+
+    def send(self, data: dict):
+        self.writer.write(Utils.encode_frame(data, self.codec))
+
+    def close(self):
+        self.read_task.cancel()
+        self.writer.transport.abort()
+
+
+def get_connected_clients(admin_port: int) -> int:
+    with urllib.request.urlopen(f'http://127.0.0.1:{admin_port}/metrics', timeout=RECEIVE_TIMEOUT) as response:
+        for line in response.read().decode('utf-8').splitlines():
+            if line.startswith('chat_connected_clients '):
+                return int(float(line.split()[1]))
+    raise ValueError('no chat_connected_clients gauge')
+
+
+async def connect_to_every_worker(args: argparse.Namespace, ssl_context: ssl.SSLContext) -> list:
+    """
+    Connects clients one at a time until every worker has at least three
+    :return: the clients, with the worker that serves them
+    """
+    clients = []
+    counts = [0] * args.workers
+    while min(counts) < 3:
+        if len(clients) == MAX_CONNECTIONS:
+            raise AssertionError(f'the kernel did not spread {MAX_CONNECTIONS} connections over the workers: {counts}')
+        client = CheckClient()
+        await client.connect(args.port, ssl_context, {'roster': {}, 'resume': None})
+        for worker in range(args.workers):
+            connected = await asyncio.to_thread(get_connected_clients, args.admin_port + worker)
+            if connected > counts[worker]:
+                client.worker = worker
+            counts[worker] = connected
+        clients.append(client)
+    print(f'{len(clients)} clients, per worker {counts}')
+    return clients
+
+
+def last_roster_version(client: CheckClient) -> int | None:
+    versions = [data['roster']['version'] for data in client.take_all(lambda data: 'roster' in data)]
+    return versions[-1] if len(versions) > 0 else None
+
+
+async def check_cluster(args: argparse.Namespace) -> list:
+    """
+    :return: descriptions of the failed checks
+    """
+    ssl_context = ssl.SSLContext(ssl.PROTOCOL_TLS_CLIENT)
+    ssl_context.check_hostname = False
+    ssl_context.verify_mode = ssl.CERT_NONE
+    failed = []
+    clients = await connect_to_every_worker(args, ssl_context)
+    msg_ids = itertools.count(1)
+
+    # presence batches of the connect phase
+    await asyncio.sleep(1)
+    versions = {last_roster_version(client) for client in clients}
+    if len(versions) != 1:
+        failed.append(f'roster versions differ between clients: {versions}')
+
+    sender = clients[0]
+    recipients = [client for client in clients[1:] if client.worker != sender.worker][:2] + \
+                 [client for client in clients[1:] if client.worker == sender.worker][:1]
+    msg_id = next(msg_ids)
+    sender.send({'recipients': [client.client_id for client in recipients], 'text': 'across', 'msg_id': msg_id})
+    for client in recipients:
+        try:
+            data = await client.wait_for(lambda data: data.get('msg_id') == msg_id and 'text' in data)
+            if data.get('from') != sender.client_id:
+                failed.append(f'message on worker {client.worker} has the wrong sender: {data}')
+        except TimeoutError:
+            failed.append(f'message from worker {sender.worker} did not reach worker {client.worker}')
+    await asyncio.sleep(0.2)
+    for client in clients:
+        if client not in recipients and len(client.take_all(lambda data: data.get('msg_id') == msg_id)) > 0:
+            failed.append(f'message reached a client on worker {client.worker} it was not sent to')
+
+    # a client of another worker disconnects, the message for it fails
+    gone = next(client for client in clients if client.worker != sender.worker and client not in recipients)
+    gone.close()
+    await asyncio.sleep(0.2)
+    msg_id = next(msg_ids)
+    sender.send({'recipients': [gone.client_id], 'text': 'too late', 'msg_id': msg_id})
+    try:
+        data = await sender.wait_for(lambda data: data.get('msg_id') == msg_id and 'info' in data)
+        if data.get('recipients') != [gone.client_id]:
+            failed.append(f'failure names the wrong recipients: {data}')
+    except TimeoutError:
+        failed.append(f'message to a gone client of worker {gone.worker} was not reported as failed')
+
+    # the join and the first room message arrive in the same read
+    member = next(client for client in clients if client.worker != sender.worker and client is not gone)
+    member.send({'join': 'check'})
+    await member.wait_for(lambda data: data.get('room') == 'check' and 'members' in data)
+    await asyncio.sleep(0.2)
+    msg_id = next(msg_ids)
+    sender.send({'join': 'check'})
+    sender.send({'room': 'check', 'text': 'first', 'msg_id': msg_id})
+    try:
+        await member.wait_for(lambda data: data.get('msg_id') == msg_id and 'text' in data)
+    except TimeoutError:
+        failed.append(f'room message from worker {sender.worker} did not reach worker {member.worker}')
+    await asyncio.sleep(0.2)
+    if len(sender.take_all(lambda data: data.get('msg_id') == msg_id and 'info' in data)) > 0:
+        failed.append('room message sent right after joining failed')
+
+    for client in clients:
+        client.close()
+    return failed
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Cluster check on loopback')
+    parser.add_argument('--workers', type=int, default=2)
+    parser.add_argument('--port', type=int, default=0, help='server port, a free one if 0')
+    parser.add_argument('--admin-port', type=int, default=0, help='admin port of the first worker, a free one if 0')
+    parser.add_argument('server_args', nargs='*', help='passed on to the server, put them after --')
+    args = parser.parse_args()
+    if args.workers < 2:
+        parser.error('--workers must be at least 2')
+    for name in ('port', 'admin_port'):
+        if getattr(args, name) == 0:
+            with socket.socket() as probe:
+                probe.bind(('127.0.0.1', 0))
+                setattr(args, name, probe.getsockname()[1])
+
+    server_args = ['--workers', str(args.workers), '--admin-port', str(args.admin_port)] + args.server_args
+    with tempfile.TemporaryDirectory(prefix='chat-cluster-') as directory:
+        cert_file, key_file = create_certificate(directory)
+        server = ServerProcess('async', args.port, cert_file, key_file, server_args)
+        try:
+            # the port answers once the first worker listens, give the others time to join
+            time.sleep(1)
+            failed = asyncio.run(check_cluster(args))
+        finally:
+            server.stop()
+
+    for failure in failed:
+        print(f'FAILED: {failure}')
+    print('cluster check passed' if len(failed) == 0 else f'{len(failed)} checks failed')
+    sys.exit(1 if len(failed) > 0 else 0)
+
+
+if __name__ == '__main__':
+    main()
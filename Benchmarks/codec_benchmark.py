@@ -0,0 +1,52 @@
+"""
+Compares the json and the binary codec on typical frames: bytes per frame (header included)
+and encode / decode time per frame.
+
+Usage: python codec_benchmark.py
+"""
+import os
+import sys
+import timeit
+import uuid
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..', 'Common'))
+
+import Utils  # noqa: E402
+
+SAMPLES = {
+    'client id': {'id': uuid.uuid1().int, 'codec': Utils.BINARY_CODEC},
+    'presence update': {'id': uuid.uuid1().int, 'name': 'alice', 'info': 'update'},
+    'message': {'from': uuid.uuid1().int, 'text': 'Are we still on for the meeting at 3?', 'msg_id': 1234},
+    'logged message': {'from': uuid.uuid1().int, 'text': 'Are we still on for the meeting at 3?', 'msg_id': 1234,
+                       'offset': 1 << 20},
+    'send failure': {'info': 'Could not send message', 'msg_id': 1234},
+    'acks': {'acks': [{'delivered': 1234, 'read': 1230, 'by': uuid.uuid1().int}]},
+    'roster of 100': {'clients': [{'id': uuid.uuid1().int, 'name': f'user {i}'} for i in range(100)]},
+    'roster changes': {'roster': {'epoch': uuid.uuid4().int >> 64, 'version': 4321, 'changes': [
+        {'id': uuid.uuid1().int, 'name': f'user {i}', 'info': ('add', 'update', 'delete')[i % 3]} for i in range(100)
+    ]}},
+}
+
+
+def measure(data: dict, codec: str) -> tuple:
+    frame = Utils.encode_frame(data, codec)
+    header = Utils.bytes_to_uint32(frame[:4])
+    body = memoryview(frame)[4:]
+    assert Utils.decode_body(header >> 24, body, len(frame)) == data
+
+    number, _ = timeit.Timer(lambda: Utils.encode_frame(data, codec)).autorange()
+    encode = timeit.timeit(lambda: Utils.encode_frame(data, codec), number=number) / number
+    decode = timeit.timeit(lambda: Utils.decode_body(header >> 24, body, len(frame)), number=number) / number
+    return len(frame), encode * 1e6, decode * 1e6
+
+
+def main():
+    print(f'{"frame":<16} {"codec":<7} {"bytes":>6} {"encode us":>10} {"decode us":>10}')
+    for name, data in SAMPLES.items():
+        for codec in (Utils.JSON_CODEC, Utils.BINARY_CODEC):
+            size, encode, decode = measure(data, codec)
+            print(f'{name:<16} {codec:<7} {size:>6} {encode:>10.2f} {decode:>10.2f}')
+
+
+if __name__ == '__main__':
+    main()
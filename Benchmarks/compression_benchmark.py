@@ -0,0 +1,42 @@
+"""
+Bytes on the wire and encode time per frame without compression, with plain deflate and with the preset dictionary.
+Frames below the compression threshold are sent as they are, so the small ones show what the threshold saves.
+
+Usage: python compression_benchmark.py
+"""
+import os
+import random
+import sys
+import timeit
+import uuid
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..', 'Common'))
+
+import Utils  # noqa: E402
+
+WORDS = ['hello', 'are', 'we', 'still', 'on', 'for', 'the', 'meeting', 'tomorrow', 'I', 'think', 'so', 'deploy',
+         'is', 'done', 'please', 'check', 'logs', 'thanks', 'https://www.example.com/build/1234']
+
+random.seed(1)
+SAMPLES = {
+    'presence update': {'id': uuid.uuid1().int, 'name': 'alice', 'info': 'update'},
+    'short message': {'from': uuid.uuid1().int, 'text': 'Are we still on for the meeting at 3?', 'msg_id': 1234},
+    'paragraph': {'from': uuid.uuid1().int, 'text': ' '.join(random.choices(WORDS, k=120)), 'msg_id': 1235},
+    'pasted text': {'from': uuid.uuid1().int, 'text': ' '.join(random.choices(WORDS, k=20000)), 'msg_id': 1236},
+    'roster of 100': {'clients': [{'id': uuid.uuid1().int, 'name': f'user {i}'} for i in range(100)]},
+}
+
+
+def main():
+    print(f'{"frame":<16} {"codec":<7} {"compression":<12} {"bytes":>8} {"encode us":>10}')
+    for name, data in SAMPLES.items():
+        for codec in (Utils.JSON_CODEC, Utils.BINARY_CODEC):
+            for compression in (None, 'zlib', 'zlib-d1'):
+                frame = Utils.encode_frame(data, codec, compression)
+                number, _ = timeit.Timer(lambda: Utils.encode_frame(data, codec, compression)).autorange()
+                encode = timeit.timeit(lambda: Utils.encode_frame(data, codec, compression), number=number) / number
+                print(f'{name:<16} {codec:<7} {str(compression):<12} {len(frame):>8} {encode * 1e6:>10.1f}')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,74 @@
+"""
+Measures the CPU cost of fanning out one presence update to N clients.
+
+per-recipient: the payload is serialized and framed again for every recipient (previous behavior)
+encode-once: one Utils.Frame is built and shared by every recipient (ChatServer.send_client_update). The presence
+window is off, so the change is not only queued but sent to every client by send_presence_batch right away
+
+Only the server side is measured, clients are legacy clients (no roster sync) with outbound queues but no sockets.
+Usage: python fanout_benchmark.py [recipients ...]
+"""
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..', 'Common'))
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..', 'ChatServer'))
+
+import ChatServer  # noqa: E402
+import Utils  # noqa: E402
+
+ROUNDS = 20
+
+
+def build_server(recipients: int) -> ChatServer.ChatServer:
+    server = ChatServer.ChatServer(presence_window_max=0)
+    for i in range(recipients):
+        server.clients[(1 << 126) + i] = {
+            'name': f'client {i}',
+            'queue': server.create_outbound_queue(None),
+            'codec': Utils.JSON_CODEC,
+            'compression': None,
+            'roster_sync': None
+        }
+    return server
+
+
+def drain(server: ChatServer.ChatServer):
+    for client in server.clients.values():
+        client['queue'].pop_all()
+
+
+def per_recipient(server: ChatServer.ChatServer, client_id: int):
+    update_data = {'id': client_id, 'name': server.clients[client_id]['name'], 'info': 'add'}
+    with server.client_lock:
+        for client in server.clients:
+            server.clients[client]['queue'].put(Utils.encode_frame(update_data))
+
+
+def encode_once(server: ChatServer.ChatServer, client_id: int):
+    server.send_client_update(client_id, 'add')
+
+
+def measure(method, server: ChatServer.ChatServer) -> float:
+    client_id = next(iter(server.clients))
+    total = 0.0
+    for _ in range(ROUNDS):
+        start = time.process_time()
+        method(server, client_id)
+        total += time.process_time() - start
+        drain(server)
+    return total / ROUNDS
+
+
+def main(sizes: list):
+    print(f'{"recipients":>10} {"per-recipient us":>17} {"encode-once us":>15} {"saved us/recipient":>19}')
+    for size in sizes:
+        server = build_server(size)
+        before = measure(per_recipient, server) * 1e6
+        after = measure(encode_once, server) * 1e6
+        print(f'{size:>10} {before:>17.0f} {after:>15.0f} {(before - after) / size:>19.3f}')
+
+
+if __name__ == '__main__':
+    main([int(arg) for arg in sys.argv[1:]] or [1000, 10000])
@@ -0,0 +1,398 @@
+"""
+Headless load generator for the chat protocol. Starts a server with a freshly generated self-signed certificate
+(needs the openssl command line tool) and simulates many clients in a single asyncio event loop, speaking the
+framing of Common/Utils.py directly, no PySide6 needed.
+
+Clients connect at --connect-rate per second. Once all are connected, the active ones (all but --idle-ratio) send
+at --message-rate per second each for --duration seconds: name changes (--name-ratio), messages to several
+recipients (--multi-ratio, --recipients each) and otherwise one-to-one messages.
+
+Reported: connect times, messages and deliveries per second, end-to-end latency percentiles (sender and recipients
+live in this process, so they share one clock) and server CPU and RSS (read from /proc, so Linux only).
+Every run is appended to --output as one json line. --compare FILE prints the change against the latest run in
+FILE with the same settings, to catch regressions between releases.
+
+The generator shares a core with the server unless pinned elsewhere, check that it is not the bottleneck
+(client cpu in the report) before reading much into throughput numbers.
+
+Usage: python load_benchmark.py [--clients N] [--engine threaded|async] [--duration S] [--output FILE]
+                                [--compare FILE] [-- server options]
+"""
+import argparse
+import asyncio
+import datetime
+import itertools
+import json
+import os
+import random
+import socket
+import ssl
+import subprocess
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..', 'Common'))
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..', 'ChatServer'))
+
+import AsyncChatServer  # noqa: E402
+import Utils  # noqa: E402
+
+SERVER_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'ChatServer')
+COMMON_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'Common')
+SERVER_START_TIMEOUT = 10.0
+CONNECT_TIMEOUT = 30.0
+MAX_DATA_SIZE = 16 * 1024 * 1024
+TEXT = 'Are we still on for the meeting at 3?'
+
+
+class ServerProcess:
+    """
+    Chat server in a child process and its CPU time and memory as reported by /proc
+    """
+    process: subprocess.Popen = None
+
+    def __init__(self, engine: str, port: int, cert_file: str, key_file: str, server_args: list):
+        env = dict(os.environ, PYTHONPATH=os.path.abspath(COMMON_DIR))
+        self.process = subprocess.Popen(
+            [sys.executable, 'main.py', '--engine', engine, '--port', str(port), '--cert', cert_file,
+             '--key', key_file] + server_args,
+            cwd=SERVER_DIR, env=env, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL
+        )
+        deadline = time.monotonic() + SERVER_START_TIMEOUT
+        while True:
+            try:
+                socket.create_connection(('127.0.0.1', port), timeout=1).close()
+                return
+            except OSError:
+                if self.process.poll() is not None or time.monotonic() > deadline:
+                    raise RuntimeError('the server did not start')
+                time.sleep(0.1)
+
+    def get_cpu_time(self) -> float | None:
+        """
+        :return: user + system seconds of the server so far, None if not available
+        """
+        try:
+            with open(f'/proc/{self.process.pid}/stat') as stat:
+                fields = stat.read().rsplit(')', 1)[1].split()
+            return (int(fields[11]) + int(fields[12])) / os.sysconf('SC_CLK_TCK')
+        except (OSError, ValueError, IndexError):
+            return None
+
+    def get_rss(self) -> int | None:
+        """
+        :return: resident memory of the server in bytes, None if not available
+        """
+        try:
+            with open(f'/proc/{self.process.pid}/status') as status:
+                for line in status:
+                    if line.startswith('VmRSS:'):
+                        return int(line.split()[1]) * 1024
+        except (OSError, ValueError):
+            pass
+        return None
+
+    def stop(self):
+        self.process.terminate()
+        try:
+            self.process.wait(5)
+        except subprocess.TimeoutExpired:
+            self.process.kill()
+
+
+class LoadRun:
+    """
+    State shared by the simulated clients of one run
+    """
+    args: argparse.Namespace = None
+    ssl_context: ssl.SSLContext = None
+    client_ids: list = None
+    msg_ids: itertools.count = None
+    sent_at: dict = None
+    started: asyncio.Event = None
+    stopped: asyncio.Event = None
+
+    connect_times: list = None
+    connect_errors: int = None
+    latencies: list = None
+    sent: int = None
+    delivered: int = None
+    failed: int = None
+    name_changes: int = None
+
+    def __init__(self, args: argparse.Namespace):
+        self.args = args
+        self.ssl_context = ssl.SSLContext(ssl.PROTOCOL_TLS_CLIENT)
+        self.ssl_context.check_hostname = False
+        self.ssl_context.verify_mode = ssl.CERT_NONE
+        self.client_ids = []
+        self.msg_ids = itertools.count(1)
+        self.sent_at = {}
+        self.started = asyncio.Event()
+        self.stopped = asyncio.Event()
+        self.connect_times = []
+        self.connect_errors = 0
+        self.reset_counters()
+
+    def reset_counters(self):
+        self.latencies = []
+        self.sent = 0
+        self.delivered = 0
+        self.failed = 0
+        self.name_changes = 0
+
+
+class SimulatedClient:
+    """
+    One connection speaking the chat protocol, it only keeps what the measurements need
+    """
+    run: LoadRun = None
+    number: int = None
+    active: bool = None
+    client_id: int = None
+    codec: str = None
+    writer: asyncio.StreamWriter = None
+
+    def __init__(self, run: LoadRun, number: int, active: bool):
+        self.run = run
+        self.number = number
+        self.active = active
+        self.codec = Utils.JSON_CODEC
+
+    async def connect(self):
+        start = time.perf_counter()
+        reader, self.writer = await asyncio.open_connection('127.0.0.1', self.run.args.port,
+                                                           ssl=self.run.ssl_context)
+        self.send({'hello': {'codecs': Utils.CODECS, 'roster': {}}})
+        frame_reader = Utils.FrameReader(MAX_DATA_SIZE)
+        messages = []
+        while len(messages) == 0:
+            received = await reader.read(Utils.RECEIVE_BUFFER_SIZE)
+            if not received:
+                raise ConnectionError('closed before the id was received')
+            messages = frame_reader.feed(received)
+            if messages is None:
+                raise ConnectionError('invalid frame')
+        first = messages.pop(0)
+        self.client_id = first['id']
+        self.codec = first.get('codec', Utils.JSON_CODEC)
+        self.run.connect_times.append(time.perf_counter() - start)
+        self.run.client_ids.append(self.client_id)
+        return reader, frame_reader, messages
+
+    async def serve(self):
+        try:
+            reader, frame_reader, messages = await asyncio.wait_for(self.connect(), CONNECT_TIMEOUT)
+        except (Exception,):
+            self.run.connect_errors += 1
+            return
+        sender = asyncio.create_task(self.send_loop()) if self.active else None
+        try:
+            while messages is not None:
+                for data in messages:
+                    self.handle_data(data)
+                received = await reader.read(Utils.RECEIVE_BUFFER_SIZE)
+                messages = frame_reader.feed(received) if received else None
+        except (Exception,):
+            pass
+        if sender is not None:
+            sender.cancel()
+        self.writer.close()
+
+    def send(self, data: dict):
+        self.writer.write(Utils.encode_frame(data, self.codec))
+
+    def handle_data(self, data: dict):
+        if 'text' in data:
+            sent_at = self.run.sent_at.get(data.get('msg_id'))
+            if sent_at is not None:
+                self.run.latencies.append(time.perf_counter() - sent_at)
+                self.run.delivered += 1
+        elif data.get('info') == 'Could not send message':
+            self.run.failed += len(data.get('recipients', []))
+
+    async def send_loop(self):
+        args = self.run.args
+        await self.run.started.wait()
+        while not self.run.stopped.is_set():
+            await asyncio.sleep(random.expovariate(args.message_rate))
+            choice = random.random()
+            if choice < args.name_ratio:
+                self.send({'name': f'client {self.number} {random.randrange(1000)}'})
+                self.run.name_changes += 1
+                continue
+            count = args.recipients if choice < args.name_ratio + args.multi_ratio else 1
+            recipients = [recipient for recipient in random.sample(self.run.client_ids, count + 1)
+                          if recipient != self.client_id][:count]
+            msg_id = next(self.run.msg_ids)
+            self.run.sent_at[msg_id] = time.perf_counter()
+            self.send({'recipients': recipients, 'text': TEXT, 'msg_id': msg_id})
+            self.run.sent += 1
+
+
+def create_certificate(directory: str) -> tuple:
+    """
+    :return: paths of a new self-signed certificate and its unencrypted key
+    """
+    cert_file = os.path.join(directory, 'cert.pem')
+    key_file = os.path.join(directory, 'key.pem')
+    subprocess.run(['openssl', 'req', '-x509', '-newkey', 'rsa:2048', '-nodes', '-days', '1', '-subj', '/CN=localhost',
+                    '-keyout', key_file, '-out', cert_file], check=True, capture_output=True)
+    return cert_file, key_file
+
+
+def percentile(values: list, fraction: float) -> float | None:
+    """
+    :param values: sorted values
+    :return: nearest-rank percentile, None without values
+    """
+    if len(values) == 0:
+        return None
+    return values[min(len(values) - 1, int(fraction * len(values)))]
+
+
+def milliseconds(value: float | None) -> float | None:
+    return round(value * 1000, 3) if value is not None else None
+
+
+async def run_load(args: argparse.Namespace, server: ServerProcess) -> dict:
+    run = LoadRun(args)
+    rss_before = server.get_rss()
+    active_clients = round(args.clients * (1 - args.idle_ratio))
+    tasks = []
+    connect_start = time.perf_counter()
+    for number in range(args.clients):
+        client = SimulatedClient(run, number, number < active_clients)
+        tasks.append(asyncio.create_task(client.serve()))
+        await asyncio.sleep(1 / args.connect_rate)
+    while len(run.client_ids) + run.connect_errors < args.clients:
+        await asyncio.sleep(0.05)
+    connect_elapsed = time.perf_counter() - connect_start
+    # let the presence broadcasts of the connect phase settle
+    await asyncio.sleep(1)
+    rss_connected = server.get_rss()
+
+    run.reset_counters()
+    cpu_start = server.get_cpu_time()
+    client_cpu_start = time.process_time()
+    start = time.perf_counter()
+    run.started.set()
+    await asyncio.sleep(args.duration)
+    run.stopped.set()
+    elapsed = time.perf_counter() - start
+    cpu_end = server.get_cpu_time()
+    client_cpu = time.process_time() - client_cpu_start
+    # deliveries still in flight are counted, latencies are what matters for them
+    await asyncio.sleep(0.5)
+
+    for task in tasks:
+        task.cancel()
+    connect_times = sorted(run.connect_times)
+    latencies = sorted(run.latencies)
+    connected = len(run.client_ids)
+    server_cpu = cpu_end - cpu_start if cpu_start is not None and cpu_end is not None else None
+    return {
+        'connected': connected,
+        'connect_errors': run.connect_errors,
+        'connects_per_s': round(connected / connect_elapsed, 1),
+        'connect_p50_ms': milliseconds(percentile(connect_times, 0.5)),
+        'connect_p99_ms': milliseconds(percentile(connect_times, 0.99)),
+        'messages_per_s': round(run.sent / elapsed, 1),
+        'deliveries_per_s': round(run.delivered / elapsed, 1),
+        'name_changes_per_s': round(run.name_changes / elapsed, 1),
+        'failed_deliveries': run.failed,
+        'latency_p50_ms': milliseconds(percentile(latencies, 0.5)),
+        'latency_p99_ms': milliseconds(percentile(latencies, 0.99)),
+        'latency_p999_ms': milliseconds(percentile(latencies, 0.999)),
+        'server_cpu_percent': round(100 * server_cpu / elapsed, 1) if server_cpu is not None else None,
+        'server_cpu_us_per_delivery':
+            round(1e6 * server_cpu / run.delivered, 1) if server_cpu is not None and run.delivered > 0 else None,
+        'server_rss_mb': round(rss_connected / 2 ** 20, 1) if rss_connected is not None else None,
+        'server_rss_kb_per_connection':
+            round((rss_connected - rss_before) / 1024 / connected, 2)
+            if rss_connected is not None and rss_before is not None and connected > 0 else None,
+        'client_cpu_percent': round(100 * client_cpu / elapsed, 1),
+    }
+
+
+def get_revision() -> str | None:
+    try:
+        return subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], cwd=SERVER_DIR, check=True,
+                              capture_output=True, text=True).stdout.strip()
+    except (Exception,):
+        return None
+
+
+def compare(results: dict, config: dict, path: str):
+    """
+    Prints every result next to the one of the latest run in path with the same config
+    """
+    baseline = None
+    with open(path) as file:
+        for line in file:
+            record = json.loads(line)
+            if record.get('config') == config:
+                baseline = record
+    if baseline is None:
+        print(f'no run with the same settings in {path}')
+        return
+    print(f'compared with {baseline.get("revision")} of {baseline.get("time")}')
+    for key, value in results.items():
+        old = baseline['results'].get(key)
+        change = f'{100 * (value - old) / old:+.1f}%' if isinstance(value, (int, float)) and old else ''
+        print(f'{key:<30} {str(old):>12} {str(value):>12} {change:>9}')
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Chat server load generator')
+    parser.add_argument('--engine', choices=['threaded', 'async'], default='async')
+    parser.add_argument('--port', type=int, default=0, help='server port, a free one if 0')
+    parser.add_argument('--clients', type=int, default=1000)
+    parser.add_argument('--connect-rate', type=float, default=500, help='new connections per second')
+    parser.add_argument('--idle-ratio', type=float, default=0.8, help='share of clients that never send')
+    parser.add_argument('--message-rate', type=float, default=1.0, help='sends per second of each active client')
+    parser.add_argument('--name-ratio', type=float, default=0.05, help='share of sends that are name changes')
+    parser.add_argument('--multi-ratio', type=float, default=0.2, help='share of sends to several recipients')
+    parser.add_argument('--recipients', type=int, default=5, help='recipients of a multi-recipient message')
+    parser.add_argument('--duration', type=float, default=20.0, help='seconds of sending')
+    parser.add_argument('--seed', type=int, default=1)
+    parser.add_argument('--output', default='load_results.jsonl', help='json lines file the run is appended to')
+    parser.add_argument('--compare', default=None, metavar='FILE', help='results file to compare this run with')
+    parser.add_argument('server_args', nargs='*', help='passed on to the server, put them after --')
+    args = parser.parse_args()
+    if args.recipients + 1 > args.clients:
+        parser.error('--recipients must be lower than --clients')
+    if args.port == 0:
+        with socket.socket() as probe:
+            probe.bind(('127.0.0.1', 0))
+            args.port = probe.getsockname()[1]
+
+    random.seed(args.seed)
+    AsyncChatServer.raise_open_files_limit()
+    config = {key: value for key, value in vars(args).items() if key not in ('port', 'output', 'compare')}
+    with tempfile.TemporaryDirectory(prefix='chat-load-') as directory:
+        cert_file, key_file = create_certificate(directory)
+        server = ServerProcess(args.engine, args.port, cert_file, key_file, args.server_args)
+        try:
+            results = asyncio.run(run_load(args, server))
+        finally:
+            server.stop()
+
+    for key, value in results.items():
+        print(f'{key:<30} {value}')
+    if args.compare is not None:
+        compare(results, config, args.compare)
+    record = {
+        'time': datetime.datetime.now().isoformat(timespec='seconds'),
+        'revision': get_revision(),
+        'python': sys.version.split()[0],
+        'config': config,
+        'results': results,
+    }
+    with open(args.output, 'a') as file:
+        file.write(json.dumps(record) + '\n')
+
+
+if __name__ == '__main__':
+    main()
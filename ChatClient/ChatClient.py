@@ -1,109 +1,108 @@
-import socket
-import ssl
+import asyncio
 
 import PySide6.QtCore
 
-import Utils
+import AsyncChatClient
 
 
 class ChatClient(PySide6.QtCore.QObject):
-    client_socket: socket.socket = None
-    client_id: int = None
-
-    server_ip: str = None
-    server_port: int = None
-
-    clients: list = None
-
-    continue_running: bool = None
-    connected: bool = None
-
-    signal_new_client_list = PySide6.QtCore.Signal(dict)
-    signal_update_client = PySide6.QtCore.Signal(dict)
-    signal_incoming_message = PySide6.QtCore.Signal(dict)
-    signal_connection = PySide6.QtCore.Signal(dict)
+    """
+    Qt adapter over AsyncChatClient: runs it on an event loop of its own and turns its events into signals. The
+    methods may be called from any thread, they hand the work to the loop
+    """
+    client: AsyncChatClient.AsyncChatClient = None
+    loop: asyncio.AbstractEventLoop = None
+
+    # the data is passed as a Python object, converting it to a Qt map fails on the 128 bit client ids
+    signal_new_client_list = PySide6.QtCore.Signal(object)
+    signal_update_clients = PySide6.QtCore.Signal(object)
+    signal_incoming_message = PySide6.QtCore.Signal(object)
+    signal_connection = PySide6.QtCore.Signal(object)
+    signal_delivery_state = PySide6.QtCore.Signal(object)
+    signal_receipt = PySide6.QtCore.Signal(object)
+
+    def __init__(self):
+        super().__init__()
+        # calls made before start_chat runs the loop wait in it until then
+        self.loop = asyncio.new_event_loop()
+        self.client = AsyncChatClient.AsyncChatClient()
 
     def get_id(self):
-        return self.client_id
+        return self.client.get_id()
 
-    def send_data(self, data: dict) -> bool:
-        return Utils.send_json_data(self.client_socket, data)
+    def send_data(self, data: dict) -> int:
+        """
+        Queues data for the server and returns at once, it is sent while connected. Data queued while disconnected
+        is sent after reconnecting. signal_delivery_state reports {'msg_id', 'state'} with state 'sent' once the data
+        is written and 'failed' if the server could not deliver it. signal_receipt reports {'by', 'delivered', 'read'}:
+        the recipient got, or read, every message to it up to that msg_id
+        :param data: json data to send
+        :return: msg_id of the data, one is assigned if it has none
+        """
+        data = dict(data)
+        if data.get('msg_id') is None:
+            data['msg_id'] = next(self.client.msg_ids)
+        self.loop.call_soon_threadsafe(self.client.send, data)
+        return data['msg_id']
 
-    def set_continue_running(self, value: bool):
-        self.continue_running = value
+    def send_name(self, name: str):
+        self.loop.call_soon_threadsafe(self.client.send_name, name)
 
-    def shutdown(self):
-        self.continue_running = False
-        self.client_socket.close()
+    def mark_read(self, sender: int):
+        """
+        Tells the sender that every message received from it so far has been read
+        """
+        self.loop.call_soon_threadsafe(self.client.mark_read, sender)
 
-    def try_to_connect(self) -> bool:
+    def shutdown(self):
+        """
+        Stops reconnecting and closes the connection once what is queued has been sent
+        """
+        if not self.loop.is_running():
+            return
         try:
-            context = ssl.SSLContext()
-            self.client_socket = context.wrap_socket(sock=socket.socket())
-            self.client_socket.settimeout(1.0)
-            self.client_socket.connect((self.server_ip, self.server_port))
-            self.client_socket.settimeout(None)
+            asyncio.run_coroutine_threadsafe(self.client.close(), self.loop).result(
+                AsyncChatClient.SHUTDOWN_TIMEOUT + AsyncChatClient.CONNECT_TIMEOUT)
         except (Exception, ):
-            self.client_socket.close()
-            return False
-        return True
-
-    def send_name(self, name: str):
-        Utils.send_json_data(self.client_socket, {
-            'name': name
-        })
+            pass
 
     def start_chat(self, ip: str, port: int):
         """
-        Establishes connection to server, handles incoming and outgoing data, emits the appropriate signals
+        Establishes connection to server, handles incoming and outgoing data, emits the appropriate signals.
+        Returns after shutdown
         :param ip: ip to connect to
         :param port: the port
         :return: None
         """
-        def client_loop():
-            data = Utils.receive_json_data(self.client_socket, 1024 * 1024)
-            if data is None:
-                return
-
-            self.client_id = data['id']
-
-            while True:
-                data = Utils.receive_json_data(self.client_socket, 1024 * 1024)
-                if data is None:
-                    break
-
-                tmp_clients = data.get('clients', None)
-                status = data.get('info', None)
-                text = data.get('text', None)
-                who = data.get('from', None)
-
-                if tmp_clients is not None and self.clients != tmp_clients:
-                    self.clients = tmp_clients
-                    self.signal_new_client_list.emit({'clients': self.clients})
-
-                if status is not None:
-                    self.signal_update_client.emit({'update': data})
-
-                if text is not None:
-                    self.signal_incoming_message.emit({'text': text, 'from': who})
-            self.client_socket.close()
-
-        self.server_ip = ip
-        self.server_port = port
-        self.continue_running = True
-        self.connected = False
-        count = 0
-
-        self.signal_connection.emit({'text': 'Initializing...', 'connected': self.connected})
-
-        while self.continue_running:
-            if not self.connected:
-                count += 1
-                count %= 6
-                self.signal_connection.emit({'text': f'Trying to connect{" ." * count}', 'connected': self.connected})
-                self.connected = self.try_to_connect()
-                if self.connected:
-                    self.signal_connection.emit({'text': f'Connected!', 'connected': self.connected})
-                    client_loop()
-                    self.connected = False
-                    count = 0
+        self.signal_connection.emit({'text': 'Initializing...', 'connected': False})
+        try:
+            self.loop.run_until_complete(self.__run__(ip, port))
+        finally:
+            self.loop.close()
+
+    async def __run__(self, ip: str, port: int):
+        events = self.client.events()
+        run_task = asyncio.create_task(self.client.run(ip, port))
+        self.client.run_task = run_task
+        async for kind, data in events:
+            self.__emit_event__(kind, data)
+        await run_task
+
+    def __emit_event__(self, kind: str, data: dict):
+        if kind == 'connection':
+            if data['connected']:
+                self.signal_connection.emit({'text': 'Connected!', 'connected': True})
+            else:
+                self.signal_connection.emit({'text': f'Trying to connect{" ." * (data["attempt"] % 6)}',
+                                             'connected': False})
+        elif kind == 'roster':
+            self.signal_new_client_list.emit(data)
+        elif kind == 'presence':
+            # a single change is a batch of one
+            self.signal_update_clients.emit(data)
+        elif kind == 'message':
+            self.signal_incoming_message.emit({'text': data['text'], 'from': data.get('from')})
+        elif kind == 'delivery':
+            self.signal_delivery_state.emit(data)
+        elif kind == 'receipt':
+            self.signal_receipt.emit(data)
@@ -1,8 +1,9 @@
 import PySide6
-from PySide6 import QtWidgets, QtCore
+from PySide6 import QtWidgets, QtCore, QtGui
 
 from EmojiMenu import EmojiMenu
-from Message import Message
+from MessageDelegate import MessageDelegate
+from MessageListModel import MessageListModel
 
 
 class ChatPanel(QtWidgets.QWidget):
@@ -11,18 +12,22 @@ class ChatPanel(QtWidgets.QWidget):
     now_hidden: bool = None
     unread_messages: bool = None
 
-    emojis_menu: EmojiMenu = None
-    messages_scroll_area: QtWidgets.QScrollArea = None
+    messages_model: MessageListModel = None
+    messages_view: QtWidgets.QListView = None
     new_message: QtWidgets.QLineEdit = None
     show_button: QtWidgets.QPushButton = None
     emojis_button: QtWidgets.QPushButton = None
 
-    signal_send_message = PySide6.QtCore.Signal(dict)
+    send_message: object = None
+
     signal_show_message = PySide6.QtCore.Signal(object)
 
     def has_unread_messages(self):
         return self.unread_messages
 
+    def is_content_hidden(self):
+        return self.now_hidden
+
     def get_client_id(self):
         return self.client_id
 
@@ -34,7 +39,7 @@ class ChatPanel(QtWidgets.QWidget):
         Builds the chat panel for a specified client
         :param cid: client id
         :param cname: client name
-        :param on_send_message: method to run when sending a message
+        :param on_send_message: method to run when sending a message, returns the msg_id of the message
         :param on_show_click: method to run when show button is clicked
         :param parent: parent widget
         """
@@ -42,27 +47,25 @@ class ChatPanel(QtWidgets.QWidget):
         self.client_id = cid
         self.client_name = cname
 
-        self.signal_send_message.connect(on_send_message)
+        self.send_message = on_send_message
         self.signal_show_message.connect(on_show_click)
 
-        self.emojis_menu = EmojiMenu(self)
-        self.emojis_menu.setWindowModality(PySide6.QtCore.Qt.WindowModality.ApplicationModal)
-        self.emojis_menu.signal_emoji_selected.connect(self.__on_emoji_selected__)
-
-        self.messages_scroll_area = QtWidgets.QScrollArea()
-        self.messages_scroll_area.setVerticalScrollBarPolicy(PySide6.QtCore.Qt.ScrollBarPolicy.ScrollBarAlwaysOn)
-        self.messages_scroll_area.setHorizontalScrollBarPolicy(PySide6.QtCore.Qt.ScrollBarPolicy.ScrollBarAlwaysOff)
-
-        scroll_layout = QtWidgets.QVBoxLayout()
-        scroll_layout.setSpacing(0)
-        scroll_layout.setContentsMargins(0, 0, 0, 0)
-        scroll_layout.setAlignment(PySide6.QtCore.Qt.AlignmentFlag.AlignTop)
-
-        scroll_widget = QtWidgets.QWidget()
-        scroll_widget.setLayout(scroll_layout)
-        self.messages_scroll_area.setWidget(scroll_widget)
-        self.messages_scroll_area.setWidgetResizable(True)
-        self.messages_scroll_area.verticalScrollBar().rangeChanged.connect(self.__on_scroll_range_change__)
+        # only rows in view are painted, row heights are laid out in batches while the event loop is idle
+        self.messages_model = MessageListModel(self)
+        self.messages_view = QtWidgets.QListView(parent=self)
+        self.messages_view.setModel(self.messages_model)
+        self.messages_view.setItemDelegate(MessageDelegate(self.messages_view))
+        self.messages_view.setLayoutMode(QtWidgets.QListView.LayoutMode.Batched)
+        self.messages_view.setBatchSize(256)
+        self.messages_view.setUniformItemSizes(False)
+        self.messages_view.setResizeMode(QtWidgets.QListView.ResizeMode.Adjust)
+        self.messages_view.setVerticalScrollMode(QtWidgets.QAbstractItemView.ScrollMode.ScrollPerPixel)
+        self.messages_view.setSelectionMode(QtWidgets.QAbstractItemView.SelectionMode.ExtendedSelection)
+        self.messages_view.setVerticalScrollBarPolicy(PySide6.QtCore.Qt.ScrollBarPolicy.ScrollBarAlwaysOn)
+        self.messages_view.setHorizontalScrollBarPolicy(PySide6.QtCore.Qt.ScrollBarPolicy.ScrollBarAlwaysOff)
+        self.messages_view.verticalScrollBar().rangeChanged.connect(self.__on_scroll_range_change__)
+        copy_shortcut = QtGui.QShortcut(QtGui.QKeySequence.StandardKey.Copy, self.messages_view)
+        copy_shortcut.activated.connect(self.__on_copy__)
 
         self.new_message = QtWidgets.QLineEdit(parent=self)
         self.new_message.returnPressed.connect(self.__on_return_press__)
@@ -77,7 +80,7 @@ class ChatPanel(QtWidgets.QWidget):
         main_layout = QtWidgets.QVBoxLayout()
         main_layout.setSpacing(0)
         main_layout.setContentsMargins(0, 0, 0, 0)
-        main_layout.addWidget(self.messages_scroll_area)
+        main_layout.addWidget(self.messages_view)
         h_layout = QtWidgets.QHBoxLayout()
         h_layout.addWidget(self.new_message)
         h_layout.addWidget(self.show_button)
@@ -87,24 +90,24 @@ class ChatPanel(QtWidgets.QWidget):
         self.hide_content()
         self.setLayout(main_layout)
 
-    def insert_message(self, text: str, incoming: bool):
+    def insert_message(self, text: str, incoming: bool, timestamp: float | None = None, msg_id: int | None = None,
+                       state: str | None = None):
+        """
+        :param text: message text
+        :param incoming: true if the message was received
+        :param timestamp: seconds since the epoch, now if not given
+        :param msg_id: msg_id of a sent message
+        :param state: delivery state of a sent message
+        """
         if self.now_hidden:
             self.unread_messages = True
-        message = Message(text, incoming)
-        last_message = None
-        last_index = self.messages_scroll_area.widget().layout().count() - 1
-        if last_index >= 0:
-            last_widget = self.messages_scroll_area.widget().layout().itemAt(last_index)
-            if last_widget is not None:
-                last_message = last_widget.widget()
-
-        if isinstance(last_message, Message) and last_message.incoming == message.incoming:
-            last_message.insert_text(f'\n{text}')
-        else:
-            self.messages_scroll_area.widget().layout().addWidget(message)
+        self.messages_model.append_message(text, incoming, timestamp, msg_id, state)
+
+    def set_delivery_state(self, msg_id: int, state: str):
+        self.messages_model.set_state(msg_id, state)
 
     def hide_content(self):
-        self.messages_scroll_area.hide()
+        self.messages_view.hide()
         self.new_message.hide()
         self.emojis_button.hide()
         self.show_button.show()
@@ -115,16 +118,21 @@ class ChatPanel(QtWidgets.QWidget):
 
     def __on_scroll_range_change__(self, minimum, maximum):
         if maximum != minimum:
-            self.messages_scroll_area.verticalScrollBar().setValue(maximum)
+            self.messages_view.verticalScrollBar().setValue(maximum)
+
+    def __on_copy__(self):
+        rows = sorted(index.row() for index in self.messages_view.selectionModel().selectedIndexes())
+        QtGui.QGuiApplication.clipboard().setText('\n'.join(self.messages_model.texts[row] for row in rows))
 
     def __on_emojis_click__(self):
-        self.emojis_menu.popup(QtCore.QPoint(0, 0))
-        x, y = -self.emojis_menu.size().width() + self.emojis_button.size().width() - 1, \
-            -self.emojis_menu.size().height() - 1
-        self.emojis_menu.move(self.emojis_button.mapToGlobal(QtCore.QPoint(x, y)))
+        emojis_menu = EmojiMenu.get_shared()
+        emojis_menu.popup_for(QtCore.QPoint(0, 0), self.__on_emoji_selected__)
+        x, y = -emojis_menu.size().width() + self.emojis_button.size().width() - 1, \
+            -emojis_menu.size().height() - 1
+        emojis_menu.move(self.emojis_button.mapToGlobal(QtCore.QPoint(x, y)))
 
     def __on_show_click__(self):
-        self.messages_scroll_area.show()
+        self.messages_view.show()
         self.new_message.show()
         self.emojis_button.show()
         self.show_button.hide()
@@ -132,7 +140,7 @@ class ChatPanel(QtWidgets.QWidget):
         self.unread_messages = False
         self.signal_show_message.emit(self.client_id)
 
-    def __on_emoji_selected__(self, value: bytes):
+    def __on_emoji_selected__(self, value: str):
         self.new_message.insert(f'{value}')
         self.new_message.setFocus()
 
@@ -140,6 +148,6 @@ class ChatPanel(QtWidgets.QWidget):
         if len(self.new_message.text()) == 0:
             return
 
-        self.signal_send_message.emit({'recipients': [self.client_id], 'text': self.new_message.text()})
-        self.insert_message(self.new_message.text(), False)
+        msg_id = self.send_message({'recipients': [self.client_id], 'text': self.new_message.text()})
+        self.insert_message(self.new_message.text(), False, msg_id=msg_id, state='queued')
         self.new_message.clear()
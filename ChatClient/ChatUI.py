@@ -1,3 +1,4 @@
+import collections
 import threading
 
 import PySide6
@@ -7,13 +8,18 @@ from PySide6.QtGui import QIcon
 
 import ChatClient
 from ChatPanel import ChatPanel
-from ClientListItem import ClientListItem
+from ClientListModel import ClientListModel
 
 
 class ChatUI(QtWidgets.QWidget):
-    client_list_widget: QtWidgets.QListWidget = None
+    client_list_model: ClientListModel = None
+    client_list_view: QtWidgets.QListView = None
     chats_tabbed_panel: QtWidgets.QTabWidget = None
     client_id_name_map: dict = None
+    chat_panels: dict = None
+    sent_messages: dict = None
+    awaiting_receipts: dict = None
+    delivered_msg_ids: dict = None
 
     chat_client: ChatClient.ChatClient = None
     name: str = None
@@ -26,16 +32,25 @@ class ChatUI(QtWidgets.QWidget):
         super().__init__()
         self.name = name
         self.client_id_name_map = {}
+        self.chat_panels = {}
+        self.sent_messages = {}
+        self.awaiting_receipts = {}
+        self.delivered_msg_ids = {}
         self.chat_client = ChatClient.ChatClient()
         self.chat_client.signal_new_client_list.connect(self.__on_new_client_list__)
-        self.chat_client.signal_update_client.connect(self.__on_client_update__)
+        self.chat_client.signal_update_clients.connect(self.__on_client_updates__)
         self.chat_client.signal_incoming_message.connect(self.__on_incoming_message__)
         self.chat_client.signal_connection.connect(self.__on_connection_update__)
+        self.chat_client.signal_delivery_state.connect(self.__on_delivery_state__)
+        self.chat_client.signal_receipt.connect(self.__on_receipt__)
         threading.Thread(target=self.chat_client.start_chat, args=('127.0.0.1', 4550)).start()
 
-        self.client_list_widget = QtWidgets.QListWidget(parent=self)
-        self.client_list_widget.itemDoubleClicked.connect(self.__on_client_double_click__)
-        self.client_list_widget.itemClicked.connect(self.__on_client_double_click__)
+        self.client_list_model = ClientListModel(self)
+        self.client_list_view = QtWidgets.QListView(parent=self)
+        self.client_list_view.setModel(self.client_list_model)
+        self.client_list_view.setUniformItemSizes(True)
+        self.client_list_view.doubleClicked.connect(self.__on_client_double_click__)
+        self.client_list_view.clicked.connect(self.__on_client_double_click__)
 
         self.chats_tabbed_panel = QtWidgets.QTabWidget(parent=self)
         self.chats_tabbed_panel.setTabsClosable(True)
@@ -46,7 +61,7 @@ class ChatUI(QtWidgets.QWidget):
         main_layout = QtWidgets.QHBoxLayout()
         main_layout.setSpacing(0)
         main_layout.setContentsMargins(0, 0, 0, 0)
-        main_layout.addWidget(self.client_list_widget, stretch=1)
+        main_layout.addWidget(self.client_list_view, stretch=1)
         main_layout.addWidget(self.chats_tabbed_panel, stretch=3)
 
         if isinstance(self, QtWidgets.QMainWindow):
@@ -59,33 +74,92 @@ class ChatUI(QtWidgets.QWidget):
 
     def get_chat_panel_from_client_id(self, cid: int) -> ChatPanel | None:
         """
-        Searches through all chat panels inside the chats tabbed panel and finds the one with client id = cid
         :param cid: client id to find
-        :return: returns the chat panel or None
+        :return: returns the chat panel of the client's open tab or None
         """
-        for i in range(self.chats_tabbed_panel.count()):
-            panel = self.chats_tabbed_panel.widget(i)
-            if isinstance(panel, ChatPanel):
-                if panel.get_client_id() == cid:
-                    return panel
-        return None
+        return self.chat_panels.get(cid)
 
     def get_tab_index_from_client_id(self, cid: int) -> int | None:
         """
-        Searches through all chat panels inside the chats tabbed panel and finds the one with client id = cid
         :param cid: client id to find
-        :return: returns the index of the tab or None
+        :return: returns the index of the client's open tab or None
         """
-        for i in range(self.chats_tabbed_panel.count()):
-            panel = self.chats_tabbed_panel.widget(i)
-            if isinstance(panel, ChatPanel):
-                if panel.get_client_id() == cid:
-                    return i
-        return None
+        chat_panel = self.chat_panels.get(cid)
+        if chat_panel is None:
+            return None
+        return self.chats_tabbed_panel.indexOf(chat_panel)
+
+    def __add_chat_panel__(self, cid: int, cname: str) -> ChatPanel:
+        chat_panel = ChatPanel(cid, cname, self.__on_send_message__, self.__on_messages_shown__,
+                               self.chats_tabbed_panel)
+        self.chat_panels[cid] = chat_panel
+        self.chats_tabbed_panel.addTab(chat_panel, str(cname))
+        return chat_panel
+
+    def __remove_tab__(self, index: int):
+        chat_panel = self.chats_tabbed_panel.widget(index)
+        if isinstance(chat_panel, ChatPanel):
+            self.chat_panels.pop(chat_panel.get_client_id(), None)
+        self.chats_tabbed_panel.removeTab(index)
+
+    def __on_send_message__(self, data: dict) -> int:
+        """
+        Queues a message of a chat panel, never blocks
+        :return: msg_id of the message
+        """
+        msg_id = self.chat_client.send_data(data)
+        self.sent_messages[msg_id] = data['recipients'][0]
+        self.awaiting_receipts.setdefault(data['recipients'][0], collections.deque()).append(msg_id)
+        return msg_id
 
     @Slot(dict)
-    def __on_send_message__(self, data: dict):
-        self.chat_client.send_data(data)
+    def __on_delivery_state__(self, data: dict):
+        msg_id = data.get('msg_id')
+        state = data.get('state')
+        cid = self.sent_messages.get(msg_id)
+        if state == 'failed':
+            # no receipt will come for it
+            self.sent_messages.pop(msg_id, None)
+            waiting = self.awaiting_receipts.get(cid)
+            if waiting is not None and msg_id in waiting:
+                waiting.remove(msg_id)
+        chat_panel = self.get_chat_panel_from_client_id(cid)
+        if chat_panel is not None:
+            chat_panel.set_delivery_state(msg_id, state)
+
+    @Slot(dict)
+    def __on_receipt__(self, data: dict):
+        """
+        A receipt covers every message sent to the recipient up to its msg_ids. Messages wait in msg_id order until
+        they are read, only the ones not yet delivered are marked delivered
+        """
+        cid = data.get('by')
+        waiting = self.awaiting_receipts.get(cid)
+        if not waiting:
+            return
+        read = data.get('read') if isinstance(data.get('read'), int) else 0
+        delivered = max(data.get('delivered') if isinstance(data.get('delivered'), int) else 0, read)
+        chat_panel = self.get_chat_panel_from_client_id(cid)
+        while len(waiting) > 0 and waiting[0] <= read:
+            msg_id = waiting.popleft()
+            self.sent_messages.pop(msg_id, None)
+            if chat_panel is not None:
+                chat_panel.set_delivery_state(msg_id, 'read')
+        previous = self.delivered_msg_ids.get(cid, 0)
+        if delivered <= previous:
+            return
+        self.delivered_msg_ids[cid] = delivered
+        if chat_panel is not None:
+            for msg_id in waiting:
+                if msg_id > delivered:
+                    break
+                if msg_id > previous:
+                    chat_panel.set_delivery_state(msg_id, 'delivered')
+
+    @Slot(object)
+    def __on_messages_shown__(self, cid: int):
+        self.chat_client.mark_read(cid)
+        self.__find_and_update_client__(cid)
 
     def __on_tab_changed__(self, index):
         """
@@ -93,43 +167,32 @@ class ChatUI(QtWidgets.QWidget):
         """
         chat_panel = self.chats_tabbed_panel.widget(index)
         if not isinstance(chat_panel, ChatPanel):
-            self.client_list_widget.clearSelection()
+            self.client_list_view.clearSelection()
             return
 
-        item = self.__find_client_list_item__(chat_panel.get_client_id())
-        if not isinstance(item, ClientListItem):
-            self.client_list_widget.clearSelection()
+        model_index = self.client_list_model.get_index(chat_panel.get_client_id())
+        if not model_index.isValid():
+            self.client_list_view.clearSelection()
             return
 
-        self.client_list_widget.setCurrentItem(item)
+        self.client_list_view.setCurrentIndex(model_index)
 
     def __on_tab_close__(self, index):
-        self.chats_tabbed_panel.removeTab(index)
+        self.__remove_tab__(index)
 
-    def __on_client_double_click__(self, item):
+    def __on_client_double_click__(self, model_index: QtCore.QModelIndex):
         """
         When user double-clicks an item from the client list -> select the appropriate tab OR create a new tab
         if it does not already exist
         """
-        chat_panel = self.get_chat_panel_from_client_id(item.get_client_id())
+        cid = self.client_list_model.get_client_id(model_index)
+        if cid is None:
+            return
+        chat_panel = self.get_chat_panel_from_client_id(cid)
         if chat_panel is None:
-            chat_panel = ChatPanel(item.get_client_id(), item.get_client_name(),
-                                   self.__on_send_message__, self.__find_and_update_client__, self.chats_tabbed_panel)
-            self.chats_tabbed_panel.addTab(chat_panel, str(item.get_client_name()))
+            chat_panel = self.__add_chat_panel__(cid, self.client_id_name_map.get(cid))
         self.chats_tabbed_panel.setCurrentWidget(chat_panel)
 
-    def __find_client_list_item__(self, cid: int) -> ClientListItem | None:
-        """
-        Searches through all items inside client list and finds the one with client id = cid
-        :param cid: client id to find
-        :return: returns the item or None
-        """
-        for i in range(self.client_list_widget.count()):
-            item = self.client_list_widget.item(i)
-            if isinstance(item, ClientListItem) and item.get_client_id() == cid:
-                return item
-        return None
-
     def __get_proper_text_for_list_and_tab__(self, cid: int, chat_panel: ChatPanel | None):
         """
         Builds text that is appropriate for display in a tab or in the client list
@@ -157,32 +220,22 @@ class ChatUI(QtWidgets.QWidget):
 
         if cid is not found then items are removed
         """
-        chat_panel = None
+        chat_panel = self.get_chat_panel_from_client_id(cid)
         index = self.get_tab_index_from_client_id(cid)
         if index is not None:
-            chat_panel = self.chats_tabbed_panel.widget(index)
             self.__update_tab__(index)
 
-        item = self.__find_client_list_item__(cid)
         text = self.__get_proper_text_for_list_and_tab__(cid, chat_panel)
         if text is None:
-            self.client_list_widget.removeItemWidget(item)
-            self.client_list_widget.takeItem(self.client_list_widget.row(item))
-            return
-
-        if item is not None:
-            item.update_client_name(text)
+            self.client_list_model.remove_client(cid)
         else:
-            item = ClientListItem(cid, text)
-            self.client_list_widget.addItem(item)
+            self.client_list_model.set_client(cid, text)
 
-    def __repopulate_client_list_widget__(self):
-        self.client_list_widget.clear()
-        for client in self.client_id_name_map:
-            text = self.__get_proper_text_for_list_and_tab__(client, None)
-            if text is not None:
-                item = ClientListItem(client, self.__get_proper_text_for_list_and_tab__(client, None))
-                self.client_list_widget.addItem(item)
+    def __repopulate_client_list__(self):
+        self.client_list_model.replace_clients({
+            cid: self.__get_proper_text_for_list_and_tab__(cid, self.get_chat_panel_from_client_id(cid))
+            for cid in self.client_id_name_map
+        })
 
     def __update_tab__(self, index: int):
         if index not in range(self.chats_tabbed_panel.count()):
@@ -192,21 +245,20 @@ class ChatUI(QtWidgets.QWidget):
         if isinstance(chat_panel, ChatPanel):
             tab_text = self.__get_proper_text_for_list_and_tab__(chat_panel.get_client_id(), chat_panel)
             if tab_text is None:
-                self.chats_tabbed_panel.removeTab(index)
+                self.__remove_tab__(index)
             else:
                 self.chats_tabbed_panel.setTabText(index, tab_text)
 
     def __update_opened_tabs__(self):
-        for i in range(self.chats_tabbed_panel.count()):
+        for i in reversed(range(self.chats_tabbed_panel.count())):
             self.__update_tab__(i)
 
     @Slot(bool)
     def __on_connection_update__(self, data: dict):
         if not data.get('connected', False):
+            # client list and chats are kept, after reconnecting only the changes since then are received and
+            # a resumed session gets the messages it missed
             self.setWindowIcon(QIcon('red_64.ico'))
-            self.client_id_name_map.clear()
-            self.client_list_widget.clear()
-            self.chats_tabbed_panel.clear()
         else:
             self.setWindowIcon(QIcon('green_64.ico'))
             self.chat_client.send_name(self.name)
@@ -223,11 +275,11 @@ class ChatUI(QtWidgets.QWidget):
         chat_panel = self.get_chat_panel_from_client_id(client_id)
 
         if chat_panel is None:
-            chat_panel = ChatPanel(client_id, client_name,
-                                   self.__on_send_message__, self.__find_and_update_client__, self.chats_tabbed_panel)
-            self.chats_tabbed_panel.addTab(chat_panel, client_name)
+            chat_panel = self.__add_chat_panel__(client_id, client_name)
         if text is not None:
             chat_panel.insert_message(text, True)
+            if not chat_panel.is_content_hidden():
+                self.chat_client.mark_read(client_id)
         self.__find_and_update_client__(client_id)
 
     @Slot(dict)
@@ -236,24 +288,39 @@ class ChatUI(QtWidgets.QWidget):
         for clients in data.values():
             for client in clients:
                 self.client_id_name_map[client['id']] = client['name']
-        self.__repopulate_client_list_widget__()
+        self.__repopulate_client_list__()
         self.__update_opened_tabs__()
 
-    @Slot(dict)
-    def __on_client_update__(self, data: dict):
-        client_id = data['update']['id']
-        client_name = data['update']['name']
-        info = data['update']['info']
-
+    def __apply_client_update__(self, update: dict):
+        client_id = update['id']
+        info = update['info']
         if info.casefold() == 'update':
-            self.client_id_name_map[client_id] = client_name
+            self.client_id_name_map[client_id] = update['name']
         elif info.casefold() == 'add':
-            self.client_id_name_map[client_id] = client_name
+            self.client_id_name_map[client_id] = update['name']
         elif info.casefold() == 'delete':
-            self.client_id_name_map.pop(client_id)
+            self.client_id_name_map.pop(client_id, None)
 
+    @Slot(dict)
+    def __on_client_updates__(self, data: dict):
+        """
+        Applies roster changes in one pass. New clients of a batch are inserted into the list together, the clients
+        that left are removed together and the open tabs are updated once
+        """
+        changed = {}
+        for update in data['updates']:
+            self.__apply_client_update__(update)
+            changed[update['id']] = None
         self.setWindowTitle(f'{self.client_id_name_map.get(self.chat_client.get_id())}')
-        self.__find_and_update_client__(client_id)
+        removed = []
+        for cid in changed:
+            text = self.__get_proper_text_for_list_and_tab__(cid, self.get_chat_panel_from_client_id(cid))
+            if text is None:
+                removed.append(cid)
+            else:
+                self.client_list_model.set_client(cid, text)
+        self.client_list_model.remove_clients(removed)
+        self.__update_opened_tabs__()
 
     def closeEvent(self, event):
         event.accept()
@@ -0,0 +1,112 @@
+import PySide6
+from PySide6 import QtCore
+
+
+class ClientListModel(QtCore.QAbstractListModel):
+    """
+    Client list indexed by client id. Rows stay in the order the clients were added. Rows are found through the
+    id -> row dict, so finding, adding and changing a client is O(1). Removing renumbers the rows below the first
+    removed one, so the clients that left in a batch are removed together with remove_clients.
+    Clients added one by one are collected and inserted together once control returns to the event loop,
+    so a burst of presence updates becomes a single row insert
+    """
+    ids: list = None
+    rows: dict = None
+    texts: dict = None
+    pending: dict = None
+
+    def __init__(self, parent=None):
+        super().__init__(parent)
+        self.ids = []
+        self.rows = {}
+        self.texts = {}
+        self.pending = {}
+
+    def rowCount(self, parent=QtCore.QModelIndex()) -> int:
+        return 0 if parent.isValid() else len(self.ids)
+
+    def data(self, index: QtCore.QModelIndex, role: int = PySide6.QtCore.Qt.ItemDataRole.DisplayRole):
+        if not index.isValid() or role != PySide6.QtCore.Qt.ItemDataRole.DisplayRole:
+            return None
+        return self.texts[self.ids[index.row()]]
+
+    def get_client_id(self, index: QtCore.QModelIndex) -> int | None:
+        return self.ids[index.row()] if index.isValid() else None
+
+    def get_index(self, cid: int) -> QtCore.QModelIndex:
+        """
+        :return: index of the client's row, invalid if the client is not in the list (yet)
+        """
+        row = self.rows.get(cid)
+        return self.index(row) if row is not None else QtCore.QModelIndex()
+
+    def set_client(self, cid: int, text: str):
+        """
+        Adds a client or changes its text
+        """
+        row = self.rows.get(cid)
+        if row is not None:
+            if self.texts[cid] != text:
+                self.texts[cid] = text
+                self.dataChanged.emit(self.index(row), self.index(row))
+            return
+        if len(self.pending) == 0:
+            QtCore.QTimer.singleShot(0, self.insert_pending)
+        self.pending[cid] = text
+
+    def remove_client(self, cid: int):
+        self.remove_clients([cid])
+
+    def remove_clients(self, cids: list):
+        """
+        Removes several clients, the rows below them are renumbered once
+        """
+        rows = [self.rows[cid] for cid in cids if self.pending.pop(cid, None) is None and cid in self.rows]
+        if len(rows) > 0:
+            self.__remove_rows__(rows)
+
+    def replace_clients(self, texts: dict):
+        """
+        Makes the list hold exactly the given clients, only the differences are applied
+        :param texts: client id -> text
+        """
+        self.pending.clear()
+        removed = [row for row, cid in enumerate(self.ids) if cid not in texts]
+        if len(removed) > 0:
+            self.__remove_rows__(removed)
+        for cid, text in texts.items():
+            self.set_client(cid, text)
+        self.insert_pending()
+
+    def __remove_rows__(self, rows: list):
+        """
+        Removes rows, every run of adjacent rows at once, and renumbers the rows below the first removed one
+        """
+        rows = sorted(rows, reverse=True)
+        start = 0
+        while start < len(rows):
+            stop = start + 1
+            while stop < len(rows) and rows[stop] == rows[stop - 1] - 1:
+                stop += 1
+            first, last = rows[stop - 1], rows[start]
+            self.beginRemoveRows(QtCore.QModelIndex(), first, last)
+            for cid in self.ids[first:last + 1]:
+                del self.rows[cid]
+                del self.texts[cid]
+            del self.ids[first:last + 1]
+            self.endRemoveRows()
+            start = stop
+        for row in range(rows[-1], len(self.ids)):
+            self.rows[self.ids[row]] = row
+
+    def insert_pending(self):
+        if len(self.pending) == 0:
+            return
+        first = len(self.ids)
+        self.beginInsertRows(QtCore.QModelIndex(), first, first + len(self.pending) - 1)
+        for cid, text in self.pending.items():
+            self.rows[cid] = len(self.ids)
+            self.ids.append(cid)
+            self.texts[cid] = text
+        self.pending.clear()
+        self.endInsertRows()
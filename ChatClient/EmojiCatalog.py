@@ -0,0 +1,19 @@
+import functools
+import json
+
+EMOJIS_FILE = 'emojis.json'
+
+
+@functools.cache
+def load_emoji_catalog(path: str = EMOJIS_FILE) -> dict:
+    """
+    Reads the emoji file once per process, later calls return the same catalog
+    :param path: json file with category -> list of code points written as 'U+1F600'
+    :return: category -> list of emoji strings
+    """
+    with open(path) as f:
+        categories = json.load(f)
+    return {
+        category: [chr(int(code.replace('U+', ''), 16)) for code in codes]
+        for category, codes in categories.items()
+    }
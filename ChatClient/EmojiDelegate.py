@@ -0,0 +1,49 @@
+import PySide6
+from PySide6 import QtCore, QtGui, QtWidgets
+
+# emoji -> pixmap, shared by all emoji views of the process
+GLYPH_PIXMAPS = {}
+
+
+class EmojiDelegate(QtWidgets.QStyledItemDelegate):
+    """
+    Paints an emoji from a pixmap that is rendered the first time the emoji is shown
+    """
+    cell_size: int = None
+
+    def __init__(self, cell_size: int, parent):
+        """
+        :param cell_size: width and height of a grid cell in pixels
+        :param parent: parent object
+        """
+        super().__init__(parent)
+        self.cell_size = cell_size
+
+    def sizeHint(self, option: QtWidgets.QStyleOptionViewItem, index: QtCore.QModelIndex) -> QtCore.QSize:
+        return QtCore.QSize(self.cell_size, self.cell_size)
+
+    def paint(self, painter: QtGui.QPainter, option: QtWidgets.QStyleOptionViewItem, index: QtCore.QModelIndex):
+        if option.state & QtWidgets.QStyle.StateFlag.State_MouseOver:
+            painter.fillRect(option.rect, option.palette.highlight())
+        pixmap = self.__get_pixmap__(index.data(), option.font, option.palette.text().color(),
+                                     painter.device().devicePixelRatioF())
+        painter.drawPixmap(option.rect.topLeft(), pixmap)
+
+    def __get_pixmap__(self, emoji: str, font: QtGui.QFont, color: QtGui.QColor, pixel_ratio: float) -> QtGui.QPixmap:
+        key = (emoji, self.cell_size, color.rgba(), pixel_ratio)
+        pixmap = GLYPH_PIXMAPS.get(key)
+        if pixmap is not None:
+            return pixmap
+        pixmap = QtGui.QPixmap(QtCore.QSize(self.cell_size, self.cell_size) * pixel_ratio)
+        pixmap.setDevicePixelRatio(pixel_ratio)
+        pixmap.fill(PySide6.QtCore.Qt.GlobalColor.transparent)
+        glyph_font = QtGui.QFont(font)
+        glyph_font.setPixelSize(self.cell_size * 2 // 3)
+        painter = QtGui.QPainter(pixmap)
+        painter.setFont(glyph_font)
+        painter.setPen(color)
+        painter.drawText(QtCore.QRect(0, 0, self.cell_size, self.cell_size),
+                         PySide6.QtCore.Qt.AlignmentFlag.AlignCenter, emoji)
+        painter.end()
+        GLYPH_PIXMAPS[key] = pixmap
+        return pixmap
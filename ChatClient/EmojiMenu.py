@@ -1,58 +1,87 @@
-import json
-
 import PySide6
 from PySide6 import QtWidgets, QtCore
-from PySide6.QtCore import Slot
 
-from Emoji import Emoji
+from EmojiCatalog import load_emoji_catalog
+from EmojiDelegate import EmojiDelegate
+
+EMOJI_CELL_SIZE = 32
+EMOJI_COLUMNS = 15
+EMOJI_ROWS = 8
 
 
 class EmojiMenu(QtWidgets.QMenu):
-    signal_emoji_selected = QtCore.Signal(bytes)
+    """
+    Emoji picker shared by all chat panels, see get_shared. A category is built the first time its tab is shown
+    """
+    shared: 'EmojiMenu' = None
 
     emojis: dict = None
     tabbed_panel: QtWidgets.QTabWidget = None
+    on_emoji_selected: object = None
+
+    @classmethod
+    def get_shared(cls):
+        """
+        :return: the picker of the process, built on first use
+        """
+        if cls.shared is None:
+            cls.shared = cls()
+            cls.shared.setWindowModality(PySide6.QtCore.Qt.WindowModality.ApplicationModal)
+        return cls.shared
 
-    def __init__(self, parent):
+    def __init__(self, parent=None):
         """
-        Loads supported emojis from emojis.json, builds a tabbed menu to display them
+        Builds a tabbed menu with an empty page per category of the emoji catalog
         :param parent: parent widget
         """
         super().__init__(parent=parent)
-        self.__load_json__()
+        self.emojis = load_emoji_catalog()
         self.tabbed_panel = QtWidgets.QTabWidget(self)
+        for emoji_category in self.emojis:
+            self.tabbed_panel.addTab(QtWidgets.QWidget(self.tabbed_panel), emoji_category)
+        self.tabbed_panel.currentChanged.connect(self.__build_category__)
 
         main_layout = QtWidgets.QGridLayout(self)
-
-        for emoji_category in self.emojis:
-            category_layout = QtWidgets.QGridLayout(self.tabbed_panel)
-            category_layout.setSpacing(0)
-            category_layout.setAlignment(PySide6.QtCore.Qt.AlignmentFlag.AlignTop)
-
-            row, col = 0, 0
-            for emoji_code_str in self.emojis[emoji_category]:
-                emoji_code = int(emoji_code_str.replace('U+', '0x'), 16)
-                emoji_button = \
-                    Emoji(emoji_code.to_bytes(8, byteorder='little').decode(encoding='UTF-32'), self.tabbed_panel)
-                emoji_button.signal_click.connect(self.__on_emoji_selected__)
-                category_layout.addWidget(emoji_button, row, col)
-                col += 1
-                if col == 15:
-                    row, col = row + 1, 0
-
-            category_widget = QtWidgets.QWidget(self.tabbed_panel)
-            category_widget.setLayout(category_layout)
-            self.tabbed_panel.addTab(category_widget, emoji_category)
         main_layout.addWidget(self.tabbed_panel)
         self.setLayout(main_layout)
+        self.__build_category__(0)
+
+    def popup_for(self, position: QtCore.QPoint, on_emoji_selected):
+        """
+        Shows the picker for one chat panel
+        :param position: global position of the menu
+        :param on_emoji_selected: called with the emoji string when one is clicked
+        """
+        self.on_emoji_selected = on_emoji_selected
+        self.popup(position)
+
+    def __build_category__(self, index: int):
+        page = self.tabbed_panel.widget(index)
+        if page is None or page.layout() is not None:
+            return
+        model = QtCore.QStringListModel(self.emojis[self.tabbed_panel.tabText(index)], page)
+        view = QtWidgets.QListView(page)
+        view.setModel(model)
+        view.setItemDelegate(EmojiDelegate(EMOJI_CELL_SIZE, view))
+        view.setViewMode(QtWidgets.QListView.ViewMode.IconMode)
+        view.setMovement(QtWidgets.QListView.Movement.Static)
+        view.setResizeMode(QtWidgets.QListView.ResizeMode.Adjust)
+        view.setUniformItemSizes(True)
+        view.setGridSize(QtCore.QSize(EMOJI_CELL_SIZE, EMOJI_CELL_SIZE))
+        view.setMouseTracking(True)
+        view.setEditTriggers(QtWidgets.QAbstractItemView.EditTrigger.NoEditTriggers)
+        view.setMinimumSize(EMOJI_CELL_SIZE * EMOJI_COLUMNS + view.verticalScrollBar().sizeHint().width() + 4,
+                            EMOJI_CELL_SIZE * EMOJI_ROWS + 4)
+        view.clicked.connect(self.__on_emoji_clicked__)
 
-    @Slot(int)
-    def __on_emoji_selected__(self, value: str):
-        self.signal_emoji_selected.emit(value)
+        layout = QtWidgets.QVBoxLayout(page)
+        layout.setContentsMargins(0, 0, 0, 0)
+        layout.addWidget(view)
+        page.setLayout(layout)
 
-    def __load_json__(self):
-        with open('emojis.json') as f:
-            self.emojis = json.load(f)
+    def __on_emoji_clicked__(self, index: QtCore.QModelIndex):
+        if self.on_emoji_selected is not None:
+            self.on_emoji_selected(index.data())
 
     def closeEvent(self, event):
         event.accept()
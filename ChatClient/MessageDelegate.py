@@ -0,0 +1,129 @@
+import collections
+import math
+
+import PySide6
+from PySide6 import QtCore, QtGui, QtWidgets
+
+SIDE_MARGIN = 60
+PADDING = 6
+RUN_SPACING = 2
+CACHED_LAYOUTS = 512
+# marks drawn next to sent messages for their delivery state
+STATE_MARKS = {
+    'queued': '\u2026',
+    'sent': '\u2713',
+    'delivered': '\u2713\u2713',
+    'read': '\u2713\u2713',
+    'failed': '!',
+}
+
+
+class MessageDelegate(QtWidgets.QStyledItemDelegate):
+    """
+    Paints the messages of a MessageListModel, reading its lists directly: incoming ones on the left, sent ones on
+    the right, with a wider gap where the side changes. Text layouts of recently painted rows and the heights of all
+    measured rows are cached per view width, so scrolling lays out only rows that come into view
+    """
+    view: QtWidgets.QAbstractItemView = None
+    layouts: collections.OrderedDict = None
+    heights: dict = None
+    text_options: dict = None
+
+    def __init__(self, view: QtWidgets.QAbstractItemView):
+        """
+        :param view: the list view this delegate paints, its viewport width is the width of the rows
+        """
+        super().__init__(view)
+        self.view = view
+        self.layouts = collections.OrderedDict()
+        self.heights = {}
+        self.text_options = {}
+        for incoming in (True, False):
+            text_option = QtGui.QTextOption(PySide6.QtCore.Qt.AlignmentFlag.AlignLeft
+                                            if incoming else
+                                            PySide6.QtCore.Qt.AlignmentFlag.AlignRight)
+            text_option.setWrapMode(QtGui.QTextOption.WrapMode.WrapAtWordBoundaryOrAnywhere)
+            self.text_options[incoming] = text_option
+        view.model().modelReset.connect(self.clear_cache)
+
+    def clear_cache(self):
+        self.layouts.clear()
+        self.heights.clear()
+
+    def sizeHint(self, option: QtWidgets.QStyleOptionViewItem, index: QtCore.QModelIndex) -> QtCore.QSize:
+        width = self.view.viewport().width()
+        cached = self.heights.get(index.row())
+        if cached is not None and cached[0] == width:
+            return QtCore.QSize(width, cached[1])
+        _, text_height = self.__get_layout__(index, option.font, width)
+        height = math.ceil(text_height) + 2 * PADDING + self.__spacing__(index)
+        self.heights[index.row()] = (width, height)
+        return QtCore.QSize(width, height)
+
+    def paint(self, painter: QtGui.QPainter, option: QtWidgets.QStyleOptionViewItem, index: QtCore.QModelIndex):
+        incoming = self.view.model().incoming[index.row()]
+        layout, _ = self.__get_layout__(index, option.font, option.rect.width())
+        rect = self.__bubble_rect__(option.rect, incoming).adjusted(0, self.__spacing__(index), 0, 0)
+
+        painter.save()
+        if option.state & QtWidgets.QStyle.StateFlag.State_Selected:
+            painter.fillRect(rect, option.palette.highlight())
+            painter.setPen(option.palette.highlightedText().color())
+        else:
+            painter.setPen(option.palette.text().color())
+        layout.draw(painter, QtCore.QPointF(rect.left() + PADDING, rect.top() + PADDING))
+        state = self.view.model().states[index.row()]
+        mark = STATE_MARKS.get(state)
+        if mark is not None:
+            if not option.state & QtWidgets.QStyle.StateFlag.State_Selected:
+                # read marks stand out from delivered ones by colour only
+                painter.setPen(option.palette.link().color() if state == 'read' else
+                               option.palette.placeholderText().color())
+            painter.drawText(QtCore.QRect(option.rect.left(), rect.top() + PADDING, SIDE_MARGIN, rect.height()),
+                             PySide6.QtCore.Qt.AlignmentFlag.AlignRight | PySide6.QtCore.Qt.AlignmentFlag.AlignTop,
+                             mark)
+        painter.restore()
+
+    def __bubble_rect__(self, rect: QtCore.QRect, incoming: bool) -> QtCore.QRect:
+        return rect.adjusted(0 if incoming else SIDE_MARGIN, 0, -SIDE_MARGIN if incoming else 0, 0)
+
+    def __spacing__(self, index: QtCore.QModelIndex) -> int:
+        """
+        Messages from the same side are a run and stay close together, a change of side gets a wider gap
+        """
+        row = index.row()
+        if row == 0:
+            return 0
+        incoming = self.view.model().incoming
+        return RUN_SPACING if incoming[row - 1] == incoming[row] else 4 * PADDING
+
+    def __get_layout__(self, index: QtCore.QModelIndex, font: QtGui.QFont, width: int) -> tuple:
+        """
+        :return: the wrapped text layout of a row and its height, laid out for the given row width
+        """
+        row = index.row()
+        cached = self.layouts.get(row)
+        if cached is not None and cached[0] == width:
+            self.layouts.move_to_end(row)
+            return cached[1], cached[2]
+
+        model = self.view.model()
+        line_width = max(1, width - SIDE_MARGIN - 2 * PADDING)
+        layout = QtGui.QTextLayout(model.texts[row], font)
+        layout.setTextOption(self.text_options[model.incoming[row]])
+        layout.setCacheEnabled(True)
+        height = 0.0
+        layout.beginLayout()
+        while True:
+            line = layout.createLine()
+            if not line.isValid():
+                break
+            line.setLineWidth(line_width)
+            line.setPosition(QtCore.QPointF(0, height))
+            height += line.height()
+        layout.endLayout()
+
+        self.layouts[row] = (width, layout, height)
+        if len(self.layouts) > CACHED_LAYOUTS:
+            self.layouts.popitem(last=False)
+        return layout, height
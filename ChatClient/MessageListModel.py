@@ -0,0 +1,81 @@
+import datetime
+import time
+
+import PySide6
+from PySide6 import QtCore
+
+INCOMING_ROLE = PySide6.QtCore.Qt.ItemDataRole.UserRole + 1
+TIMESTAMP_ROLE = PySide6.QtCore.Qt.ItemDataRole.UserRole + 2
+STATE_ROLE = PySide6.QtCore.Qt.ItemDataRole.UserRole + 3
+# a delivery state only ever moves forward, receipts and write confirmations may arrive in any order
+STATE_ORDER = {'queued': 0, 'sent': 1, 'delivered': 2, 'read': 3, 'failed': 4}
+
+
+class MessageListModel(QtCore.QAbstractListModel):
+    """
+    Messages of one conversation, one row per message. Columns of data are kept in plain lists so that a row
+    costs a few list entries and no Qt object. Sent messages have a delivery state, found by msg_id
+    """
+    texts: list = None
+    incoming: list = None
+    timestamps: list = None
+    states: list = None
+    msg_rows: dict = None
+
+    def __init__(self, parent=None):
+        super().__init__(parent)
+        self.texts = []
+        self.incoming = []
+        self.timestamps = []
+        self.states = []
+        self.msg_rows = {}
+
+    def rowCount(self, parent=QtCore.QModelIndex()) -> int:
+        return 0 if parent.isValid() else len(self.texts)
+
+    def data(self, index: QtCore.QModelIndex, role: int = PySide6.QtCore.Qt.ItemDataRole.DisplayRole):
+        if not index.isValid():
+            return None
+        row = index.row()
+        if role == PySide6.QtCore.Qt.ItemDataRole.DisplayRole:
+            return self.texts[row]
+        if role == INCOMING_ROLE:
+            return self.incoming[row]
+        if role == TIMESTAMP_ROLE:
+            return self.timestamps[row]
+        if role == STATE_ROLE:
+            return self.states[row]
+        if role == PySide6.QtCore.Qt.ItemDataRole.ToolTipRole:
+            timestamp = datetime.datetime.fromtimestamp(self.timestamps[row]).strftime('%H:%M:%S')
+            return timestamp if self.states[row] is None else f'{timestamp} {self.states[row]}'
+        return None
+
+    def append_message(self, text: str, incoming: bool, timestamp: float | None = None, msg_id: int | None = None,
+                       state: str | None = None):
+        """
+        :param text: message text
+        :param incoming: true if the message was received, false if it was sent
+        :param timestamp: seconds since the epoch, now if not given
+        :param msg_id: msg_id of a sent message, used to update its delivery state
+        :param state: delivery state of a sent message
+        """
+        row = len(self.texts)
+        self.beginInsertRows(QtCore.QModelIndex(), row, row)
+        self.texts.append(text)
+        self.incoming.append(incoming)
+        self.timestamps.append(timestamp if timestamp is not None else time.time())
+        self.states.append(state)
+        if msg_id is not None:
+            self.msg_rows[msg_id] = row
+        self.endInsertRows()
+
+    def set_state(self, msg_id: int, state: str) -> bool:
+        """
+        :return: False if there is no message with this msg_id or it already is in a later state
+        """
+        row = self.msg_rows.get(msg_id)
+        if row is None or STATE_ORDER.get(state, 0) <= STATE_ORDER.get(self.states[row], -1):
+            return False
+        self.states[row] = state
+        self.dataChanged.emit(self.index(row), self.index(row), [STATE_ROLE])
+        return True
@@ -0,0 +1,67 @@
+import http.server
+import threading
+import urllib.parse
+
+METRICS_CONTENT_TYPE = 'text/plain; version=0.0.4; charset=utf-8'
+TEXT_CONTENT_TYPE = 'text/plain; charset=utf-8'
+JSON_CONTENT_TYPE = 'application/json'
+JSON_LINES_CONTENT_TYPE = 'application/x-ndjson'
+
+
+class AdminEndpoint:
+    """
+    Local HTTP endpoint for monitoring and control. Every command is a method and path, its function gets the query
+    parameters and returns the text of the response, a ValueError it raises is answered with 400 and its message.
+    It runs on its own thread, so it answers even when the chat engine is busy
+    """
+    commands: dict = None
+    server: http.server.ThreadingHTTPServer = None
+
+    def __init__(self, commands: dict, ip: str, port: int):
+        """
+        :param commands: (method, path) to (function, content type), functions take a dict of query parameters
+        :param ip: address to listen on, keep it local, the endpoint has no authentication
+        """
+        self.commands = commands
+        endpoint = self
+
+        class Handler(http.server.BaseHTTPRequestHandler):
+            def do_GET(self):
+                endpoint.handle(self, 'GET')
+
+            def do_POST(self):
+                endpoint.handle(self, 'POST')
+
+            def log_message(self, format, *args):
+                # scrapes are frequent and not worth a log line each
+                pass
+
+        self.server = http.server.ThreadingHTTPServer((ip, port), Handler)
+        self.server.daemon_threads = True
+
+    def handle(self, request: http.server.BaseHTTPRequestHandler, method: str):
+        url = urllib.parse.urlsplit(request.path)
+        command = self.commands.get((method, url.path))
+        if command is None:
+            known = [path for command_method, path in self.commands if path == url.path]
+            request.send_error(405 if len(known) > 0 else 404)
+            return
+        function, content_type = command
+        params = dict(urllib.parse.parse_qsl(url.query))
+        try:
+            body = function(params).encode('utf-8')
+        except ValueError as e:
+            request.send_error(400, str(e))
+            return
+        request.send_response(200)
+        request.send_header('Content-Type', content_type)
+        request.send_header('Content-Length', str(len(body)))
+        request.end_headers()
+        request.wfile.write(body)
+
+    def start(self):
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+
+    def stop(self):
+        self.server.shutdown()
+        self.server.server_close()
@@ -0,0 +1,51 @@
+import time
+
+LOAD_CHECK_INTERVAL = 0.5
+ADMISSION_DELAY = 1.0
+
+
+class AdmissionControl:
+    """
+    Decides whether new connections are admitted. The server is overloaded while the CPU time the process used since
+    the previous update, as a share of one core, or the bytes waiting in all outbound queues reach their threshold.
+    A threshold of 0 is disabled. The server calls update every LOAD_CHECK_INTERVAL seconds
+    """
+    max_cpu: float = None
+    max_queued_bytes: int = None
+    overloaded: bool = None
+    cpu_usage: float = None
+    queued_bytes: int = None
+    last_sample: tuple | None = None
+
+    def __init__(self, max_cpu: float = 0.0, max_queued_bytes: int = 0):
+        self.overloaded = False
+        self.cpu_usage = 0.0
+        self.queued_bytes = 0
+        self.set_thresholds(max_cpu, max_queued_bytes)
+
+    def set_thresholds(self, max_cpu: float | None = None, max_queued_bytes: int | None = None):
+        """
+        :param max_cpu: share of one core, unchanged if None
+        :param max_queued_bytes: unchanged if None
+        """
+        if (max_cpu is not None and max_cpu < 0) or (max_queued_bytes is not None and max_queued_bytes < 0):
+            raise ValueError('thresholds must not be negative')
+        if max_cpu is not None:
+            self.max_cpu = max_cpu
+        if max_queued_bytes is not None:
+            self.max_queued_bytes = max_queued_bytes
+
+    def update(self, queued_bytes: int) -> bool:
+        """
+        :param queued_bytes: bytes waiting in all outbound queues
+        :return: True if the server became overloaded or recovered
+        """
+        now, cpu = time.monotonic(), time.process_time()
+        if self.last_sample is not None and now > self.last_sample[0]:
+            self.cpu_usage = (cpu - self.last_sample[1]) / (now - self.last_sample[0])
+        self.last_sample = (now, cpu)
+        self.queued_bytes = queued_bytes
+        overloaded = (0 < self.max_cpu <= self.cpu_usage) or (0 < self.max_queued_bytes <= queued_bytes)
+        changed = overloaded != self.overloaded
+        self.overloaded = overloaded
+        return changed
@@ -0,0 +1,159 @@
+import asyncio
+import time
+
+import ChatServer
+import Utils
+
+try:
+    import resource
+except ImportError:
+    resource = None
+
+LISTEN_BACKLOG = 4096
+
+
+class AsyncChatServer(ChatServer.ChatServer):
+    """
+    Same protocol, roster and routing as ChatServer but all connections are served by a single asyncio event loop
+    instead of one OS thread per client. Routing methods are inherited: they run on the loop thread and only
+    append to the clients' outbound queues, so they never block.
+    """
+    loop: asyncio.AbstractEventLoop = None
+
+    def abort_connection(self, client: dict):
+        client['writer'].transport.abort()
+
+    def close_client(self, client: dict):
+        client['queue'].close()
+        client['writer'].close()
+
+    def call_later(self, delay: float, callback, *args):
+        # runs on the event loop like everything else
+        asyncio.get_running_loop().call_later(delay, callback, *args)
+
+    def read_message_log(self, read, callback):
+        # the disk is read on a worker thread, the callback runs on the loop
+        async def read_and_call_back():
+            callback(await asyncio.to_thread(read))
+
+        asyncio.create_task(read_and_call_back())
+
+    def run_on_engine_thread(self, function):
+        async def run():
+            function()
+
+        asyncio.run_coroutine_threadsafe(run(), self.loop).result()
+
+    async def write_frames(self, client_id: int, writer: asyncio.StreamWriter, queue, ready: asyncio.Event):
+        """
+        Drains the outbound queue of a client, frames queued within the flush window are written together.
+        Waits for the transport to flush before taking more frames so that a slow client fills only its own queue
+        """
+        while not queue.is_closed():
+            await ready.wait()
+            if self.flush_window > 0:
+                await asyncio.sleep(self.flush_window)
+            ready.clear()
+            frames = queue.pop_all()
+            if len(frames) == 0:
+                continue
+            self.count_write(frames)
+            try:
+                writer.write(frames[0] if len(frames) == 1 else b''.join(frames))
+                await writer.drain()
+            except (Exception,):
+                self.evict_client(client_id, queue)
+                break
+            self.trace_write(frames)
+
+    async def wait_for_admission(self) -> bool:
+        """
+        While overloaded a new connection waits up to admission_delay. asyncio does the handshake before the
+        connection is handed over, so unlike the threaded engine the wait comes after it, but still before the
+        session and its roster
+        :return: False if the connection should be refused
+        """
+        deadline = time.monotonic() + self.admission_delay
+        while self.admission.overloaded and time.monotonic() < deadline:
+            await asyncio.sleep(ChatServer.ADMISSION_POLL)
+        return not self.admission.overloaded
+
+    async def receive_messages(self, reader: asyncio.StreamReader, frame_reader: Utils.FrameReader) -> list | None:
+        """
+        Reads once from the stream
+        :return: list of json data, possibly empty. None if connection should be closed
+        """
+        received = await reader.read(Utils.RECEIVE_BUFFER_SIZE)
+        if not received:
+            return None
+        messages = frame_reader.feed(received)
+        self.count_received(messages, frame_reader)
+        return messages
+
+    async def receive_hello(self, reader: asyncio.StreamReader, frame_reader: Utils.FrameReader) -> list:
+        messages = []
+        try:
+            async with asyncio.timeout(self.hello_timeout):
+                while messages is not None and len(messages) == 0:
+                    messages = await self.receive_messages(reader, frame_reader)
+        except (TimeoutError, OSError):
+            pass
+        return messages if messages is not None else []
+
+    async def handle_connection(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+        if not await self.wait_for_admission():
+            writer.transport.abort()
+            self.refuse_connection()
+            return
+        ChatServer.set_user_timeout(writer.get_extra_info('socket'),
+                                    self.ping_interval + self.ping_timeout if self.ping_interval > 0 else 0)
+        frame_reader = Utils.FrameReader(ChatServer.MAX_DATA_SIZE)
+        messages = await self.receive_hello(reader, frame_reader)
+        ready = asyncio.Event()
+        queue = self.create_outbound_queue(ready.set)
+        client = self.create_client(messages, writer=writer, queue=queue)
+        client_id = self.start_session(client)
+        writer_task = asyncio.create_task(self.write_frames(client_id, writer, queue, ready))
+        try:
+            while messages is not None and self.clients.get(client_id) is client:
+                self.mark_alive(client_id)
+                wait = self.limit_reading(client_id, messages, frame_reader)
+                if wait > 0:
+                    await asyncio.sleep(wait)
+                for data in messages:
+                    self.handle_client_data(client_id, data)
+                messages = await self.receive_messages(reader, frame_reader)
+        except Exception as e:
+            self.log.warning('connection_failed', client=client_id, error=e)
+        self.cleanup(client_id, client)
+        await writer_task
+
+    async def serve(self, ip: str, port: int):
+        self.loop = asyncio.get_running_loop()
+        self.check_load()
+        self.run_timers()
+        server = await asyncio.start_server(self.handle_connection, ip, port,
+                                            ssl=self.create_ssl_context(), backlog=LISTEN_BACKLOG,
+                                            ssl_handshake_timeout=self.handshake_timeout)
+        async with server:
+            await server.serve_forever()
+
+    def start_serving(self, ip: str, port: int):
+        raise_open_files_limit()
+        self.start_admin_endpoint()
+        asyncio.run(self.serve(ip, port))
+
+
+def raise_open_files_limit():
+    """
+    Every connection is a file descriptor, raise the soft limit as far as allowed so that tens of thousands
+    of connections can be held. Does nothing on platforms without the resource module
+    """
+    if resource is None:
+        return
+    soft, hard = resource.getrlimit(resource.RLIMIT_NOFILE)
+    if soft != hard:
+        try:
+            resource.setrlimit(resource.RLIMIT_NOFILE, (hard, hard))
+        except (ValueError, OSError):
+            pass
@@ -1,44 +1,598 @@
+import json
+import os
 import socket
 import ssl
 import threading
+import time
 import uuid
 
+import Compression
 import Utils
+from AdmissionControl import AdmissionControl, ADMISSION_DELAY, LOAD_CHECK_INTERVAL
+from AdminEndpoint import AdminEndpoint, METRICS_CONTENT_TYPE, TEXT_CONTENT_TYPE, JSON_CONTENT_TYPE, \
+    JSON_LINES_CONTENT_TYPE
+from EventLog import EventLog
+from MessageLog import MessageLog, HISTORY_PAGE_SIZE
+from Metrics import Metrics, frame_type, FANOUT_BUCKETS, LATENCY_BUCKETS, SIZE_BUCKETS
+from OutboundQueue import OutboundQueue, QUEUE_HIGH_WATER, QUEUE_HARD_LIMIT
+from Profiler import Profiler, SAMPLE_INTERVAL
+from RateLimiter import RateLimiter
+from ResumeTokens import ResumeTokens, KEY_FILE_NAME, TOKEN_REFRESH, load_key
+from RoomIndex import RoomIndex
+from RosterJournal import RosterJournal, ROSTER_JOURNAL_SIZE
+from TimerWheel import TimerWheel
+from Tracer import Tracer
 
 MAX_DATA_SIZE = 1024 * 1024
+FLUSH_WINDOW = 0.001
+HELLO_TIMEOUT = 0.3
+HANDSHAKE_TIMEOUT = 10.0
+ROSTER_PAGE_SIZE = 500
+OFFLINE_RETENTION = 24 * 60 * 60
+RESUME_GRACE = 30.0
+RESUME_BUFFER_SIZE = 1000
+ACK_FLUSH_DELAY = 0.05
+ACK_KINDS = ('delivered', 'read')
+ADMISSION_POLL = 0.05
+PRESENCE_WINDOW_MIN = 0.005
+PRESENCE_WINDOW_MAX = 0.2
+PING_INTERVAL = 30.0
+PING_TIMEOUT = 30.0
+TIMER_TICK = 0.5
+
+CERT_FILE = 'C:\\openssl\\cert.pem'
+KEY_FILE = 'C:\\openssl\\key.pem'
+KEY_PASSWORD = 'password'
 
 
 class ChatServer:
     client_lock: threading.Lock = None
-    print_lock: threading.Lock = None
     server: socket.socket = None
-    clients: dict = {}
+    clients: dict = None
+    roster: RosterJournal = None
+    rooms: RoomIndex = None
+    message_log: MessageLog | None = None
+    offline_clients: dict = None
+    suspended_clients: dict = None
+    resume_tokens: dict = None
+    tokens: ResumeTokens = None
+    pending_acks: dict = None
+    ack_flush_scheduled: bool = None
+    pending_presence: dict = None
+    presence_window: float = None
+    presence_flush_scheduled: bool = None
+    timer_wheel: TimerWheel = None
+    ping_frame: Utils.Frame = None
+    metrics: Metrics = None
+    log: EventLog = None
+    admin_endpoint: AdminEndpoint | None = None
+    tracer: Tracer = None
+    profiler: Profiler = None
+    rate_limiter: RateLimiter = None
+    admission: AdmissionControl = None
+
+    cert_file: str = None
+    key_file: str = None
+    key_password: str = None
+    queue_high_water: int = None
+    queue_hard_limit: int = None
+    flush_window: float = None
+    compression_threshold: int = None
+    offline_retention: float = None
+    resume_grace: float = None
+    handshake_timeout: float = None
+    hello_timeout: float = None
+    admin_port: int | None = None
+    ack_flush_delay: float = None
+    admission_delay: float = None
+    presence_window_max: float = None
+    ping_interval: float = None
+    ping_timeout: float = None
+
+    def __init__(self, cert_file: str = CERT_FILE, key_file: str = KEY_FILE, key_password: str = KEY_PASSWORD,
+                 queue_high_water: int = QUEUE_HIGH_WATER, queue_hard_limit: int = QUEUE_HARD_LIMIT,
+                 flush_window: float = FLUSH_WINDOW, compression_threshold: int = Compression.COMPRESSION_THRESHOLD,
+                 roster_journal_size: int = ROSTER_JOURNAL_SIZE, message_log_dir: str | None = None,
+                 offline_retention: float = OFFLINE_RETENTION, resume_grace: float = RESUME_GRACE,
+                 handshake_timeout: float = HANDSHAKE_TIMEOUT, admin_port: int | None = None,
+                 trace_sample_rate: float = 0.0, ack_flush_delay: float = ACK_FLUSH_DELAY,
+                 rate_limits: dict | None = None, max_cpu: float = 0.0, max_queued_bytes: int = 0,
+                 admission_delay: float = ADMISSION_DELAY, presence_window_max: float = PRESENCE_WINDOW_MAX,
+                 ping_interval: float = PING_INTERVAL, ping_timeout: float = PING_TIMEOUT,
+                 hello_timeout: float = HELLO_TIMEOUT, resume_key_file: str | None = None):
+        """
+        Holds the roster of connected clients and routes data between them
+        :param cert_file: path of the certificate used for TLS
+        :param key_file: path of the private key used for TLS
+        :param key_password: password of the private key
+        :param queue_high_water: outbound queued bytes per client after which low priority frames are dropped
+        :param queue_hard_limit: outbound queued bytes per client after which the client is disconnected
+        :param flush_window: seconds a writer waits for more frames so that they are written together
+        :param compression_threshold: frames smaller than this are never compressed
+        :param roster_journal_size: number of roster changes remembered for incremental roster sync
+        :param message_log_dir: directory of the message log that keeps history and messages for offline clients,
+        None disables both
+        :param offline_retention: seconds after a client disconnected during which messages for it are kept, the
+        message log keeps history as long
+        :param resume_grace: seconds a disconnected client may reconnect with its resume token and keep its session,
+        0 disables resuming
+        :param handshake_timeout: seconds a client has to complete the TLS handshake
+        :param admin_port: local port of the admin endpoint (metrics, tracing and profiling), None disables it
+        :param trace_sample_rate: share of messages traced, can be changed on the admin endpoint
+        :param ack_flush_delay: seconds acks are collected before they are forwarded to the senders together
+        :param rate_limits: kind to (rate, burst) of the limits per connection, see RateLimiter
+        :param max_cpu: share of one core the server may use before new connections are held back, 0 for no limit
+        :param max_queued_bytes: bytes in all outbound queues from which new connections are held back, 0 for no
+        limit
+        :param admission_delay: seconds a new connection is held back before it is refused
+        :param presence_window_max: longest window in seconds in which roster changes are collected and merged
+        before they are broadcast, 0 broadcasts every change at once
+        :param ping_interval: seconds a client may be silent before it is pinged, 0 disables heartbeats
+        :param ping_timeout: seconds a client that answers pings may stay silent after the ping before its
+        connection is dropped
+        :param hello_timeout: seconds the server waits for the hello of a new client, a legacy client that sends
+        nothing gets its id after this time
+        :param resume_key_file: file with the key that signs resume tokens, created if missing, so that tokens stay
+        valid when the server restarts. Defaults to a file in the message log directory, without either the tokens
+        are valid only until the server stops
+        """
+        self.clients = {}
+        self.roster = RosterJournal(roster_journal_size)
+        self.rooms = RoomIndex()
+        self.message_log = MessageLog(message_log_dir, retention=offline_retention) \
+            if message_log_dir is not None else None
+        self.offline_clients = {}
+        self.offline_retention = offline_retention
+        self.suspended_clients = {}
+        self.resume_tokens = {}
+        self.resume_grace = resume_grace
+        if resume_key_file is None and message_log_dir is not None:
+            resume_key_file = os.path.join(message_log_dir, KEY_FILE_NAME)
+        self.tokens = ResumeTokens(load_key(resume_key_file),
+                                   max(resume_grace, offline_retention if message_log_dir is not None else 0) +
+                                   TOKEN_REFRESH)
+        self.pending_acks = {}
+        self.ack_flush_scheduled = False
+        self.ack_flush_delay = ack_flush_delay
+        self.rate_limiter = RateLimiter(rate_limits)
+        self.admission = AdmissionControl(max_cpu, max_queued_bytes)
+        self.admission_delay = admission_delay
+        self.pending_presence = {}
+        self.presence_window_max = presence_window_max
+        self.presence_window = min(PRESENCE_WINDOW_MIN, presence_window_max)
+        self.presence_flush_scheduled = False
+        self.timer_wheel = TimerWheel(TIMER_TICK)
+        self.ping_frame = Utils.Frame({'ping': True})
+        self.ping_interval = ping_interval
+        self.ping_timeout = ping_timeout
+        self.handshake_timeout = handshake_timeout
+        self.hello_timeout = hello_timeout
+        self.admin_port = admin_port
+        self.cert_file = cert_file
+        self.key_file = key_file
+        self.key_password = key_password
+        self.queue_high_water = queue_high_water
+        self.queue_hard_limit = queue_hard_limit
+        self.flush_window = flush_window
+        self.compression_threshold = compression_threshold
+        self.client_lock = threading.Lock()
+        self.log = EventLog()
+        self.metrics = Metrics()
+        self.describe_metrics()
+        self.tracer = Tracer(trace_sample_rate)
+        self.profiler = Profiler(self.run_on_engine_thread)
+
+    def describe_metrics(self):
+        metrics = self.metrics
+        metrics.describe('chat_sessions_total', 'counter',
+                         'Sessions started, by kind (new, resumed, taken_over or restored)')
+        metrics.describe('chat_disconnects_total', 'counter', 'Connections that ended')
+        metrics.describe('chat_evictions_total', 'counter', 'Clients disconnected because their queue was full')
+        metrics.describe('chat_pings_total', 'counter', 'Pings sent to silent clients')
+        metrics.describe('chat_reaped_total', 'counter', 'Clients disconnected because they stopped answering pings')
+        metrics.describe('chat_handshake_failures_total', 'counter', 'TLS handshakes that failed or timed out')
+        metrics.describe('chat_handshake_seconds', 'histogram', 'TLS handshake time (threaded engine)',
+                         LATENCY_BUCKETS)
+        metrics.describe('chat_frames_received_total', 'counter', 'Frames received, by type')
+        metrics.describe('chat_bytes_received_total', 'counter', 'Bytes received including headers, by type')
+        metrics.describe('chat_frames_sent_total', 'counter', 'Frames queued for sending, by type')
+        metrics.describe('chat_bytes_sent_total', 'counter', 'Bytes queued for sending including headers, by type')
+        metrics.describe('chat_decode_seconds', 'histogram', 'Time to decode the frames of one read', LATENCY_BUCKETS)
+        metrics.describe('chat_encode_seconds', 'histogram', 'Time to encode a frame, once per codec and compression',
+                         LATENCY_BUCKETS)
+        metrics.describe('chat_routing_seconds', 'histogram', 'Time to route a message to every recipient queue',
+                         LATENCY_BUCKETS)
+        metrics.describe('chat_acks_total', 'counter', 'Cumulative acks received from recipients, by kind')
+        metrics.describe('chat_presence_batch_changes', 'histogram', 'Merged roster changes per presence broadcast',
+                         FANOUT_BUCKETS)
+        metrics.describe('chat_rate_limited_total', 'counter', 'Times a connection hit a rate limit, by kind')
+        metrics.describe('chat_admission_refused_total', 'counter', 'Connections refused while overloaded')
+        metrics.describe('chat_fanout_recipients', 'histogram', 'Recipients of one frame, by kind', FANOUT_BUCKETS)
+        metrics.describe('chat_write_frames', 'histogram', 'Queued frames taken by one write', FANOUT_BUCKETS)
+        metrics.describe('chat_write_bytes', 'histogram', 'Queued bytes taken by one write', SIZE_BUCKETS)
+        metrics.describe('chat_connected_clients', 'gauge', 'Connected clients')
+        metrics.describe('chat_suspended_clients', 'gauge', 'Disconnected clients that may still resume')
+        metrics.describe('chat_queued_bytes', 'gauge', 'Bytes waiting in all outbound queues')
+        metrics.describe('chat_queued_bytes_max', 'gauge', 'Bytes waiting in the fullest outbound queue')
+        metrics.describe('chat_dropped_frames', 'gauge', 'Low priority frames dropped for the connected clients')
+        metrics.describe('chat_cpu_usage', 'gauge', 'CPU time used as a share of one core, see admission control')
+        metrics.describe('chat_overloaded', 'gauge', '1 while new connections are held back')
+        metrics.set_gauge('chat_connected_clients', lambda: len(self.clients))
+        metrics.set_gauge('chat_suspended_clients', lambda: len(self.suspended_clients))
+        metrics.set_gauge('chat_queued_bytes',
+                          lambda: sum(client['queue'].queued_bytes for client in list(self.clients.values())))
+        metrics.set_gauge('chat_queued_bytes_max',
+                          lambda: max((client['queue'].queued_bytes for client in list(self.clients.values())),
+                                      default=0))
+        metrics.set_gauge('chat_dropped_frames',
+                          lambda: sum(client['queue'].dropped_frames for client in list(self.clients.values())))
+
+    def start_admin_endpoint(self):
+        if self.admin_port is None:
+            return
+        self.admin_endpoint = AdminEndpoint(self.get_admin_commands(), '127.0.0.1', self.admin_port)
+        self.admin_endpoint.start()
+        self.log.info('admin_endpoint', url=f'http://127.0.0.1:{self.admin_port}/metrics')
+
+    def get_admin_commands(self) -> dict:
+        """
+        GET /metrics: metrics in the Prometheus text format
+        GET /traces: buffered message traces as json lines
+        POST /tracing?rate=R: traces a share R of the messages from now on
+        POST /profiler/start?mode=sample|cprofile&interval=S: starts profiling, see Profiler
+        POST /profiler/stop: stops profiling and returns the profile
+        GET /limits: rate limits and admission thresholds as json
+        POST /limits?kind=K&rate=R&burst=B: changes the rate limit of a kind, burst is optional
+        POST /admission?max_cpu=C&max_queued_bytes=Q: changes the admission thresholds, either is optional
+        """
+        def get_number(params: dict, name: str, required: bool = True) -> float | None:
+            if name not in params:
+                if required:
+                    raise ValueError(f'{name} is missing')
+                return None
+            try:
+                return float(params[name])
+            except ValueError:
+                raise ValueError(f'{name} must be a number')
+
+        def set_trace_sample_rate(params: dict) -> str:
+            rate = get_number(params, 'rate')
+            self.tracer.set_sample_rate(rate)
+            self.log.info('tracing', rate=rate)
+            return f'trace sample rate {rate}\n'
+
+        def start_profiler(params: dict) -> str:
+            mode = params.get('mode', 'sample')
+            interval = get_number(params, 'interval', False)
+            self.profiler.start(mode, interval if interval is not None else SAMPLE_INTERVAL)
+            self.log.info('profiler_start', mode=mode)
+            return f'profiler started ({mode})\n'
+
+        def stop_profiler(params: dict) -> str:
+            profile = self.profiler.stop()
+            self.log.info('profiler_stop')
+            return profile
+
+        def get_limits(params: dict) -> str:
+            return json.dumps({
+                'limits': {kind: {'rate': rate, 'burst': burst}
+                           for kind, (rate, burst) in self.rate_limiter.limits.items()},
+                'admission': {'max_cpu': self.admission.max_cpu, 'max_queued_bytes': self.admission.max_queued_bytes,
+                              'cpu_usage': self.admission.cpu_usage, 'queued_bytes': self.admission.queued_bytes,
+                              'overloaded': self.admission.overloaded}
+            }) + '\n'
+
+        def set_limit(params: dict) -> str:
+            kind = params.get('kind')
+            self.rate_limiter.set_limit(kind, get_number(params, 'rate'), get_number(params, 'burst', False))
+            rate, burst = self.rate_limiter.limits[kind]
+            self.log.info('limit', kind=kind, rate=rate, burst=burst)
+            return get_limits(params)
+
+        def set_admission(params: dict) -> str:
+            max_queued_bytes = get_number(params, 'max_queued_bytes', False)
+            self.admission.set_thresholds(get_number(params, 'max_cpu', False),
+                                          int(max_queued_bytes) if max_queued_bytes is not None else None)
+            self.log.info('admission', max_cpu=self.admission.max_cpu, max_queued_bytes=self.admission.max_queued_bytes)
+            return get_limits(params)
+
+        return {
+            ('GET', '/metrics'): (lambda params: self.metrics.render(), METRICS_CONTENT_TYPE),
+            ('GET', '/traces'): (lambda params: self.tracer.dump(), JSON_LINES_CONTENT_TYPE),
+            ('POST', '/tracing'): (set_trace_sample_rate, TEXT_CONTENT_TYPE),
+            ('POST', '/profiler/start'): (start_profiler, TEXT_CONTENT_TYPE),
+            ('POST', '/profiler/stop'): (stop_profiler, TEXT_CONTENT_TYPE),
+            ('GET', '/limits'): (get_limits, JSON_CONTENT_TYPE),
+            ('POST', '/limits'): (set_limit, JSON_CONTENT_TYPE),
+            ('POST', '/admission'): (set_admission, JSON_CONTENT_TYPE),
+        }
+
+    def run_on_engine_thread(self, function):
+        """
+        Runs function on the thread that does all the routing and waits for it, used to run cProfile there
+        """
+        raise ValueError('the threaded engine routes on every client thread, use the sample mode')
+
+    def count_received(self, messages: list | None, reader: Utils.FrameReader):
+        """
+        Records the frames of one read
+        """
+        if not messages:
+            return
+        self.metrics.observe('chat_decode_seconds', reader.decode_time)
+        self.tracer.mark_read(reader.decode_time)
+        for data, size in zip(messages, reader.frame_sizes):
+            labels = (('type', frame_type(data)),)
+            self.metrics.increment('chat_frames_received_total', 1, labels)
+            self.metrics.increment('chat_bytes_received_total', size, labels)
+
+    def count_write(self, frames: list):
+        self.metrics.observe('chat_write_frames', len(frames))
+        self.metrics.observe('chat_write_bytes', sum(len(frame) for frame in frames))
+
+    def trace_write(self, frames: list):
+        """
+        Records the socket write of traced frames, called once frames are written
+        """
+        if self.tracer.pending_writes:
+            self.tracer.written(frames)
+
+    def create_ssl_context(self) -> ssl.SSLContext:
+        """
+        One context serves all connections, so the session tickets it issues let reconnecting clients resume
+        their TLS session with an abbreviated handshake
+        """
+        context = ssl.create_default_context(ssl.Purpose.CLIENT_AUTH)
+        context.load_cert_chain(certfile=self.cert_file, keyfile=self.key_file, password=self.key_password)
+        context.options &= ~ssl.OP_NO_TICKET
+        return context
+
+    def create_outbound_queue(self, on_ready) -> OutboundQueue:
+        return OutboundQueue(self.queue_high_water, self.queue_hard_limit, on_ready)
+
+    def send_to_client(self, client_id: int, data: dict | Utils.Frame, low_priority: bool = False,
+                       coalesce_key=None) -> bool:
+        """
+        Queues data for a connected client, the client's writer does the actual sending.
+        A client whose queue exceeds the hard limit is evicted
+        :param client_id: id of the recipient
+        :param data: json data to send or a Frame shared between several recipients
+        :param low_priority: data may be coalesced or dropped if the client is slow
+        :param coalesce_key: newer low priority data with the same key replaces queued data
+        :return: True on success
+        """
+        client = self.clients.get(client_id)
+        if client is None:
+            return False
+        frame = data if isinstance(data, Utils.Frame) else Utils.Frame(data)
+        trace = self.tracer.get_current()
+        if trace is not None and frame.data.get('trace') != trace['trace']:
+            # replies to the sender while its message is routed are not part of the trace
+            trace = None
+        encoded = frame.encoded.get((client['codec'], client['compression']))
+        if encoded is None:
+            start = time.perf_counter()
+            encoded = frame.get_bytes(client['codec'], client['compression'], self.compression_threshold)
+            self.metrics.observe('chat_encode_seconds', time.perf_counter() - start)
+        if trace is not None:
+            self.tracer.mark(trace, 'encode')
+        labels = (('type', frame_type(frame.data)),)
+        self.metrics.increment('chat_frames_sent_total', 1, labels)
+        self.metrics.increment('chat_bytes_sent_total', len(encoded), labels)
+        if client['queue'].put(encoded, low_priority, coalesce_key):
+            if trace is not None:
+                self.tracer.enqueued(trace, encoded)
+            return True
+        self.evict_client(client_id)
+        return False
+
+    def evict_client(self, client_id: int, queue: OutboundQueue | None = None):
+        """
+        Drops a client that does not keep up with its outbound queue. Its connection is shut down so that
+        its reader ends and the usual cleanup runs
+        :param queue: queue of the connection, nothing is done if the session has moved to another connection
+        """
+        client = self.clients.get(client_id)
+        if client is None or client['queue'].is_closed() or (queue is not None and client['queue'] is not queue):
+            return
+        client['queue'].close()
+        self.metrics.increment('chat_evictions_total')
+        self.log.warning('evict', client=client_id, queued=client['queue'].queued_bytes)
+        self.abort_connection(client)
+
+    def abort_connection(self, client: dict):
+        """
+        Shuts the connection of a client down so that its reader ends and the usual cleanup runs
+        """
+        try:
+            client['socket'].shutdown(socket.SHUT_RDWR)
+        except OSError:
+            pass
+
+    def close_client(self, client: dict):
+        client['queue'].close()
+        client['socket'].close()
+
+    def call_later(self, delay: float, callback, *args):
+        """
+        Runs callback(*args) after delay seconds on a timer thread
+        """
+        timer = threading.Timer(delay, callback, args)
+        timer.daemon = True
+        timer.start()
+
+    def run_timers(self):
+        """
+        Runs the timers of the timer wheel that are due every TIMER_TICK seconds, must first be called on the
+        engine's thread. The wheel holds the per connection timers, call_later is for the few server wide ones
+        """
+        self.call_later(self.timer_wheel.tick, self.run_timers)
+        for callback, args in self.timer_wheel.expire():
+            try:
+                callback(*args)
+            except Exception as e:
+                self.log.warning('timer_failed', error=e)
 
-    def send_whole_client_list(self, client_socket: socket.socket):
+    def mark_alive(self, client_id: int):
+        """
+        Called for every read from a client, anything received shows that the client is still there
+        """
+        self.clients[client_id]['last_received'] = time.monotonic()
+        self.refresh_token(client_id)
+
+    def watch_client(self, client_id: int, client: dict, delay: float):
+        if self.ping_interval > 0:
+            client['idle_timer'] = self.timer_wheel.schedule(delay, self.check_idle, client_id, client)
+
+    def check_idle(self, client_id: int, client: dict):
+        """
+        Timer of a connection. A client silent for ping_interval is pinged once, a client that answers pings and
+        stays silent ping_timeout longer is gone without closing its connection and is dropped. The timer is not
+        moved on every read, it checks the time of the last read when it is due and sets itself again from there.
+        Clients that do not answer pings are only pinged: if they are gone the ping is never acknowledged and the
+        TCP user timeout ends the connection
+        :param client: the record the timer was set for, the client may have left or resumed on a new connection
+        """
+        if self.clients.get(client_id) is not client:
+            return
+        now = time.monotonic()
+        silent = now - client['last_received']
+        if silent < self.ping_interval:
+            self.watch_client(client_id, client, self.ping_interval - silent)
+            return
+        if client['heartbeat'] and silent >= self.ping_interval + self.ping_timeout:
+            self.reap_client(client_id, silent)
+            return
+        if client['pinged'] < client['last_received']:
+            client['pinged'] = now
+            self.metrics.increment('chat_pings_total')
+            self.send_to_client(client_id, self.ping_frame)
+        delay = self.ping_interval + self.ping_timeout - silent if client['heartbeat'] else self.ping_interval
+        self.watch_client(client_id, client, delay)
+
+    def reap_client(self, client_id: int, silent: float):
+        client = self.clients.get(client_id)
+        if client is None or client['queue'].is_closed():
+            return
+        client['queue'].close()
+        self.metrics.increment('chat_reaped_total')
+        self.log.warning('reap', client=client_id, silent=round(silent, 1))
+        self.abort_connection(client)
+
+    def send_roster(self, client_id: int):
+        """
+        Sends the roster to a newly connected client, client_lock must be held so that no change slips between
+        the roster and the following updates.
+        Legacy clients get the whole client list. Clients that sent the epoch and version of the roster they know
+        get only the changes since then if the journal still has them, otherwise a snapshot in pages
+        """
+        roster_sync = self.clients[client_id]['roster_sync']
+        entries = self.get_roster_entries()
+        if roster_sync is None:
+            self.send_to_client(client_id, {
+                'clients': [{'id': cid, 'name': name} for cid, name in entries.items()]
+            })
+            return
+
+        changes = self.roster.changes_since(roster_sync.get('epoch'), roster_sync.get('version'), len(entries))
+        if changes is not None:
+            self.send_to_client(client_id, {'roster': {
+                'epoch': self.roster.epoch,
+                'version': self.roster.version,
+                'changes': changes
+            }})
+            return
+
+        snapshot = [{'id': cid, 'name': name} for cid, name in entries.items()]
+        pages = max(1, (len(snapshot) + ROSTER_PAGE_SIZE - 1) // ROSTER_PAGE_SIZE)
+        for page in range(pages):
+            self.send_to_client(client_id, {'roster': {
+                'epoch': self.roster.epoch,
+                'version': self.roster.version,
+                'snapshot': snapshot[page * ROSTER_PAGE_SIZE:(page + 1) * ROSTER_PAGE_SIZE],
+                'page': page,
+                'pages': pages
+            }})
+
+    def get_roster_entries(self) -> dict:
+        """
+        :return: id -> name of every client in the roster, client_lock must be held
+        """
+        entries = {cid: client.get('name') for cid, client in self.clients.items()}
+        entries.update((cid, client.get('name')) for cid, client in self.suspended_clients.items())
+        return entries
+
+    def broadcast_client_update(self, client_id: int, name: str | None, info: str):
+        """
+        Records a roster change, it is broadcast with the other changes of the current presence window,
+        client_lock must be held
+        """
+        if info == 'delete':
+            self.rooms.remove_client(client_id)
+        self.roster.record(client_id, name, info)
+        RosterJournal.merge_change(self.pending_presence, client_id, name, info)
+        if self.presence_window_max <= 0:
+            self.send_presence_batch()
+        elif not self.presence_flush_scheduled:
+            self.presence_flush_scheduled = True
+            self.call_later(self.presence_window, self.flush_presence)
+
+    def flush_presence(self):
+        """
+        Ends a presence window. A window with several changes doubles the next one up to presence_window_max, so a
+        connect or disconnect storm costs every client a few large frames instead of one frame per change. Quiet
+        windows halve it again, so that a single change is announced quickly
+        """
         with self.client_lock:
-            client_list = {
-                'clients': [{
-                    'id': client_id,
-                    'name': self.clients[client_id].get('name')
-                } for client_id in self.clients]
-            }
-        Utils.send_json_data(client_socket, client_list)
+            self.presence_flush_scheduled = False
+            changes = len(self.pending_presence)
+            self.send_presence_batch()
+            if changes > 1:
+                self.presence_window = min(self.presence_window_max, self.presence_window * 2)
+            else:
+                self.presence_window = max(min(PRESENCE_WINDOW_MIN, self.presence_window_max), self.presence_window / 2)
+
+    def send_presence_batch(self):
+        """
+        Sends the merged changes of the window, client_lock must be held so that no client gets its roster between
+        the changes and their version. Clients with roster sync get one roster delta frame, the same one the changes
+        since their version get on connecting, legacy clients one frame per changed client
+        """
+        changes = list(self.pending_presence.values())
+        self.pending_presence = {}
+        if len(changes) == 0:
+            return
+        batch = Utils.Frame({'roster': {
+            'epoch': self.roster.epoch,
+            'version': self.roster.version,
+            'changes': changes
+        }})
+        single_frames = None
+        self.metrics.observe('chat_presence_batch_changes', len(changes))
+        self.metrics.observe('chat_fanout_recipients', len(self.clients), (('kind', 'presence'),))
+        for client_id, client in self.clients.items():
+            if client['roster_sync'] is not None:
+                self.send_to_client(client_id, batch)
+                continue
+            if single_frames is None:
+                single_frames = [(Utils.Frame(dict(change, version=self.roster.version)), change) for change in changes]
+            for frame, change in single_frames:
+                low_priority = change['info'] == 'update'
+                self.send_to_client(client_id, frame, low_priority, (change['id'], 'update') if low_priority else None)
 
     def send_client_update(self, client_id: int, info: str):
-        update_data = {
-            'id': client_id,
-            'name': self.clients[client_id].get('name'),
-            'info': info
-        }
         with self.client_lock:
-            for client in self.clients:
-                Utils.send_json_data(self.clients[client]['socket'], update_data)
+            self.broadcast_client_update(client_id, self.clients[client_id].get('name'), info)
 
     def send_client_id(self, client_id: int):
         update_data = {
-            'id': client_id
+            'id': client_id,
+            'codec': self.clients[client_id]['codec'],
+            'compression': self.clients[client_id]['compression']
         }
-        Utils.send_json_data(self.clients[client_id]['socket'], update_data)
+        if self.clients[client_id]['token'] is not None:
+            update_data['resume'] = self.clients[client_id]['token']
+        self.send_to_client(client_id, update_data)
 
     def send_message_to_recipients(self, json_data, client_id: int):
         text = json_data.get('text')
@@ -47,65 +601,687 @@ class ChatServer:
         if not isinstance(recipients, list):
             return
 
-        for recipient in recipients:
-            if recipient in self.clients:
-                Utils.send_json_data(self.clients[recipient]['socket'], {
+        data = {
+            'from': client_id,
+            'text': text if text is not None else '<No text>',
+            'msg_id': msg_id
+        }
+        offline = []
+        # under the lock, so that a recipient that starts its session meanwhile gets the message live or in its inbox
+        with self.client_lock:
+            if self.message_log is not None:
+                known = [recipient for recipient in recipients
+                         if recipient in self.clients or recipient in self.suspended_clients]
+                offline = [recipient for recipient in recipients
+                           if recipient not in self.clients and recipient in self.offline_clients]
+                keys = [MessageLog.conversation_key(client_id, recipient) for recipient in known + offline]
+                keys += [MessageLog.inbox_key(recipient) for recipient in offline]
+                if len(keys) > 0:
+                    data['offset'] = self.message_log.append(dict(data, time=time.time()), keys)
+
+            unreachable = self.deliver_message([recipient for recipient in recipients if recipient not in offline],
+                                               data)
+        self.send_failure(client_id, msg_id, unreachable)
+
+    def send_failure(self, client_id: int, msg_id, unreachable: list, room: str | None = None):
+        """
+        Reports every recipient a message could not be delivered to in a single frame
+        :param client_id: the sender
+        :param msg_id: msg_id of the message
+        :param unreachable: ids of the recipients that did not get the message
+        :param room: room the message was sent to, if any
+        """
+        if len(unreachable) == 0 and room is None:
+            return
+        failure = {
+            'info': 'Could not send message',
+            'msg_id': msg_id,
+            'recipients': unreachable
+        }
+        if room is not None:
+            failure['room'] = room
+        self.send_to_client(client_id, failure, low_priority=True)
+
+    def send_message_to_room(self, json_data, client_id: int):
+        """
+        Sends a message to every member of a room but the sender, the data is encoded once
+        """
+        room = json_data.get('room')
+        text = json_data.get('text')
+        msg_id = json_data.get('msg_id')
+        with self.client_lock:
+            if not self.rooms.is_member(room, client_id):
+                members = None
+            else:
+                members = [member for member in self.rooms.get_members(room) if member != client_id]
+            if members is not None:
+                data = {
                     'from': client_id,
+                    'room': room,
                     'text': text if text is not None else '<No text>',
                     'msg_id': msg_id
-                })
+                }
+                if self.message_log is not None:
+                    data['offset'] = self.message_log.append(dict(data, time=time.time()),
+                                                             [MessageLog.room_key(room)])
+                unreachable = self.deliver_message(members, data)
+        if members is None:
+            self.send_failure(client_id, msg_id, [], room)
+        elif len(unreachable) > 0:
+            self.send_failure(client_id, msg_id, unreachable, room)
+
+    def send_history(self, json_data, client_id: int):
+        """
+        {'history': {'with': uid} or {'room': room}, optionally with 'before': offset and 'limit': n} asks for a page
+        of a conversation, the latest messages first. Answered with {'history': {..., 'messages': [...], 'more': bool}},
+        messages oldest first, the offset of the first one is the 'before' of the next page
+        """
+        request = json_data.get('history')
+        if not isinstance(request, dict):
+            return
+        other_id = request.get('with')
+        room = request.get('room')
+        before = request.get('before')
+        limit = request.get('limit')
+        limit = min(limit, HISTORY_PAGE_SIZE) if isinstance(limit, int) and limit > 0 else HISTORY_PAGE_SIZE
+        reply = {'with': other_id} if room is None else {'room': room}
+        key = None
+        if self.message_log is not None and (isinstance(other_id, int) or isinstance(room, str)) and \
+                (before is None or isinstance(before, int)):
+            if room is None:
+                key = MessageLog.conversation_key(client_id, other_id)
+            elif self.rooms.is_member(room, client_id):
+                key = MessageLog.room_key(room)
+
+        def send_page(page: tuple):
+            messages, more = page
+            reply['messages'] = [dict(message, offset=offset) for offset, message in messages]
+            reply['more'] = more
+            self.send_to_client(client_id, {'history': reply})
+
+        if key is None:
+            send_page(([], False))
+        else:
+            self.read_message_log(lambda: self.message_log.history(key, before, limit), send_page)
+
+    def read_message_log(self, read, callback):
+        """
+        Reads from the message log and passes the result to callback(result)
+        """
+        callback(read())
+
+    def send_stored_messages(self, client_id: int, client: dict):
+        """
+        Sends a client the messages that were sent to it while it was offline. The inbox is read with
+        read_message_log, so not on the engine thread and not under client_lock, which must not be held. Messages
+        routed to the client meanwhile are held back until the inbox is queued, so that they cannot overtake it.
+        If the connection is gone by then, the inbox and the held messages are delivered again to wherever the
+        session is now
+        :param client: record of the connection that gets the messages, start_session has set its 'held' to []
+        """
+        if self.message_log is None:
+            return
+
+        def send(stored: list):
+            with self.client_lock:
+                held, client['held'] = client['held'], None
+                messages = [dict(message, offset=offset) for offset, message in stored]
+                if self.clients.get(client_id) is client:
+                    for data in messages:
+                        self.send_to_client(client_id, data)
+                    for frame in held:
+                        self.send_to_client(client_id, frame)
+                    return
+                unreachable = [data for data in messages + [frame.data for frame in held]
+                               if len(self.deliver_message([client_id], data)) > 0]
+                failed = self.keep_undelivered(client_id, unreachable)
+            for data in failed:
+                self.send_failure(data.get('from'), data.get('msg_id'), [client_id], data.get('room'))
+
+        self.read_message_log(lambda: self.message_log.take_inbox(MessageLog.inbox_key(client_id)), send)
+
+    def keep_undelivered(self, client_id: int, messages: list) -> list:
+        """
+        Puts the messages for an ended session that are in the message log back into its inbox while the client
+        counts as offline, client_lock must be held
+        :param messages: messages the client did not get
+        :return: the messages whose senders must be told that they could not be delivered, acks are dropped
+        """
+        failed = []
+        for data in messages:
+            if 'acks' in data:
+                continue
+            if client_id in self.offline_clients and 'offset' in data and 'room' not in data:
+                self.message_log.add_to_index(MessageLog.inbox_key(client_id), data['offset'])
             else:
-                Utils.send_json_data(self.clients[client_id]['socket'], {
-                    'info': 'Could not send message',
-                    'msg_id': msg_id
-                })
+                failed.append(data)
+        return failed
+
+    def forget_offline_clients(self):
+        """
+        Stops keeping messages for clients that are offline longer than the retention, client_lock must be held
+        """
+        deadline = time.monotonic() - self.offline_retention
+        while len(self.offline_clients) > 0:
+            client_id, (since, token) = next(iter(self.offline_clients.items()))
+            if since > deadline:
+                break
+            del self.offline_clients[client_id]
+            self.resume_tokens.pop(token, None)
+            self.message_log.drop_index(MessageLog.inbox_key(client_id))
+
+    def handle_room_data(self, json_data, client_id: int):
+        """
+        {'join': room} makes the client a member of the room, creating it if needed. {'leave': room} removes it,
+        the room is gone with its last member
+        """
+        with self.client_lock:
+            for info in ('join', 'leave'):
+                room = json_data.get(info)
+                if isinstance(room, str):
+                    self.update_room(room, client_id, info)
+
+    def update_room(self, room: str, client_id: int, info: str):
+        """
+        Applies a membership change and announces it to the members, client_lock must be held.
+        A joining client gets the member list
+        """
+        changed = self.rooms.join(room, client_id) if info == 'join' else self.rooms.leave(room, client_id)
+        if not changed:
+            return
+        announcement = Utils.Frame({'room': room, 'joined' if info == 'join' else 'left': client_id})
+        for member in self.rooms.get_members(room):
+            if member != client_id and member in self.clients:
+                self.send_to_client(member, announcement)
+        if info == 'join' and client_id in self.clients:
+            self.send_to_client(client_id, {'room': room, 'members': list(self.rooms.get_members(room))})
+
+    def deliver_message(self, recipients: list, data: dict) -> list:
+        """
+        Sends the same data to several clients, it is encoded once. client_lock must be held, so that a recipient
+        that starts or ends its session meanwhile gets the message in the right place
+        :param recipients: ids of the recipients
+        :param data: json data to send
+        :return: recipients that are not connected
+        """
+        trace = self.tracer.get_current()
+        if trace is not None:
+            data['trace'] = trace['trace']
+            self.tracer.mark(trace, 'route')
+        message = Utils.Frame(data)
+        unreachable = []
+        kind = 'acks' if 'acks' in data else 'message'
+        self.metrics.observe('chat_fanout_recipients', len(recipients), (('kind', kind),))
+        for recipient in recipients:
+            client = self.clients.get(recipient)
+            if client is not None and client['held'] is not None:
+                client['held'].append(message)
+            elif client is not None:
+                self.send_to_client(recipient, message)
+            elif recipient in self.suspended_clients:
+                self.keep_for_suspended_client(recipient, data)
+            else:
+                unreachable.append(recipient)
+        return unreachable
 
-    def cleanup(self, client_id: int):
+    def keep_for_suspended_client(self, client_id: int, data: dict):
+        """
+        Keeps a message until the client resumes its session, a session that misses too many messages ends early
+        """
+        suspended = self.suspended_clients[client_id]
+        suspended['missed'].append(data)
+        if len(suspended['missed']) == RESUME_BUFFER_SIZE:
+            self.call_later(0, self.end_suspended_session, client_id, suspended['token'])
+
+    @staticmethod
+    def take_hello(messages: list) -> dict:
+        """
+        Clients that support more than the legacy protocol send {'hello': {...}} right after connecting
+        :param messages: first messages received from the client, the hello is removed from them
+        :return: contents of the hello, empty if the client did not send one
+        """
+        if len(messages) > 0 and isinstance(messages[0], dict) and isinstance(messages[0].get('hello'), dict):
+            return messages.pop(0)['hello']
+        return {}
+
+    @staticmethod
+    def negotiate_codec(hello: dict) -> str:
+        """
+        :param hello: contents of the client's hello
+        :return: the first codec of the client's list that the server supports, json if there is none
+        """
+        codecs = hello.get('codecs')
+        if isinstance(codecs, list):
+            return next((codec for codec in codecs if codec in Utils.CODECS), Utils.JSON_CODEC)
+        return Utils.JSON_CODEC
+
+    def create_client(self, messages: list, **client) -> dict:
+        """
+        Builds the record of a newly connected client from its first messages
+        :param messages: first messages received from the client, a hello is removed from them
+        :param client: engine specific entries of the record
+        :return: the client record
+        """
+        hello = self.take_hello(messages)
+        client['codec'] = self.negotiate_codec(hello)
+        client['compression'] = Compression.negotiate(hello.get('compression'))
+        client['roster_sync'] = hello.get('roster') if isinstance(hello.get('roster'), dict) else None
+        # clients that know about resuming send 'resume', None until they have a token
+        client['resume'] = hello.get('resume') if 'resume' in hello else False
+        client['buckets'] = self.rate_limiter.create_buckets()
+        # clients that answer pings say so, the others are never dropped for being silent
+        client['heartbeat'] = hello.get('heartbeat') is True
+        client['last_received'] = time.monotonic()
+        client['pinged'] = 0.0
+        # messages routed to the client while its inbox is read, None when they are sent right away
+        client['held'] = None
+        return client
+
+    def start_session(self, client: dict) -> int:
+        """
+        Registers a client, sends its id and the current roster and announces it to everyone.
+        A client with the resume token of a suspended session gets that session back instead: it keeps its id, name
+        and rooms, is not announced again and receives the messages it missed. A token of a session whose connection
+        is still open takes that session over, the old connection is aborted. With a message log the token also
+        brings back the id of an ended session during the offline retention, so that the inbox is delivered, and
+        signed tokens of an earlier run of the server bring back ids that are not in use.
+        The missed messages are queued in the same critical section that registers the client, so no message routed
+        in the meantime can overtake them. The stored ones are read from the inbox afterwards, see
+        send_stored_messages
+        :param client: the record of the newly connected client, see create_client
+        :return: id of the client
+        """
+        resume = client.pop('resume')
+        with self.client_lock:
+            client_id = self.take_resumable_id(resume)
+            previous = self.clients.pop(client_id, None)
+            suspended = self.suspended_clients.pop(client_id, None)
+            if previous is not None:
+                self.replace_connection(client_id, previous)
+                client['name'] = previous.get('name')
+                kind = 'taken_over'
+            elif suspended is not None:
+                client['name'] = suspended.get('name')
+                kind = 'resumed'
+            elif client_id is not None:
+                kind = 'restored'
+            else:
+                client_id = uuid.uuid1().int
+                kind = 'new'
+            self.offline_clients.pop(client_id, None)
+            client['token'] = None
+            if resume is not False and self.resume_grace > 0:
+                self.issue_token(client_id, client)
+            self.clients[client_id] = client
+            self.watch_client(client_id, client, self.ping_interval)
+            self.send_client_id(client_id)
+            self.send_roster(client_id)
+            if kind in ('new', 'restored'):
+                self.broadcast_client_update(client_id, None, 'add')
+            if suspended is not None:
+                for data in suspended['missed']:
+                    self.send_to_client(client_id, data)
+            if self.message_log is not None:
+                client['held'] = []
+        self.send_stored_messages(client_id, client)
+        self.metrics.increment('chat_sessions_total', 1, (('kind', kind),))
+        self.log.info('connect', client=client_id, session=kind, clients=len(self.clients))
+        return client_id
+
+    def take_resumable_id(self, token) -> int | None:
+        """
+        Looks up the session of a resume token, the token is used up. client_lock must be held
+        :param token: resume token from the hello
+        :return: id of the session, None if the client gets a new id
+        """
+        if not isinstance(token, str) or self.resume_grace <= 0:
+            return None
+        client_id = self.resume_tokens.pop(token, None)
+        if client_id is not None:
+            return client_id
+        # every token of this run is in resume_tokens until its session ends or gets a new token
+        verified = self.tokens.verify(token)
+        if verified is None or verified[1]:
+            return None
+        client_id = verified[0]
+        if client_id in self.clients or client_id in self.suspended_clients or client_id in self.offline_clients:
+            return None
+        return client_id
+
+    def issue_token(self, client_id: int, client: dict):
+        """
+        Gives a session a new resume token, its previous token is no longer valid. client_lock must be held
+        """
+        self.resume_tokens.pop(client['token'], None)
+        client['token'], client['token_refresh'] = self.tokens.issue(client_id)
+        self.resume_tokens[client['token']] = client_id
+
+    def refresh_token(self, client_id: int):
+        """
+        Sends a connected client a new resume token before its current one gets too old, see ResumeTokens
+        """
+        client = self.clients.get(client_id)
+        if client is None or client['token'] is None or time.time() < client['token_refresh']:
+            return
+        with self.client_lock:
+            self.issue_token(client_id, client)
+            self.send_to_client(client_id, {'resume': client['token']})
+
+    def replace_connection(self, client_id: int, previous: dict):
+        """
+        The connection of a session that is taken over is dead but the server has not noticed yet. It is aborted and
+        its cleanup leaves the session alone. client_lock must be held
+        """
+        previous['queue'].close()
+        TimerWheel.cancel(previous.get('idle_timer'))
+        self.abort_connection(previous)
+        self.log.info('taken_over', client=client_id)
+
+    def handle_client_data(self, client_id: int, data: dict):
+        """
+        Handles one json object received from a client
+        :param client_id: the sender
+        :param data: received json data
+        """
+        if data.get('bye') is True:
+            # the client quits for good, its session is not kept for resuming
+            with self.client_lock:
+                self.resume_tokens.pop(self.clients[client_id]['token'], None)
+                self.clients[client_id]['token'] = None
+            return
+        if 'ping' in data:
+            self.send_to_client(client_id, {'pong': data.get('ping')})
+            return
+        if 'pong' in data:
+            # the read that brought it already counts
+            return
+        if 'ack' in data:
+            self.record_acks(client_id, data.get('ack'))
+            return
+        name = data.get('name')
+        if name is not None and isinstance(name, str) and name != self.clients[client_id].get('name'):
+            self.change_name(client_id, name)
+        if 'join' in data or 'leave' in data:
+            self.handle_room_data(data, client_id)
+        if 'history' in data:
+            self.send_history(data, client_id)
+            return
+        start = time.perf_counter()
+        trace = self.tracer.begin(client_id, data, frame_type(data))
+        try:
+            if 'room' in data:
+                self.send_message_to_room(data, client_id)
+            else:
+                self.send_message_to_recipients(data, client_id)
+        finally:
+            self.tracer.end(trace)
+        self.metrics.observe('chat_routing_seconds', time.perf_counter() - start)
+
+    def change_name(self, client_id: int, name: str):
+        """
+        Every name change is broadcast to all clients, so they are rate limited. A change over the limit waits until
+        the limit allows it, only the newest of the waiting names is announced
+        """
+        client = self.clients.get(client_id)
+        if client is None:
+            return
+        wait = self.rate_limiter.try_take(client['buckets'], 'names')
+        if wait > 0:
+            waiting = 'pending_name' in client
+            client['pending_name'] = name
+            if not waiting:
+                self.count_rate_limited(client_id, 'names')
+                self.call_later(wait, self.apply_pending_name, client_id)
+            return
+        client['name'] = name
+        self.send_client_update(client_id, 'update')
+
+    def apply_pending_name(self, client_id: int):
+        client = self.clients.get(client_id)
+        if client is None or 'pending_name' not in client:
+            return
+        name = client.pop('pending_name')
+        if name != client.get('name'):
+            self.change_name(client_id, name)
+
+    def limit_reading(self, client_id: int, messages: list | None, reader: Utils.FrameReader) -> float:
+        """
+        Charges the frames of one read to the client's message and byte limits
+        :return: seconds the engine waits before it handles the frames and reads again, so that a flooding client
+        is slowed down by its own TCP window while nothing it sent is lost
+        """
+        if not messages:
+            return 0.0
+        buckets = self.clients[client_id]['buckets']
+        wait = 0.0
+        for kind, amount in (('messages', len(messages)), ('bytes', sum(reader.frame_sizes))):
+            kind_wait = self.rate_limiter.take(buckets, kind, amount)
+            if kind_wait > 0:
+                self.count_rate_limited(client_id, kind)
+                wait = max(wait, kind_wait)
+        return wait
+
+    def count_rate_limited(self, client_id: int, kind: str):
+        self.metrics.increment('chat_rate_limited_total', 1, (('kind', kind),))
+        self.log.warning('rate_limited', client=client_id, kind=kind)
+
+    def check_load(self):
+        """
+        Updates the admission control every LOAD_CHECK_INTERVAL seconds, must first be called on the engine's thread
+        """
+        queued_bytes = 0
+        if self.admission.max_queued_bytes > 0:
+            queued_bytes = sum(client['queue'].queued_bytes for client in list(self.clients.values()))
+        if self.admission.update(queued_bytes):
+            self.log.warning('overloaded' if self.admission.overloaded else 'recovered',
+                             cpu=round(self.admission.cpu_usage, 3), queued_bytes=queued_bytes)
+        self.call_later(LOAD_CHECK_INTERVAL, self.check_load)
+
+    def refuse_connection(self):
+        self.metrics.increment('chat_admission_refused_total')
+        self.log.warning('refused', cpu=round(self.admission.cpu_usage, 3), queued_bytes=self.admission.queued_bytes)
+
+    def record_acks(self, client_id: int, acks):
+        """
+        Collects the acks of a recipient, they are forwarded to the senders after ack_flush_delay. An ack is
+        cumulative: the recipient got (delivered) or read every message from the sender up to that msg_id, so only
+        the highest one per sender, recipient and kind is kept
+        :param client_id: the recipient
+        :param acks: list of {'from': sender, 'delivered': msg_id, 'read': msg_id}, either msg_id may be missing
+        """
+        if not isinstance(acks, list):
+            return
+        with self.client_lock:
+            for ack in acks:
+                sender = ack.get('from') if isinstance(ack, dict) else None
+                if not isinstance(sender, int):
+                    continue
+                for kind in ACK_KINDS:
+                    msg_id = ack.get(kind)
+                    if not isinstance(msg_id, int) or isinstance(msg_id, bool):
+                        continue
+                    pending = self.pending_acks.setdefault(sender, {}).setdefault(client_id, {})
+                    pending[kind] = max(pending.get(kind, msg_id), msg_id)
+                    self.metrics.increment('chat_acks_total', 1, (('kind', kind),))
+            schedule = len(self.pending_acks) > 0 and not self.ack_flush_scheduled
+            if schedule:
+                self.ack_flush_scheduled = True
+        if schedule:
+            self.call_later(self.ack_flush_delay, self.flush_acks)
+
+    def flush_acks(self):
+        """
+        Forwards the collected acks, every sender gets one frame {'acks': [{'by': recipient, ...}, ...]}.
+        They take the way of messages, so a suspended sender gets them when it resumes
+        """
+        with self.client_lock:
+            pending, self.pending_acks = self.pending_acks, {}
+            self.ack_flush_scheduled = False
+            for sender, acks in pending.items():
+                self.deliver_message([sender], {'acks': [dict(ack, by=recipient) for recipient, ack in acks.items()]})
+
+    def cleanup(self, client_id: int, client: dict):
+        """
+        Ends the session of a disconnected client, or suspends it for resume_grace seconds if the client has a resume
+        token. A suspended client stays in the roster and its rooms and messages for it are kept
+        :param client: record of the connection, a session that another connection took over is left alone
+        """
         try:
-            self.clients[client_id]['socket'].close()
-            self.send_client_update(client_id, 'delete')
-            self.clients.pop(client_id)
-            with self.print_lock:
-                print(f'- {client_id} ({len(self.clients)})')
+            self.close_client(client)
+            with self.client_lock:
+                if self.clients.get(client_id) is not client:
+                    self.metrics.increment('chat_disconnects_total')
+                    self.log.info('disconnect', client=client_id, taken_over=True, clients=len(self.clients))
+                    return
+                del self.clients[client_id]
+                TimerWheel.cancel(client.get('idle_timer'))
+                if client['token'] is not None:
+                    self.suspended_clients[client_id] = {'name': client.get('name'), 'token': client['token'],
+                                                         'missed': []}
+                    self.call_later(self.resume_grace, self.end_suspended_session, client_id, client['token'])
+                else:
+                    self.end_session(client_id, client.get('name'))
+            self.metrics.increment('chat_disconnects_total')
+            self.log.info('disconnect', client=client_id, suspended=client['token'] is not None,
+                          clients=len(self.clients))
         except Exception as e:
-            with self.print_lock:
-                print(f'cleanup: {e}')
+            self.log.warning('cleanup_failed', client=client_id, error=e)
+
+    def end_session(self, client_id: int, name: str | None, token: str | None = None):
+        """
+        Announces that a client is gone, client_lock must be held. With a message log and a resume token the client
+        counts as offline during the offline retention: messages for it wait in its inbox. Without a token no one can
+        come back with its id to collect them, so messages for it fail
+        :param token: resume token of the session, with a message log it stays valid during the offline retention
+        """
+        self.broadcast_client_update(client_id, name, 'delete')
+        if self.message_log is None or token is None:
+            self.resume_tokens.pop(token, None)
+            return
+        self.forget_offline_clients()
+        self.offline_clients[client_id] = (time.monotonic(), token)
+
+    def end_suspended_session(self, client_id: int, token: str):
+        """
+        Ends a suspended session that was not resumed. The messages it missed go to the client's inbox when they
+        are in the message log, the senders of the others are told that they could not be delivered
+        :param token: resume token of the session, nothing is done if the session was resumed in the meantime
+        """
+        with self.client_lock:
+            suspended = self.suspended_clients.get(client_id)
+            if suspended is None or suspended['token'] != token:
+                return
+            del self.suspended_clients[client_id]
+            self.end_session(client_id, suspended.get('name'), token)
+            failed = self.keep_undelivered(client_id, suspended['missed'])
+        for data in failed:
+            self.send_failure(data.get('from'), data.get('msg_id'), [client_id], data.get('room'))
+        self.log.info('session_end', client=client_id, missed=len(suspended['missed']))
 
     def start_serving(self, ip: str, port: int):
-        def client_thread(cid: int, client_socket: socket.socket):
-            self.send_client_id(cid)
-            self.send_whole_client_list(client_socket)
-            self.send_client_update(cid, 'add')
-            while True:
-                data = Utils.receive_json_data(client_socket, MAX_DATA_SIZE)
-                if data is None:
+        def receive_hello(client_socket: socket.socket, reader: Utils.FrameReader) -> list:
+            deadline = time.monotonic() + self.hello_timeout
+            messages = []
+            while len(messages) == 0 and deadline > time.monotonic():
+                client_socket.settimeout(deadline - time.monotonic())
+                messages = reader.receive(client_socket)
+                if messages is None:
+                    messages = []
                     break
-                name = data.get('name')
-                if name is not None and isinstance(name, str) and name != self.clients[cid].get('name'):
-                    self.clients[cid]['name'] = name
-                    self.send_client_update(cid, 'update')
-                self.send_message_to_recipients(data, cid)
-            self.cleanup(cid)
+                self.count_received(messages, reader)
+            client_socket.settimeout(None)
+            return messages
 
-        context = ssl.create_default_context(ssl.Purpose.CLIENT_AUTH)
-        context.load_cert_chain(certfile="C:\\openssl\\cert.pem", keyfile="C:\\openssl\\key.pem", password="password")
+        def handshake(client_socket: socket.socket) -> ssl.SSLSocket | None:
+            """
+            Runs on the client's own thread so that a slow handshake never holds up accepting
+            """
+            start = time.perf_counter()
+            try:
+                client_socket.settimeout(self.handshake_timeout)
+                client_socket = context.wrap_socket(sock=client_socket, server_side=True)
+                client_socket.settimeout(None)
+            except (Exception,) as e:
+                client_socket.close()
+                self.metrics.increment('chat_handshake_failures_total')
+                self.log.warning('handshake_failed', error=e)
+                return None
+            self.metrics.observe('chat_handshake_seconds', time.perf_counter() - start)
+            return client_socket
+
+        def client_thread(client_socket: socket.socket):
+            client_socket = handshake(client_socket)
+            if client_socket is None:
+                return
+            set_user_timeout(client_socket, self.ping_interval + self.ping_timeout if self.ping_interval > 0 else 0)
+            reader = Utils.FrameReader(MAX_DATA_SIZE)
+            messages = receive_hello(client_socket, reader)
+            ready = threading.Event()
+            queue = self.create_outbound_queue(ready.set)
+            client = self.create_client(messages, socket=client_socket, queue=queue)
+            cid = self.start_session(client)
+            threading.Thread(target=writer_thread, args=(cid, client_socket, queue, ready)).start()
+
+            while messages is not None and self.clients.get(cid) is client:
+                self.mark_alive(cid)
+                wait = self.limit_reading(cid, messages, reader)
+                if wait > 0:
+                    time.sleep(wait)
+                for data in messages:
+                    self.handle_client_data(cid, data)
+                messages = reader.receive(client_socket)
+                self.count_received(messages, reader)
+            self.cleanup(cid, client)
+
+        def writer_thread(cid: int, client_socket: socket.socket, queue: OutboundQueue, ready: threading.Event):
+            while not queue.is_closed():
+                ready.wait()
+                if self.flush_window > 0:
+                    time.sleep(self.flush_window)
+                ready.clear()
+                frames = queue.pop_all()
+                if len(frames) == 0:
+                    continue
+                self.count_write(frames)
+                if not Utils.send_frames(client_socket, frames):
+                    self.evict_client(cid, queue)
+                    break
+                self.trace_write(frames)
+
+        context = self.create_ssl_context()
+        self.start_admin_endpoint()
+        self.check_load()
+        self.run_timers()
 
         self.server = socket.socket()
         self.server.bind((ip, port))
         self.server.listen()
-        self.client_lock = threading.Lock()
-        self.print_lock = threading.Lock()
         while True:
             try:
                 sock, _ = self.server.accept()
-                sock = context.wrap_socket(sock=sock, server_side=True)
-                client_id = uuid.uuid1().int
-                self.clients[client_id] = {'socket': sock}
+                # while overloaded new connections wait, before their handshake, and are refused if it lasts
+                deadline = time.monotonic() + self.admission_delay
+                while self.admission.overloaded and time.monotonic() < deadline:
+                    time.sleep(ADMISSION_POLL)
+                if self.admission.overloaded:
+                    sock.close()
+                    self.refuse_connection()
+                    continue
+                threading.Thread(target=client_thread, args=(sock,)).start()
+            except Exception as e:
+                self.log.warning('accept_failed', error=e)
 
-                with self.print_lock:
-                    print(f'+ {client_id} ({len(self.clients)})')
 
-                threading.Thread(target=client_thread, args=(client_id, sock)).start()
-            except Exception as e:
-                with self.print_lock:
-                    print(f'start_serving: {e}')
+def set_user_timeout(client_socket, timeout: float):
+    """
+    Makes the kernel drop a connection whose sent data stays unacknowledged for timeout seconds, so that the ping to
+    a vanished client that does not answer pings still ends its connection. Only where TCP_USER_TIMEOUT exists
+    :param client_socket: a socket or the socket of an asyncio transport
+    :param timeout: 0 keeps the system default
+    """
+    if timeout <= 0 or not hasattr(socket, 'TCP_USER_TIMEOUT'):
+        return
+    try:
+        client_socket.setsockopt(socket.IPPROTO_TCP, socket.TCP_USER_TIMEOUT, int(timeout * 1000))
+    except OSError:
+        pass
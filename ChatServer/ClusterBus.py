@@ -0,0 +1,191 @@
+import asyncio
+import uuid
+
+import ChatServer
+import Utils
+from OutboundQueue import OutboundQueue
+from RoomIndex import RoomIndex
+
+BUS_MAX_DATA_SIZE = 2 * ChatServer.MAX_DATA_SIZE
+BUS_QUEUE_LIMIT = 64 * 1024 * 1024
+
+
+def encode_bus_data(data: dict) -> bytes:
+    return Utils.encode_frame(data, Utils.BINARY_CODEC)
+
+
+async def receive_bus_messages(reader: asyncio.StreamReader, frame_reader: Utils.FrameReader) -> list | None:
+    """
+    Reads once from a bus connection
+    :return: list of bus messages, possibly empty. None if the connection is gone
+    """
+    try:
+        received = await reader.read(Utils.RECEIVE_BUFFER_SIZE)
+    except OSError:
+        return None
+    return frame_reader.feed(received) if received else None
+
+
+def create_bus_queue() -> tuple:
+    """
+    Every bus connection has an outbound queue like a client, nothing on the bus may be dropped, so a connection
+    whose queue exceeds BUS_QUEUE_LIMIT is given up instead of buffering without bound
+    :return: the queue and the event that is set when it has something for write_bus_frames
+    """
+    ready = asyncio.Event()
+    return OutboundQueue(BUS_QUEUE_LIMIT, BUS_QUEUE_LIMIT, ready.set), ready
+
+
+async def write_bus_frames(writer: asyncio.StreamWriter, queue: OutboundQueue, ready: asyncio.Event):
+    """
+    Writes everything queued at once and waits for the transport to flush before taking more, so a peer that does
+    not read fills only its queue. The connection is aborted if writing fails
+    """
+    while not queue.is_closed():
+        await ready.wait()
+        ready.clear()
+        frames = queue.pop_all()
+        if len(frames) == 0:
+            continue
+        try:
+            writer.write(b''.join(frames))
+            await writer.drain()
+        except (Exception,):
+            queue.close()
+            writer.transport.abort()
+
+
+class BusHub:
+    """
+    Connects the worker processes of a cluster over a Unix domain socket.
+
+    Every roster change of every worker passes through the hub, which numbers it and sends it to all workers in the
+    same order, so every worker holds the same roster with the same versions. Room membership changes take the
+    same way, the worker of the client has applied them already. Messages for clients of another worker are
+    forwarded to that worker only, recipients that are gone are reported back to the sender's worker. Every worker
+    has an outbound queue, a worker that does not keep up with its queue is disconnected like a slow client.
+
+    Bus messages are json data with a 'bus' entry:
+        worker -> hub   {'bus': 'join', 'worker': w}
+        hub -> worker   {'bus': 'sync', 'epoch': e, 'version': v, 'clients': [{'id', 'name', 'worker'}, ...],
+                         'rooms': {room: [id, ...]}}
+        both ways       {'bus': 'presence', 'id', 'name', 'info', 'worker'}, the hub adds 'version' when sending
+        both ways       {'bus': 'route', 'worker': w, 'recipients': [...], 'data': {...}}
+        both ways       {'bus': 'room', 'room': room, 'id': id, 'info': 'join' | 'leave', 'worker': w}
+        both ways       {'bus': 'failure', 'worker': w, 'id': sender, 'msg_id', 'recipients': [...], 'room'}
+    """
+    path: str = None
+    epoch: int = None
+    version: int = None
+    clients: dict = None
+    workers: dict = None
+    rooms: RoomIndex = None
+
+    def __init__(self, path: str):
+        """
+        :param path: path of the Unix domain socket
+        """
+        self.path = path
+        self.epoch = uuid.uuid4().int >> 64
+        self.version = 0
+        self.clients = {}
+        self.workers = {}
+        self.rooms = RoomIndex()
+
+    def publish_presence(self, client_id: int, name: str | None, info: str, worker: int):
+        if info == 'delete':
+            self.clients.pop(client_id, None)
+            self.rooms.remove_client(client_id)
+        else:
+            self.clients[client_id] = {'id': client_id, 'name': name, 'worker': worker}
+        self.version += 1
+        frame = encode_bus_data({
+            'bus': 'presence', 'id': client_id, 'name': name, 'info': info, 'worker': worker, 'version': self.version
+        })
+        for worker in list(self.workers):
+            self.send_to_worker(worker, frame)
+
+    def send_to_worker(self, worker: int, frame: bytes) -> bool:
+        """
+        :return: False if the worker is not connected (anymore)
+        """
+        connection = self.workers.get(worker)
+        if connection is None:
+            return False
+        if connection['queue'].put(frame):
+            return True
+        self.evict_worker(worker)
+        return False
+
+    def evict_worker(self, worker: int):
+        """
+        Drops a worker that does not keep up with its queue, its reader ends and its clients are removed
+        """
+        connection = self.workers.pop(worker, None)
+        if connection is None:
+            return
+        connection['queue'].close()
+        connection['writer'].transport.abort()
+
+    def handle_bus_data(self, worker: int, data: dict):
+        kind = data.get('bus')
+        if kind == 'presence':
+            self.publish_presence(data.get('id'), data.get('name'), data.get('info'), worker)
+        elif kind == 'route':
+            if not self.send_to_worker(data.get('worker'), encode_bus_data(data)):
+                self.report_unreachable(worker, data)
+        elif kind == 'failure':
+            self.send_to_worker(data.get('worker'), encode_bus_data(data))
+        elif kind == 'room':
+            room, client_id = data.get('room'), data.get('id')
+            if data.get('info') == 'join':
+                self.rooms.join(room, client_id)
+            else:
+                self.rooms.leave(room, client_id)
+            frame = encode_bus_data(data)
+            for worker in list(self.workers):
+                self.send_to_worker(worker, frame)
+
+    def report_unreachable(self, worker: int, route: dict):
+        """
+        Tells the worker of the sender that the recipients of a route are gone with their worker
+        """
+        data = route.get('data')
+        if not isinstance(data, dict) or 'acks' in data or data.get('from') is None:
+            return
+        self.send_to_worker(worker, encode_bus_data({
+            'bus': 'failure', 'worker': worker, 'id': data.get('from'), 'msg_id': data.get('msg_id'),
+            'recipients': route.get('recipients'), 'room': data.get('room')
+        }))
+
+    async def handle_worker(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+        frame_reader = Utils.FrameReader(BUS_MAX_DATA_SIZE)
+        messages = []
+        while messages is not None and len(messages) == 0:
+            messages = await receive_bus_messages(reader, frame_reader)
+        if messages is None or messages[0].get('bus') != 'join':
+            writer.close()
+            return
+
+        worker = messages.pop(0).get('worker')
+        queue, ready = create_bus_queue()
+        connection = {'queue': queue, 'writer': writer}
+        self.workers[worker] = connection
+        writer_task = asyncio.create_task(write_bus_frames(writer, queue, ready))
+        self.send_to_worker(worker, encode_bus_data({
+            'bus': 'sync', 'epoch': self.epoch, 'version': self.version, 'clients': list(self.clients.values()),
+            'rooms': {room: list(members) for room, members in self.rooms.members.items()}
+        }))
+        while messages is not None and self.workers.get(worker) is connection:
+            for data in messages:
+                self.handle_bus_data(worker, data)
+            messages = await receive_bus_messages(reader, frame_reader)
+
+        # worker is gone and so are its clients
+        if self.workers.get(worker) is connection:
+            del self.workers[worker]
+        queue.close()
+        for client in [client for client in self.clients.values() if client['worker'] == worker]:
+            self.publish_presence(client['id'], client['name'], 'delete', worker)
+        writer.close()
+        await writer_task
@@ -0,0 +1,225 @@
+import asyncio
+import multiprocessing
+import os
+import shutil
+import socket
+import tempfile
+
+import AsyncChatServer
+import ClusterBus
+import Utils
+from EventLog import configure_logging
+from OutboundQueue import OutboundQueue
+from RoomIndex import RoomIndex
+
+
+class ClusterChatServer(AsyncChatServer.AsyncChatServer):
+    """
+    One worker process of a cluster. Every worker accepts connections on the same port (SO_REUSEPORT lets the
+    kernel spread them) and serves them like AsyncChatServer. Roster changes go through the bus hub and are applied
+    when the hub sends them back, so all workers number them the same way and a client keeps its roster version
+    when it reconnects to another worker. Room membership changes are applied by the client's worker at once and
+    by the others when the hub sends them on. Messages to clients of another worker are forwarded over the bus.
+    Sessions are not resumed: the kernel may hand a reconnect to any worker and a session can not move between them.
+    """
+    worker: int = None
+    bus_path: str = None
+    bus_writer: asyncio.StreamWriter = None
+    bus_queue: OutboundQueue = None
+    cluster_clients: dict = None
+
+    def __init__(self, worker: int, bus_path: str, **kwargs):
+        """
+        :param worker: number of this worker, unique in the cluster
+        :param bus_path: path of the Unix domain socket of the bus hub
+        :param kwargs: see ChatServer, resume_grace is ignored
+        """
+        super().__init__(**dict(kwargs, resume_grace=0))
+        self.worker = worker
+        if self.admin_port is not None:
+            # every worker has its own metrics on the next port
+            self.admin_port += worker
+        self.bus_path = bus_path
+        self.cluster_clients = {}
+
+    def publish(self, data: dict):
+        """
+        Queues data for the hub. If the hub does not keep up the bus is given up, the worker stops serving then
+        """
+        if not self.bus_queue.put(ClusterBus.encode_bus_data(data)) and not self.bus_queue.is_closed():
+            self.bus_queue.close()
+            self.log.warning('bus_evicted', worker=self.worker)
+            self.bus_writer.transport.abort()
+
+    def get_roster_entries(self) -> dict:
+        return {cid: client['name'] for cid, client in self.cluster_clients.items()}
+
+    def broadcast_client_update(self, client_id: int, name: str | None, info: str):
+        # the change is recorded and sent to the clients once the hub has numbered it, see apply_presence
+        self.publish({'bus': 'presence', 'id': client_id, 'name': name, 'info': info})
+
+    def apply_presence(self, data: dict):
+        client_id, name, info = data.get('id'), data.get('name'), data.get('info')
+        with self.client_lock:
+            if info == 'delete':
+                self.cluster_clients.pop(client_id, None)
+            else:
+                self.cluster_clients[client_id] = {'name': name, 'worker': data.get('worker')}
+            if self.roster.version + 1 != data.get('version'):
+                self.roster.reset(self.roster.epoch, data.get('version') - 1)
+            super().broadcast_client_update(client_id, name, info)
+
+    def apply_sync(self, data: dict):
+        with self.client_lock:
+            self.roster.reset(data.get('epoch'), data.get('version'))
+            self.cluster_clients = {
+                client['id']: {'name': client['name'], 'worker': client['worker']} for client in data.get('clients')
+            }
+            self.rooms = RoomIndex()
+            for room, members in data.get('rooms', {}).items():
+                for member in members:
+                    self.rooms.join(room, member)
+
+    def update_room(self, room: str, client_id: int, info: str):
+        # applied here at once, so that the client's next frames already see it, and on the other workers once the
+        # hub sends it on. Only a client's own worker changes its memberships, so they apply in the same order
+        if self.rooms.is_member(room, client_id) == (info == 'join'):
+            return
+        super().update_room(room, client_id, info)
+        self.publish({'bus': 'room', 'room': room, 'id': client_id, 'info': info, 'worker': self.worker})
+
+    def deliver_message(self, recipients: list, data: dict) -> list:
+        local = []
+        remote = {}
+        unreachable = []
+        for recipient in recipients:
+            worker = self.cluster_clients.get(recipient, {}).get('worker')
+            if recipient in self.clients or recipient in self.suspended_clients:
+                local.append(recipient)
+            elif worker is not None and worker != self.worker:
+                remote.setdefault(worker, []).append(recipient)
+            else:
+                unreachable.append(recipient)
+        unreachable.extend(super().deliver_message(local, data))
+        for worker, worker_recipients in remote.items():
+            self.publish({'bus': 'route', 'worker': worker, 'recipients': worker_recipients, 'data': data})
+        return unreachable
+
+    def send_failure(self, client_id: int, msg_id, unreachable: list, room: str | None = None):
+        # the sender of a forwarded message is a client of another worker, the failure goes back over the bus
+        worker = self.cluster_clients.get(client_id, {}).get('worker')
+        if client_id in self.clients or client_id in self.suspended_clients or worker is None or \
+                worker == self.worker:
+            super().send_failure(client_id, msg_id, unreachable, room)
+        elif len(unreachable) > 0 or room is not None:
+            self.publish({'bus': 'failure', 'worker': worker, 'id': client_id, 'msg_id': msg_id,
+                          'recipients': unreachable, 'room': room})
+
+    def handle_bus_data(self, data: dict):
+        kind = data.get('bus')
+        if kind == 'presence':
+            self.apply_presence(data)
+        elif kind == 'route':
+            # the recipients may have left in the meantime
+            message = data.get('data')
+            with self.client_lock:
+                unreachable = super().deliver_message(data.get('recipients'), message)
+            if len(unreachable) > 0 and 'acks' not in message:
+                self.send_failure(message.get('from'), message.get('msg_id'), unreachable, message.get('room'))
+        elif kind == 'failure':
+            super().send_failure(data.get('id'), data.get('msg_id'), data.get('recipients'), data.get('room'))
+        elif kind == 'room':
+            if data.get('worker') == self.worker:
+                # applied when it was published
+                return
+            with self.client_lock:
+                super().update_room(data.get('room'), data.get('id'), data.get('info'))
+        elif kind == 'sync':
+            self.apply_sync(data)
+
+    async def join_bus(self) -> tuple:
+        """
+        Connects to the hub and waits for the roster of the cluster
+        :return: reader, frame reader and bus messages received after the sync
+        """
+        reader, self.bus_writer = await asyncio.open_unix_connection(self.bus_path)
+        self.bus_queue, ready = ClusterBus.create_bus_queue()
+        asyncio.create_task(ClusterBus.write_bus_frames(self.bus_writer, self.bus_queue, ready))
+        self.publish({'bus': 'join', 'worker': self.worker})
+        frame_reader = Utils.FrameReader(ClusterBus.BUS_MAX_DATA_SIZE)
+        messages = []
+        while messages is not None and len(messages) == 0:
+            messages = await ClusterBus.receive_bus_messages(reader, frame_reader)
+        if messages is None or messages[0].get('bus') != 'sync':
+            raise ConnectionError('bus hub did not send the roster')
+        self.apply_sync(messages.pop(0))
+        return reader, frame_reader, messages
+
+    async def follow_bus(self, reader: asyncio.StreamReader, frame_reader: Utils.FrameReader, messages: list):
+        while messages is not None:
+            for data in messages:
+                self.handle_bus_data(data)
+            messages = await ClusterBus.receive_bus_messages(reader, frame_reader)
+        self.log.warning('bus_lost', worker=self.worker)
+
+    async def serve(self, ip: str, port: int):
+        self.loop = asyncio.get_running_loop()
+        self.check_load()
+        self.run_timers()
+        bus = await self.join_bus()
+        server = await asyncio.start_server(self.handle_connection, sock=create_listening_socket(ip, port),
+                                            ssl=self.create_ssl_context(),
+                                            ssl_handshake_timeout=self.handshake_timeout)
+        async with server:
+            # without the bus the roster can not be kept consistent, stop serving
+            await self.follow_bus(*bus)
+
+
+def create_listening_socket(ip: str, port: int) -> socket.socket:
+    """
+    :return: a listening socket that shares its port with the other workers
+    """
+    listening_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    listening_socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    listening_socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
+    listening_socket.bind((ip, port))
+    listening_socket.listen(AsyncChatServer.LISTEN_BACKLOG)
+    listening_socket.setblocking(False)
+    return listening_socket
+
+
+def run_worker(worker: int, bus_path: str, ip: str, port: int, log_level: str, server_kwargs: dict):
+    # spawned workers start with a fresh logging configuration
+    configure_logging(log_level)
+    ClusterChatServer(worker, bus_path, **server_kwargs).start_serving(ip, port)
+
+
+async def serve_bus(hub: ClusterBus.BusHub, workers: list):
+    server = await asyncio.start_unix_server(hub.handle_worker, hub.path)
+    for process in workers:
+        process.start()
+    async with server:
+        await server.serve_forever()
+
+
+def run_cluster(ip: str, port: int, workers: int, log_level: str = 'INFO', **server_kwargs):
+    """
+    Runs the bus hub in this process and the given number of worker processes. Needs SO_REUSEPORT and Unix domain
+    sockets, so Linux or another Unix
+    :param log_level: logging level of the workers
+    :param server_kwargs: see ChatServer
+    """
+    if not hasattr(socket, 'SO_REUSEPORT') or not hasattr(socket, 'AF_UNIX'):
+        raise RuntimeError('the cluster needs SO_REUSEPORT and Unix domain sockets')
+    bus_dir = tempfile.mkdtemp(prefix='chat-bus-')
+    hub = ClusterBus.BusHub(os.path.join(bus_dir, 'bus.sock'))
+    # workers must not inherit the hub's event loop
+    context = multiprocessing.get_context('spawn')
+    processes = [
+        context.Process(target=run_worker, args=(worker, hub.path, ip, port, log_level, server_kwargs), daemon=True)
+        for worker in range(workers)
+    ]
+    try:
+        asyncio.run(serve_bus(hub, processes))
+    finally:
+        shutil.rmtree(bus_dir, ignore_errors=True)
@@ -0,0 +1,66 @@
+import json
+import logging
+import time
+
+LOG_RATE = 10
+LOG_FORMAT = '%(asctime)s %(levelname)s %(message)s'
+
+
+class EventLog:
+    """
+    Structured, rate-limited log. A record is an event name with key=value fields on one line, so that it can be
+    searched and parsed. Every event may be logged rate times per second, further records of the event are only
+    counted and the next record that gets through carries that count as 'suppressed'.
+    The standard logging module does the output, see configure_logging
+    """
+    logger: logging.Logger = None
+    rate: int = None
+    windows: dict = None
+
+    def __init__(self, name: str = 'chat', rate: int = LOG_RATE):
+        """
+        :param name: name of the logger
+        :param rate: records per event and second, 0 for no limit
+        """
+        self.logger = logging.getLogger(name)
+        self.rate = rate
+        self.windows = {}
+
+    def log(self, event: str, level: int = logging.INFO, **fields):
+        if not self.logger.isEnabledFor(level):
+            return
+        if self.rate > 0:
+            now = time.monotonic()
+            # start of the current second, records in it, records suppressed in it
+            window = self.windows.get(event)
+            if window is None or now - window[0] >= 1:
+                if window is not None and window[2] > 0:
+                    fields['suppressed'] = window[2]
+                self.windows[event] = [now, 1, 0]
+            elif window[1] < self.rate:
+                window[1] += 1
+            else:
+                window[2] += 1
+                return
+        self.logger.log(level, ' '.join([f'event={event}'] +
+                                        [f'{key}={format_value(value)}' for key, value in fields.items()]))
+
+    def info(self, event: str, **fields):
+        self.log(event, logging.INFO, **fields)
+
+    def warning(self, event: str, **fields):
+        self.log(event, logging.WARNING, **fields)
+
+
+def format_value(value) -> str:
+    """
+    Values with spaces, quotes or '=' are quoted so that the line stays parsable
+    """
+    text = str(value)
+    if text == '' or any(character in text for character in ' "=\n'):
+        return json.dumps(text)
+    return text
+
+
+def configure_logging(level: str = 'INFO'):
+    logging.basicConfig(level=level, format=LOG_FORMAT)
@@ -0,0 +1,481 @@
+import bisect
+import collections
+import hashlib
+import mmap
+import os
+import struct
+import threading
+import time
+import zlib
+
+import BinaryCodec
+
+SEGMENT_SIZE = 64 * 1024 * 1024
+COMMIT_INTERVAL = 0.005
+RETENTION_CHECK_INTERVAL = 60.0
+OPEN_INDEXES = 1024
+HISTORY_PAGE_SIZE = 50
+
+RECORD_HEADER = struct.Struct('<II')
+INDEX_HEADER = struct.Struct('=QQ')
+INDEX_ENTRY = struct.Struct('=Q')
+INDEX_INITIAL_ENTRIES = 512
+
+
+class OffsetIndex:
+    """
+    Memory-mapped, append-only list of log offsets of one conversation or inbox. The file starts with the number of
+    entries and a cursor (used by inboxes for the first undelivered entry), followed by the entries. Capacity doubles
+    when it is exhausted, so appends do not change the file size most of the time
+    """
+    path: str = None
+    fd: int = None
+    map: mmap.mmap = None
+    count: int = None
+    cursor: int = None
+
+    def __init__(self, path: str):
+        self.path = path
+        self.fd = os.open(path, os.O_RDWR | os.O_CREAT, 0o644)
+        size = os.fstat(self.fd).st_size
+        if size < INDEX_HEADER.size + INDEX_INITIAL_ENTRIES * INDEX_ENTRY.size:
+            size = INDEX_HEADER.size + INDEX_INITIAL_ENTRIES * INDEX_ENTRY.size
+            os.ftruncate(self.fd, size)
+        self.map = mmap.mmap(self.fd, size)
+        self.count, self.cursor = INDEX_HEADER.unpack_from(self.map, 0)
+        self.count = min(self.count, (size - INDEX_HEADER.size) // INDEX_ENTRY.size)
+        # entries taken from an inbox before they were written may be missing after a crash
+        self.cursor = min(self.cursor, self.count)
+
+    def append(self, offset: int):
+        position = INDEX_HEADER.size + self.count * INDEX_ENTRY.size
+        if position + INDEX_ENTRY.size > len(self.map):
+            self.__grow__()
+        INDEX_ENTRY.pack_into(self.map, position, offset)
+        self.count += 1
+        INDEX_HEADER.pack_into(self.map, 0, self.count, self.cursor)
+
+    def set_cursor(self, cursor: int):
+        self.cursor = cursor
+        INDEX_HEADER.pack_into(self.map, 0, self.count, self.cursor)
+
+    def read(self, start: int, stop: int) -> list:
+        """
+        :return: entries start to stop (excluded)
+        """
+        with memoryview(self.map) as view, view[INDEX_HEADER.size:].cast('Q') as entries:
+            return entries[start:stop].tolist()
+
+    def find(self, offset: int) -> int:
+        """
+        :return: number of entries below offset, entries are ascending
+        """
+        with memoryview(self.map) as view, view[INDEX_HEADER.size:].cast('Q') as entries:
+            return bisect.bisect_left(entries, offset, 0, self.count)
+
+    def flush(self):
+        self.map.flush()
+
+    def close(self):
+        self.map.flush()
+        self.map.close()
+        os.close(self.fd)
+
+    def __grow__(self):
+        size = len(self.map) * 2
+        self.map.close()
+        os.ftruncate(self.fd, size)
+        self.map = mmap.mmap(self.fd, size)
+
+
+class MessageLog:
+    """
+    Durable, append-only message log on local disk.
+
+    Records go to segment files named after the log offset of their first byte, a new segment is started when the
+    current one exceeds segment_size. Each record is its length and crc32 followed by the binary encoded message.
+    Every conversation (and every inbox of undelivered messages) has an OffsetIndex with the offsets of its records,
+    so a page of history is a binary search in the index and one read per message.
+
+    Appends never touch the disk, they assign the offset and keep the record and its index entries in memory, so
+    they may be called on an event loop. A writer thread writes what was appended at most every commit_interval
+    seconds and syncs it with a single fsync (group commit), the lock is only held while it moves entries into the
+    indexes. Reads see what is not written yet. The commit is asynchronous: a message is appended and delivered
+    before it is on disk, if the process dies within commit_interval of the append the message is lost.
+
+    Segments last written more than retention seconds ago are deleted, oldest first, and so are index files that
+    only point into deleted segments
+    """
+    path: str = None
+    segment_size: int = None
+    commit_interval: float = None
+    retention: float | None = None
+    segments: list = None
+    segment_fds: dict = None
+    retired_fds: list = None
+    end: int = None
+    written_end: int = None
+    unwritten: dict = None
+    unindexed: dict = None
+    indexes: collections.OrderedDict = None
+    dirty_indexes: set = None
+    dropped_keys: list = None
+    dirty: bool = None
+    lock: threading.Lock = None
+    commit_condition: threading.Condition = None
+    writer: threading.Thread = None
+    closed: bool = None
+
+    def __init__(self, path: str, segment_size: int = SEGMENT_SIZE, commit_interval: float = COMMIT_INTERVAL,
+                 retention: float | None = None):
+        """
+        :param path: directory of the log, created if needed
+        :param segment_size: bytes after which a new segment file is started
+        :param commit_interval: seconds appends are gathered before they are synced to disk together
+        :param retention: seconds after their last write segments are deleted, None keeps them forever
+        """
+        self.path = path
+        self.segment_size = segment_size
+        self.commit_interval = commit_interval
+        self.retention = retention
+        self.segment_fds = {}
+        self.retired_fds = []
+        self.unwritten = {}
+        self.unindexed = {}
+        self.indexes = collections.OrderedDict()
+        self.dirty_indexes = set()
+        self.dropped_keys = []
+        self.dirty = False
+        self.closed = False
+        self.lock = threading.Lock()
+        self.commit_condition = threading.Condition(self.lock)
+        os.makedirs(os.path.join(path, 'index'), exist_ok=True)
+
+        self.segments = sorted(int(name[:-4]) for name in os.listdir(path) if name.endswith('.log'))
+        for base in self.segments:
+            self.segment_fds[base] = os.open(self.__segment_path__(base), os.O_RDWR)
+        if len(self.segments) == 0:
+            self.__start_segment__(0)
+        self.end = self.segments[-1] + self.__recover__(self.segments[-1])
+        self.written_end = self.end
+        self.writer = threading.Thread(target=self.__commit_loop__, daemon=True)
+        self.writer.start()
+
+    def append(self, data: dict, keys: list) -> int:
+        """
+        Adds a message to the log and to the indexes of the given conversations / inboxes, the writer thread
+        writes it with the next commit
+        :param data: the message, anything the binary codec can encode, it must not be changed afterwards
+        :param keys: names of the indexes, see conversation_key and inbox_key
+        :return: offset of the message in the log
+        """
+        body = BinaryCodec.encode(data)
+        record = RECORD_HEADER.pack(len(body), zlib.crc32(body)) + body
+        with self.lock:
+            offset = self.end
+            self.end += len(record)
+            self.unwritten[offset] = (record, data)
+            for key in keys:
+                self.unindexed.setdefault(key, []).append(offset)
+            self.dirty = True
+            self.commit_condition.notify()
+        return offset
+
+    def add_to_index(self, key: str, offset: int):
+        with self.lock:
+            self.unindexed.setdefault(key, []).append(offset)
+            self.dirty = True
+            self.commit_condition.notify()
+
+    def drop_index(self, key: str):
+        """
+        Deletes an index that is not needed anymore, e.g. the inbox of a client that is not coming back
+        """
+        with self.lock:
+            self.dropped_keys.append(key)
+            self.dirty = True
+            self.commit_condition.notify()
+
+    def read(self, offset: int) -> dict | None:
+        """
+        :return: the message at offset, None if it is not in the log (anymore) or damaged
+        """
+        with self.lock:
+            pending = self.unwritten.get(offset)
+            if pending is not None:
+                return pending[1]
+            position = bisect.bisect_right(self.segments, offset) - 1
+            if position < 0 or offset >= self.written_end:
+                return None
+            base = self.segments[position]
+            # a deleted segment's descriptor stays open until the next retention check
+            fd = self.segment_fds[base]
+        header = os.pread(fd, RECORD_HEADER.size, offset - base)
+        if len(header) < RECORD_HEADER.size:
+            return None
+        length, crc = RECORD_HEADER.unpack(header)
+        body = os.pread(fd, length, offset - base + RECORD_HEADER.size)
+        if len(body) < length or zlib.crc32(body) != crc:
+            return None
+        return BinaryCodec.decode(body)
+
+    def history(self, key: str, before: int | None = None, limit: int = HISTORY_PAGE_SIZE) -> tuple:
+        """
+        One page of a conversation, read straight from the log
+        :param key: conversation index name
+        :param before: only messages with a lower offset, None for the latest ones
+        :param limit: max number of messages
+        :return: list of (offset, message) oldest first, True if there are older messages
+        """
+        with self.lock:
+            index = self.__get_index__(key)
+            # entries the writer has not moved to the index yet, they come after the ones in it
+            pending = self.unindexed.get(key, [])
+            stop = index.count if before is None else index.find(before)
+            pending_stop = len(pending) if before is None else bisect.bisect_left(pending, before)
+            pending_start = max(0, pending_stop - limit)
+            start = max(0, stop - (limit - (pending_stop - pending_start)))
+            offsets = index.read(start, stop) + pending[pending_start:pending_stop]
+        messages = [(offset, self.read(offset)) for offset in offsets]
+        return [(offset, message) for offset, message in messages if message is not None], \
+            start > 0 or pending_start > 0
+
+    def take_inbox(self, key: str) -> list:
+        """
+        Removes the undelivered messages from an inbox
+        :return: list of (offset, message) in the order they were sent
+        """
+        with self.lock:
+            index = self.__get_index__(key)
+            offsets = index.read(index.cursor, index.count) + self.unindexed.pop(key, [])
+            index.set_cursor(index.count)
+            self.dirty_indexes.add(key)
+            self.dirty = True
+            self.commit_condition.notify()
+        messages = [(offset, self.read(offset)) for offset in offsets]
+        return [(offset, message) for offset, message in messages if message is not None]
+
+    def close(self):
+        """
+        Commits what was appended and closes the files
+        """
+        with self.lock:
+            self.closed = True
+            self.commit_condition.notify()
+        self.writer.join()
+
+    @staticmethod
+    def conversation_key(client_id: int, other_id: int) -> str:
+        return f'direct:{min(client_id, other_id)}:{max(client_id, other_id)}'
+
+    @staticmethod
+    def room_key(room: str) -> str:
+        return f'room:{room}'
+
+    @staticmethod
+    def inbox_key(client_id: int) -> str:
+        return f'inbox:{client_id}'
+
+    def __segment_path__(self, base: int) -> str:
+        return os.path.join(self.path, f'{base:020d}.log')
+
+    def __index_path__(self, key: str) -> str:
+        return os.path.join(self.path, 'index', hashlib.sha1(key.encode('utf-8')).hexdigest())
+
+    def __start_segment__(self, base: int):
+        fd = os.open(self.__segment_path__(base), os.O_RDWR | os.O_CREAT, 0o644)
+        with self.lock:
+            self.segment_fds[base] = fd
+            self.segments.append(base)
+
+    def __recover__(self, base: int) -> int:
+        """
+        Finds the end of the last complete record of a segment and cuts off a torn write after it
+        :return: the valid size of the segment
+        """
+        fd = self.segment_fds[base]
+        size = os.fstat(fd).st_size
+        position = 0
+        while position + RECORD_HEADER.size <= size:
+            length, crc = RECORD_HEADER.unpack(os.pread(fd, RECORD_HEADER.size, position))
+            body = os.pread(fd, length, position + RECORD_HEADER.size)
+            if len(body) < length or zlib.crc32(body) != crc:
+                break
+            position += RECORD_HEADER.size + length
+        if position < size:
+            os.ftruncate(fd, position)
+        return position
+
+    def __get_index__(self, key: str) -> OffsetIndex:
+        """
+        Opens the index if needed, lock must be held. Only the writer thread closes indexes, see __trim_indexes__
+        """
+        index = self.indexes.get(key)
+        if index is not None:
+            self.indexes.move_to_end(key)
+            return index
+        index = OffsetIndex(self.__index_path__(key))
+        self.indexes[key] = index
+        return index
+
+    def __commit_loop__(self):
+        next_retention_check = time.monotonic()
+        while True:
+            with self.lock:
+                while not self.dirty and not self.closed and time.monotonic() < next_retention_check:
+                    self.commit_condition.wait(next_retention_check - time.monotonic())
+                closed = self.closed
+            if closed:
+                self.__commit__()
+                self.__close_files__()
+                return
+            if time.monotonic() >= next_retention_check:
+                next_retention_check = time.monotonic() + RETENTION_CHECK_INTERVAL
+                self.__apply_retention__()
+                continue
+            # let more appends join this commit
+            time.sleep(self.commit_interval)
+            self.__commit__()
+
+    def __commit__(self):
+        """
+        Writes the appended records and moves the pending entries into the indexes, then syncs both. Runs on the
+        writer thread, which is the only one that writes the files
+        """
+        with self.lock:
+            self.dirty = False
+            records = list(self.unwritten.items())
+            dropped_keys, self.dropped_keys = self.dropped_keys, []
+            for key in dropped_keys:
+                self.unindexed.pop(key, None)
+            keys = [key for key in self.unindexed if key not in self.indexes]
+        synced_fds = self.__write_records__(records)
+        opened = {key: OffsetIndex(self.__index_path__(key)) for key in keys}
+
+        with self.lock:
+            for offset, _ in records:
+                del self.unwritten[offset]
+            if len(records) > 0:
+                self.written_end = records[-1][0] + len(records[-1][1][0])
+            duplicates = []
+            for key, index in opened.items():
+                if key in self.indexes:
+                    # a reader opened it in the meantime
+                    duplicates.append(index)
+                else:
+                    self.indexes[key] = index
+            for key in list(self.unindexed):
+                index = self.indexes.get(key)
+                if index is None:
+                    continue
+                for offset in self.unindexed.pop(key):
+                    index.append(offset)
+                self.dirty_indexes.add(key)
+            closing = duplicates + [self.indexes.pop(key) for key in dropped_keys if key in self.indexes]
+            closing += self.__trim_indexes__()
+            dirty_indexes = [self.indexes[key] for key in self.dirty_indexes if key in self.indexes]
+            self.dirty_indexes = set()
+
+        # the records first, so that a synced index entry never points past the end of the log
+        for fd in synced_fds:
+            os.fsync(fd)
+        for index in dirty_indexes:
+            index.flush()
+        for index in closing:
+            index.close()
+        for key in dropped_keys:
+            try:
+                os.unlink(self.__index_path__(key))
+            except FileNotFoundError:
+                pass
+
+    def __write_records__(self, records: list) -> list:
+        """
+        Writes records in offset order with one write per segment, starting new segments as needed
+        :return: the descriptors of the segments that were written
+        """
+        written = []
+        start = 0
+        while start < len(records):
+            if records[start][0] - self.segments[-1] >= self.segment_size:
+                self.__start_segment__(records[start][0])
+            base = self.segments[-1]
+            stop = start + 1
+            while stop < len(records) and records[stop][0] - base < self.segment_size:
+                stop += 1
+            fd = self.segment_fds[base]
+            os.pwrite(fd, b''.join(record for _, (record, _) in records[start:stop]), records[start][0] - base)
+            if fd not in written:
+                written.append(fd)
+            start = stop
+        return written
+
+    def __trim_indexes__(self) -> list:
+        """
+        Least recently used indexes are taken out so that only OPEN_INDEXES files are mapped at a time, lock must
+        be held
+        :return: the indexes to flush and close
+        """
+        closing = []
+        while len(self.indexes) > OPEN_INDEXES:
+            key, index = self.indexes.popitem(last=False)
+            self.dirty_indexes.discard(key)
+            closing.append(index)
+        return closing
+
+    def __apply_retention__(self):
+        """
+        Deletes the oldest segments while they were last written before the retention, the current segment is kept.
+        The descriptors of deleted segments are closed at the next check, when no read can still be using them.
+        Index files that are not open and only point into deleted segments are deleted as well
+        """
+        for fd in self.retired_fds:
+            os.close(fd)
+        self.retired_fds = []
+        if self.retention is None:
+            return
+        deadline = time.time() - self.retention
+        expired = []
+        for base in self.segments[:-1]:
+            if os.fstat(self.segment_fds[base]).st_mtime >= deadline:
+                break
+            expired.append(base)
+        with self.lock:
+            del self.segments[:len(expired)]
+            self.retired_fds = [self.segment_fds.pop(base) for base in expired]
+            first_offset = self.segments[0]
+        for base in expired:
+            os.unlink(self.__segment_path__(base))
+
+        index_dir = os.path.join(self.path, 'index')
+        unused = []
+        for name in os.listdir(index_dir):
+            path = os.path.join(index_dir, name)
+            try:
+                if os.stat(path).st_mtime >= deadline:
+                    continue
+                with open(path, 'rb') as file:
+                    count, _ = INDEX_HEADER.unpack(file.read(INDEX_HEADER.size))
+                    file.seek(INDEX_HEADER.size + (count - 1) * INDEX_ENTRY.size)
+                    last = INDEX_ENTRY.unpack(file.read(INDEX_ENTRY.size))[0] if count > 0 else -1
+            except (OSError, struct.error):
+                continue
+            if last < first_offset:
+                unused.append(path)
+        with self.lock:
+            # only this thread appends, so an index that is not open has not changed since it was checked
+            open_paths = {index.path for index in self.indexes.values()}
+            for path in unused:
+                if path not in open_paths:
+                    os.unlink(path)
+
+    def __close_files__(self):
+        with self.lock:
+            indexes = list(self.indexes.values())
+            self.indexes.clear()
+            fds = list(self.segment_fds.values()) + self.retired_fds
+        for index in indexes:
+            index.close()
+        os.fsync(self.segment_fds[self.segments[-1]])
+        for fd in fds:
+            os.close(fd)
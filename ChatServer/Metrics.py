@@ -0,0 +1,134 @@
+import bisect
+import math
+
+LATENCY_BUCKETS = (0.00005, 0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0,
+                   2.5, 5.0, 10.0)
+FANOUT_BUCKETS = (1, 2, 5, 10, 25, 50, 100, 250, 500, 1000, 2500, 5000, 10000, 25000, 50000)
+SIZE_BUCKETS = (64, 256, 1024, 4096, 16384, 65536, 262144, 1048576, 4194304, 16777216)
+
+
+class Histogram:
+    """
+    Counts of observed values per bucket, rendered cumulatively like Prometheus expects
+    """
+    buckets: tuple = None
+    counts: list = None
+    total: float = None
+    count: int = None
+
+    def __init__(self, buckets: tuple):
+        """
+        :param buckets: ascending upper bounds, a +Inf bucket is added
+        """
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)
+        self.total = 0.0
+        self.count = 0
+
+    def observe(self, value: float):
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.total += value
+        self.count += 1
+
+    def render(self, name: str, labels: tuple) -> list:
+        lines = []
+        cumulative = 0
+        for bound, count in zip(self.buckets + (math.inf,), self.counts):
+            cumulative += count
+            le = '+Inf' if bound == math.inf else repr(bound)
+            lines.append(f'{name}_bucket{format_labels(labels + (("le", le),))} {cumulative}')
+        lines.append(f'{name}_sum{format_labels(labels)} {self.total!r}')
+        lines.append(f'{name}_count{format_labels(labels)} {self.count}')
+        return lines
+
+
+class Metrics:
+    """
+    Counters, histograms and gauges of a server, rendered in the Prometheus text format.
+
+    Recording is a dict lookup and an addition, there is no lock: the async engines record on a single thread and
+    in the threaded engine a concurrent update may rarely be lost, which does not matter for monitoring.
+    Gauges are functions that are called when the metrics are rendered
+    """
+    descriptions: dict = None
+    counters: dict = None
+    histograms: dict = None
+    gauges: dict = None
+
+    def __init__(self):
+        self.descriptions = {}
+        self.counters = {}
+        self.histograms = {}
+        self.gauges = {}
+
+    def describe(self, name: str, kind: str, description: str, buckets: tuple | None = None):
+        """
+        Declares a metric, every metric must be declared before it is recorded
+        :param kind: counter, histogram or gauge
+        :param buckets: upper bounds of a histogram's buckets
+        """
+        self.descriptions[name] = (kind, description, buckets)
+
+    def increment(self, name: str, value: float = 1, labels: tuple = ()):
+        """
+        :param labels: tuple of (label, value) pairs
+        """
+        key = (name, labels)
+        self.counters[key] = self.counters.get(key, 0) + value
+
+    def observe(self, name: str, value: float, labels: tuple = ()):
+        key = (name, labels)
+        histogram = self.histograms.get(key)
+        if histogram is None:
+            histogram = self.histograms[key] = Histogram(self.descriptions[name][2])
+        histogram.observe(value)
+
+    def set_gauge(self, name: str, function):
+        """
+        :param function: called without arguments when rendering, returns the current value
+        """
+        self.gauges[name] = function
+
+    def render(self) -> str:
+        samples = {}
+        for (name, labels), value in list(self.counters.items()):
+            samples.setdefault(name, []).append(f'{name}{format_labels(labels)} {value}')
+        for (name, labels), histogram in list(self.histograms.items()):
+            samples.setdefault(name, []).extend(histogram.render(name, labels))
+        for name, function in list(self.gauges.items()):
+            samples.setdefault(name, []).append(f'{name} {function()}')
+
+        lines = []
+        for name, (kind, description, _) in self.descriptions.items():
+            lines.append(f'# HELP {name} {description}')
+            lines.append(f'# TYPE {name} {kind}')
+            lines.extend(samples.get(name, []))
+        return '\n'.join(lines) + '\n'
+
+
+def format_labels(labels: tuple) -> str:
+    if len(labels) == 0:
+        return ''
+    return '{' + ','.join(f'{label}="{value}"' for label, value in labels) + '}'
+
+
+def frame_type(data) -> str:
+    """
+    :return: short name of the kind of a frame of the chat protocol, used as a label
+    """
+    if not isinstance(data, dict):
+        return 'invalid'
+    if 'text' in data:
+        return 'room_message' if 'room' in data else 'message'
+    if 'info' in data:
+        return 'presence' if 'id' in data else 'failure'
+    if 'id' in data:
+        return 'id'
+    for key in ('name', 'hello', 'roster', 'clients', 'history', 'bye', 'ack', 'acks', 'ping', 'pong'):
+        if key in data:
+            return key
+    if 'join' in data or 'leave' in data:
+        return 'membership'
+    if 'room' in data:
+        return 'room_event'
+    return 'other'
@@ -0,0 +1,102 @@
+import collections
+import threading
+from typing import Callable
+
+QUEUE_HIGH_WATER = 512 * 1024
+QUEUE_HARD_LIMIT = 8 * 1024 * 1024
+
+
+class OutboundQueue:
+    """
+    Bounded queue of frames waiting to be written to a single client by that client's own writer.
+
+    Below high_water every frame is queued. Past high_water low priority frames are coalesced with a queued frame
+    that has the same coalesce key or dropped if they have no key. Past hard_limit put fails and the client
+    should be disconnected
+    """
+    entries: collections.deque = None
+    keyed_entries: dict = None
+    queued_bytes: int = None
+    dropped_frames: int = None
+    closed: bool = None
+
+    high_water: int = None
+    hard_limit: int = None
+    on_ready: Callable = None
+    lock: threading.Lock = None
+
+    def __init__(self, high_water: int = QUEUE_HIGH_WATER, hard_limit: int = QUEUE_HARD_LIMIT,
+                 on_ready: Callable = None):
+        """
+        :param high_water: queued bytes after which low priority frames are coalesced or dropped
+        :param hard_limit: queued bytes after which put fails
+        :param on_ready: called without arguments whenever there is something new for the writer
+        """
+        self.entries = collections.deque()
+        self.keyed_entries = {}
+        self.queued_bytes = 0
+        self.dropped_frames = 0
+        self.closed = False
+        self.high_water = high_water
+        self.hard_limit = hard_limit
+        self.on_ready = on_ready
+        self.lock = threading.Lock()
+
+    def put(self, frame: bytes, low_priority: bool = False, coalesce_key=None) -> bool:
+        """
+        Queues a frame
+        :param frame: bytes ready to be written to the socket
+        :param low_priority: frame may be coalesced or dropped when client is slow
+        :param coalesce_key: a newer low priority frame with the same key replaces the queued one
+        :return: False if hard limit is exceeded, client should be disconnected
+        """
+        with self.lock:
+            if self.closed:
+                return True
+            if self.queued_bytes + len(frame) > self.hard_limit:
+                return False
+            if low_priority and self.queued_bytes >= self.high_water:
+                entry = self.keyed_entries.get(coalesce_key) if coalesce_key is not None else None
+                if entry is not None:
+                    self.queued_bytes += len(frame) - len(entry[0])
+                    entry[0] = frame
+                    self.dropped_frames += 1
+                    return True
+                if coalesce_key is None:
+                    self.dropped_frames += 1
+                    return True
+            entry = [frame, coalesce_key]
+            self.entries.append(entry)
+            if coalesce_key is not None:
+                self.keyed_entries[coalesce_key] = entry
+            self.queued_bytes += len(frame)
+        if self.on_ready is not None:
+            self.on_ready()
+        return True
+
+    def pop_all(self) -> list:
+        """
+        Takes every queued frame, in order
+        :return: list of frames, empty if nothing is queued
+        """
+        with self.lock:
+            frames = [entry[0] for entry in self.entries]
+            self.entries.clear()
+            self.keyed_entries.clear()
+            self.queued_bytes = 0
+        return frames
+
+    def close(self):
+        """
+        Discards queued frames and wakes up the writer so that it can exit
+        """
+        with self.lock:
+            self.closed = True
+            self.entries.clear()
+            self.keyed_entries.clear()
+            self.queued_bytes = 0
+        if self.on_ready is not None:
+            self.on_ready()
+
+    def is_closed(self) -> bool:
+        return self.closed
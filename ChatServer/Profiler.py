@@ -0,0 +1,91 @@
+import collections
+import cProfile
+import io
+import pstats
+import sys
+import threading
+
+SAMPLE_INTERVAL = 0.005
+PROFILE_LINES = 40
+
+
+class Profiler:
+    """
+    Profiler that can be switched on and off while the server runs.
+
+    'sample' mode looks at the stacks of all threads every interval seconds from a thread of its own, it costs
+    little and sees every engine. The result is in the collapsed stack format ('outer;inner count' per line) that
+    flame graph tools read. 'cprofile' mode runs cProfile on one thread, run_on_thread must run a function on the
+    thread to profile (the event loop of the async engines), the result is the pstats listing by cumulative time
+    """
+    mode: str = None
+    interval: float = None
+    stacks: collections.Counter = None
+    sampler: threading.Thread = None
+    stopping: threading.Event = None
+    profile: cProfile.Profile = None
+    run_on_thread = None
+    lock: threading.Lock = None
+
+    def __init__(self, run_on_thread=None):
+        """
+        :param run_on_thread: function that runs a function without arguments on the thread cProfile should
+        profile and waits for it, None if cprofile mode is not supported
+        """
+        self.run_on_thread = run_on_thread
+        self.lock = threading.Lock()
+
+    def start(self, mode: str = 'sample', interval: float = SAMPLE_INTERVAL):
+        """
+        :param mode: 'sample' or 'cprofile'
+        :param interval: seconds between samples of 'sample' mode
+        """
+        with self.lock:
+            if self.mode is not None:
+                raise ValueError(f'the profiler is already running ({self.mode})')
+            if mode == 'sample':
+                if interval <= 0:
+                    raise ValueError('the interval must be positive')
+                self.interval = interval
+                self.stacks = collections.Counter()
+                self.stopping = threading.Event()
+                self.sampler = threading.Thread(target=self.__sample_loop__, daemon=True)
+                self.sampler.start()
+            elif mode == 'cprofile':
+                if self.run_on_thread is None:
+                    raise ValueError('cprofile mode is not supported by this engine, use sample mode')
+                self.profile = cProfile.Profile()
+                self.run_on_thread(self.profile.enable)
+            else:
+                raise ValueError(f'unknown profiler mode {mode}')
+            self.mode = mode
+
+    def stop(self) -> str:
+        """
+        :return: the result, see the class description
+        """
+        with self.lock:
+            if self.mode is None:
+                raise ValueError('the profiler is not running')
+            mode, self.mode = self.mode, None
+            if mode == 'sample':
+                self.stopping.set()
+                self.sampler.join()
+                return ''.join(f'{stack} {count}\n' for stack, count in self.stacks.most_common())
+            self.run_on_thread(self.profile.disable)
+            output = io.StringIO()
+            pstats.Stats(self.profile, stream=output).sort_stats('cumulative').print_stats(PROFILE_LINES)
+            return output.getvalue()
+
+    def __sample_loop__(self):
+        own = threading.get_ident()
+        while not self.stopping.wait(self.interval):
+            for thread_id, frame in sys._current_frames().items():
+                if thread_id == own:
+                    continue
+                stack = []
+                while frame is not None:
+                    code = frame.f_code
+                    stack.append(f'{code.co_name} ({code.co_filename.rsplit("/", 1)[-1]}:{code.co_firstlineno})')
+                    frame = frame.f_back
+                self.stacks[';'.join(reversed(stack))] += 1
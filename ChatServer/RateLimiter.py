@@ -0,0 +1,76 @@
+import time
+
+# kind of traffic: (tokens per second, burst)
+DEFAULT_LIMITS = {
+    'messages': (200.0, 400.0),
+    'bytes': (2.0 * 1024 * 1024, 4.0 * 1024 * 1024),
+    'names': (10 / 60, 5.0),
+}
+
+
+class RateLimiter:
+    """
+    Token buckets per connection and kind of traffic. The limits are shared by all connections, so changing one
+    applies to every connection at once. A connection only holds its buckets, [tokens, time of last update] per kind.
+    A rate of 0 disables the limit of a kind
+    """
+    limits: dict = None
+
+    def __init__(self, limits: dict | None = None):
+        """
+        :param limits: kind to (tokens per second, burst), DEFAULT_LIMITS for the kinds not given
+        """
+        self.limits = dict(DEFAULT_LIMITS)
+        if limits is not None:
+            for kind, (rate, burst) in limits.items():
+                self.set_limit(kind, rate, burst)
+
+    def set_limit(self, kind: str, rate: float, burst: float | None = None):
+        """
+        :param burst: tokens a bucket holds at most, the current burst of the kind if not given
+        """
+        if kind not in self.limits:
+            raise ValueError(f'unknown limit {kind}, known are {", ".join(self.limits)}')
+        if burst is None:
+            burst = self.limits[kind][1]
+        if rate < 0 or burst < 1:
+            raise ValueError('the rate must not be negative and the burst must be at least 1')
+        self.limits[kind] = (rate, burst)
+
+    def create_buckets(self) -> dict:
+        now = time.monotonic()
+        return {kind: [burst, now] for kind, (_, burst) in self.limits.items()}
+
+    def __refill__(self, bucket: list, rate: float, burst: float) -> float:
+        now = time.monotonic()
+        bucket[0] = min(burst, bucket[0] + (now - bucket[1]) * rate)
+        bucket[1] = now
+        return bucket[0]
+
+    def take(self, buckets: dict, kind: str, amount: float = 1) -> float:
+        """
+        Takes tokens for traffic that already happened, the bucket may go into debt
+        :return: seconds until the bucket is out of debt, 0 if it had enough tokens
+        """
+        rate, burst = self.limits[kind]
+        if rate <= 0:
+            return 0.0
+        bucket = buckets[kind]
+        tokens = self.__refill__(bucket, rate, burst) - amount
+        bucket[0] = tokens
+        return 0.0 if tokens >= 0 else -tokens / rate
+
+    def try_take(self, buckets: dict, kind: str) -> float:
+        """
+        Takes one token if there is one
+        :return: 0 if the token was taken, else seconds until there is one
+        """
+        rate, burst = self.limits[kind]
+        if rate <= 0:
+            return 0.0
+        bucket = buckets[kind]
+        tokens = self.__refill__(bucket, rate, burst)
+        if tokens >= 1:
+            bucket[0] = tokens - 1
+            return 0.0
+        return (1 - tokens) / rate
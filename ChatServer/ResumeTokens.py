@@ -0,0 +1,95 @@
+import hashlib
+import hmac
+import os
+import secrets
+import time
+
+KEY_SIZE = 32
+TOKEN_REFRESH = 60 * 60.0
+KEY_FILE_NAME = 'resume.key'
+
+
+def load_key(path: str | None) -> bytes:
+    """
+    Reads the secret key of the tokens, a missing key file is created with a new random key. Processes that start
+    at the same time with the same file all end up with the key of the first one
+    :param path: path of the key file, None for a key that is lost with the process
+    """
+    if path is None:
+        return secrets.token_bytes(KEY_SIZE)
+    try:
+        with open(path, 'rb') as key_file:
+            key = key_file.read()
+        if len(key) == KEY_SIZE:
+            return key
+    except FileNotFoundError:
+        pass
+    # written under another name and linked, so that the key file never exists half written
+    temporary = f'{path}.{os.getpid()}.tmp'
+    descriptor = os.open(temporary, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600)
+    try:
+        os.write(descriptor, secrets.token_bytes(KEY_SIZE))
+        os.fsync(descriptor)
+    finally:
+        os.close(descriptor)
+    try:
+        os.link(temporary, path)
+    except FileExistsError:
+        pass
+    finally:
+        os.unlink(temporary)
+    with open(path, 'rb') as key_file:
+        return key_file.read()
+
+
+class ResumeTokens:
+    """
+    Resume tokens that are signed instead of stored: '<boot>.<id>.<expires>.<mac>' where mac is an HMAC-SHA256 over
+    the rest with a key kept on disk. A server that restarted with the same key still accepts the tokens it issued
+    before, so a reconnecting client gets its id back.
+
+    boot changes whenever the server starts. While it runs the server knows every token it issued, the signature
+    only matters for tokens of an earlier boot. A token stays valid for lifetime seconds, connected clients get a new
+    one every TOKEN_REFRESH seconds, so a token is always valid for at least lifetime - TOKEN_REFRESH
+    """
+    key: bytes = None
+    boot: str = None
+    lifetime: float = None
+
+    def __init__(self, key: bytes, lifetime: float):
+        """
+        :param key: secret key, see load_key
+        :param lifetime: seconds a token is valid after it was issued
+        """
+        self.key = key
+        self.boot = secrets.token_hex(8)
+        self.lifetime = lifetime
+
+    def __sign__(self, payload: str) -> str:
+        return hmac.new(self.key, payload.encode('utf-8'), hashlib.sha256).hexdigest()[:32]
+
+    def issue(self, client_id: int) -> tuple:
+        """
+        :return: the token and the time.time() at which the client should get a new one
+        """
+        now = time.time()
+        payload = f'{self.boot}.{client_id:x}.{int(now + self.lifetime)}'
+        return f'{payload}.{self.__sign__(payload)}', now + TOKEN_REFRESH
+
+    def verify(self, token) -> tuple | None:
+        """
+        :return: (client_id, True if the token was issued since this server started), None if the token is not
+        one of ours or has expired
+        """
+        parts = token.split('.') if isinstance(token, str) else []
+        if len(parts) != 4:
+            return None
+        try:
+            if not hmac.compare_digest(self.__sign__('.'.join(parts[:3])).encode('utf-8'), parts[3].encode('utf-8')):
+                return None
+            client_id, expires = int(parts[1], 16), int(parts[2])
+        except ValueError:
+            return None
+        if expires < time.time():
+            return None
+        return client_id, parts[0] == self.boot
@@ -0,0 +1,49 @@
+class RoomIndex:
+    """
+    Room membership indexed both ways: room -> members for the fan-out of room messages and
+    client -> rooms so that a disconnected client leaves its rooms without scanning all of them.
+    A room exists while it has members
+    """
+    members: dict = None
+    rooms_of_client: dict = None
+
+    def __init__(self):
+        self.members = {}
+        self.rooms_of_client = {}
+
+    def join(self, room: str, client_id: int) -> bool:
+        """
+        :return: False if the client already was a member
+        """
+        members = self.members.setdefault(room, set())
+        if client_id in members:
+            return False
+        members.add(client_id)
+        self.rooms_of_client.setdefault(client_id, set()).add(room)
+        return True
+
+    def leave(self, room: str, client_id: int) -> bool:
+        """
+        :return: False if the client was not a member
+        """
+        members = self.members.get(room)
+        if members is None or client_id not in members:
+            return False
+        members.discard(client_id)
+        if len(members) == 0:
+            del self.members[room]
+        rooms = self.rooms_of_client[client_id]
+        rooms.discard(room)
+        if len(rooms) == 0:
+            del self.rooms_of_client[client_id]
+        return True
+
+    def remove_client(self, client_id: int):
+        for room in list(self.rooms_of_client.get(client_id, ())):
+            self.leave(room, client_id)
+
+    def get_members(self, room: str) -> set:
+        return self.members.get(room, set())
+
+    def is_member(self, room: str, client_id: int) -> bool:
+        return client_id in self.members.get(room, ())
@@ -0,0 +1,85 @@
+import collections
+import itertools
+import uuid
+
+ROSTER_JOURNAL_SIZE = 10000
+
+
+class RosterJournal:
+    """
+    Numbers every roster change (add, update, delete) and remembers the latest ones, so that a client that knows
+    the roster up to some version can be sent only what changed since then.
+
+    The epoch changes whenever the server starts, versions of another epoch are meaningless
+    """
+    epoch: int = None
+    version: int = None
+    changes: collections.deque = None
+
+    def __init__(self, size: int = ROSTER_JOURNAL_SIZE):
+        """
+        :param size: number of changes remembered, older versions get a full snapshot
+        """
+        self.epoch = uuid.uuid4().int >> 64
+        self.version = 0
+        self.changes = collections.deque(maxlen=size)
+
+    def reset(self, epoch: int, version: int):
+        """
+        Continues the numbering of another journal, e.g. the one of the cluster hub. Older changes are forgotten
+        """
+        self.epoch = epoch
+        self.version = version
+        self.changes.clear()
+
+    def record(self, client_id: int, name: str | None, info: str) -> int:
+        """
+        :return: the version of the roster after this change
+        """
+        self.version += 1
+        self.changes.append((self.version, client_id, name, info))
+        return self.version
+
+    def changes_since(self, epoch, version, roster_size: int) -> list | None:
+        """
+        Merges all changes after version into one change per client. A client that was added and deleted since
+        then does not appear at all
+        :param epoch: epoch the client's version belongs to
+        :param version: last version the client knows
+        :param roster_size: current number of clients, no point in sending more changes than that
+        :return: list of {'id', 'name', 'info'} or None if the client needs a full snapshot
+        """
+        if epoch != self.epoch or not isinstance(version, int) or not 0 <= version <= self.version:
+            return None
+        if version == self.version:
+            return []
+        first_version = self.changes[0][0] if len(self.changes) > 0 else self.version + 1
+        if first_version > version + 1:
+            return None
+
+        merged = {}
+        for _, client_id, name, info in itertools.islice(self.changes, version + 1 - first_version, None):
+            self.merge_change(merged, client_id, name, info)
+        if len(merged) > roster_size:
+            return None
+        return list(merged.values())
+
+    @staticmethod
+    def merge_change(merged: dict, client_id: int, name: str | None, info: str):
+        """
+        Adds a change to changes merged into one per client: an add followed by a delete cancels out, renames keep
+        the latest name and a delete followed by an add becomes an update
+        :param merged: client id -> {'id', 'name', 'info'}, updated in place
+        """
+        change = merged.get(client_id)
+        if change is None:
+            merged[client_id] = {'id': client_id, 'name': name, 'info': info}
+        elif info == 'delete':
+            if change['info'] == 'add':
+                merged.pop(client_id)
+            else:
+                change.update(name=name, info=info)
+        else:
+            change['name'] = name
+            if change['info'] == 'delete':
+                change['info'] = 'update'
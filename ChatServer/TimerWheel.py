@@ -0,0 +1,100 @@
+import math
+import threading
+import time
+
+WHEEL_BITS = 6
+WHEEL_SIZE = 1 << WHEEL_BITS
+WHEEL_MASK = WHEEL_SIZE - 1
+WHEEL_LEVELS = 4
+
+
+class TimerWheel:
+    """
+    Hierarchical timer wheel for many coarse timers, e.g. one per connection. Time passes in ticks of tick seconds.
+    The first level has a slot per tick for the next WHEEL_SIZE ticks, every further level a slot per WHEEL_SIZE
+    slots of the level below. When a level wraps around, the timers of the next slot of the level above move down,
+    so a timer moves at most WHEEL_LEVELS - 1 times. Scheduling and cancelling are O(1) and so is a tick, apart from
+    the timers that expire or move in it, however many timers are waiting.
+
+    A timer never expires before its delay, and at most one tick after it. Timers further out than the wheel reaches,
+    WHEEL_SIZE ** WHEEL_LEVELS ticks, wait in the last slot of the top level and are put back when it comes round.
+    Expired timers are returned to the caller, which runs them outside the lock
+    """
+    tick: float = None
+    start: float = None
+    ticks: int = None
+    wheels: list = None
+    lock: threading.Lock = None
+
+    def __init__(self, tick: float):
+        """
+        :param tick: seconds per tick
+        """
+        self.tick = tick
+        self.start = time.monotonic()
+        self.ticks = 0
+        self.wheels = [[[] for _ in range(WHEEL_SIZE)] for _ in range(WHEEL_LEVELS)]
+        self.lock = threading.Lock()
+
+    def schedule(self, delay: float, callback, *args) -> list:
+        """
+        :param delay: seconds until callback(*args) is due
+        :return: the timer, to cancel it
+        """
+        expires = math.ceil((time.monotonic() + delay - self.start) / self.tick)
+        timer = [expires, callback, args]
+        with self.lock:
+            timer[0] = max(timer[0], self.ticks + 1)
+            self.__insert__(timer)
+        return timer
+
+    @staticmethod
+    def cancel(timer: list | None):
+        """
+        The timer stays in its slot until it is due but is not returned
+        """
+        if timer is not None:
+            timer[1] = None
+
+    def __insert__(self, timer: list):
+        expires = timer[0]
+        delta = expires - self.ticks
+        level = 0
+        while level < WHEEL_LEVELS - 1 and delta >= WHEEL_SIZE << (WHEEL_BITS * level):
+            level += 1
+        if delta >= 1 << (WHEEL_BITS * WHEEL_LEVELS):
+            expires = self.ticks + (1 << (WHEEL_BITS * WHEEL_LEVELS)) - 1
+        self.wheels[level][(expires >> (WHEEL_BITS * level)) & WHEEL_MASK].append(timer)
+
+    def __cascade__(self):
+        """
+        Moves the timers of the levels that wrap around at the current tick down, the highest level first
+        """
+        level = 1
+        while level < WHEEL_LEVELS and self.ticks & ((1 << (WHEEL_BITS * level)) - 1) == 0:
+            level += 1
+        for wrapped in range(level - 1, 0, -1):
+            index = (self.ticks >> (WHEEL_BITS * wrapped)) & WHEEL_MASK
+            timers, self.wheels[wrapped][index] = self.wheels[wrapped][index], []
+            for timer in timers:
+                if timer[1] is not None:
+                    self.__insert__(timer)
+
+    def expire(self) -> list:
+        """
+        Advances the wheel to the current time
+        :return: (callback, args) of every timer that became due, the caller runs them
+        """
+        now = int((time.monotonic() - self.start) / self.tick)
+        due = []
+        with self.lock:
+            while self.ticks < now:
+                self.ticks += 1
+                if self.ticks & WHEEL_MASK == 0:
+                    self.__cascade__()
+                index = self.ticks & WHEEL_MASK
+                timers = self.wheels[0][index]
+                if len(timers) > 0:
+                    self.wheels[0][index] = []
+                    due.extend((timer[1], timer[2]) for timer in timers if timer[1] is not None)
+        return due
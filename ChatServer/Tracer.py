@@ -0,0 +1,142 @@
+import collections
+import json
+import random
+import threading
+import time
+
+TRACE_BUFFER_SIZE = 4096
+MAX_PENDING_WRITES = 4096
+STAGES = ('decode', 'route', 'encode', 'enqueue', 'write', 'last_write')
+
+
+class Tracer:
+    """
+    Follows sampled messages through the server. A message is traced if it carries a 'trace' id or, at sample_rate,
+    gets one; the id is passed on to the recipients. A trace holds the monotonic time of every stage: receive and
+    decode of the read the message came in, route once its recipients are known, encode, enqueue and socket write of
+    its first recipient and the write to its last recipient.
+
+    Traces go to a ring buffer of the latest buffer_size ones. Routing runs on one thread from receive to enqueue,
+    the trace being routed is kept per thread. Writes happen later on the writers, they are matched by the identity
+    of the encoded frame
+    """
+    sample_rate: float = None
+    traces: collections.deque = None
+    pending_writes: dict = None
+    active: int = None
+    active_lock: threading.Lock = None
+    local: threading.local = None
+
+    def __init__(self, sample_rate: float = 0.0, buffer_size: int = TRACE_BUFFER_SIZE):
+        """
+        :param sample_rate: share of messages traced without being asked to, 0 to 1
+        :param buffer_size: number of traces kept
+        """
+        self.sample_rate = sample_rate
+        self.traces = collections.deque(maxlen=buffer_size)
+        self.pending_writes = {}
+        self.active = 0
+        self.active_lock = threading.Lock()
+        self.local = threading.local()
+
+    def set_sample_rate(self, sample_rate: float):
+        if not 0 <= sample_rate <= 1:
+            raise ValueError('the sample rate must be between 0 and 1')
+        self.sample_rate = sample_rate
+
+    def mark_read(self, decode_time: float):
+        """
+        Remembers when the frames being handled on this thread were received and decoded
+        :param decode_time: seconds spent decoding them
+        """
+        decoded = time.perf_counter()
+        self.local.read = (decoded - decode_time, decoded)
+
+    def begin(self, client_id: int, data: dict, kind: str) -> dict | None:
+        """
+        Starts tracing a message if it asks for it or is sampled, it becomes the current trace of this thread
+        :param kind: type of the message
+        :return: the trace, None if the message is not traced
+        """
+        trace_id = data.get('trace')
+        if trace_id is None:
+            if self.sample_rate <= 0 or random.random() >= self.sample_rate:
+                return None
+            trace_id = random.getrandbits(63)
+        received, decoded = getattr(self.local, 'read', (time.perf_counter(), time.perf_counter()))
+        trace = {'trace': trace_id, 'time': time.time(), 'client': client_id, 'type': kind, 'receive': received,
+                 'decode': decoded, 'recipients': 0, 'writes': 0}
+        self.traces.append(trace)
+        self.local.trace = trace
+        with self.active_lock:
+            self.active += 1
+        return trace
+
+    def end(self, trace: dict | None):
+        """
+        Ends the routing of a message, its writes are still recorded
+        :param trace: returned by begin
+        """
+        if trace is None:
+            return
+        self.local.trace = None
+        with self.active_lock:
+            self.active -= 1
+
+    def get_current(self) -> dict | None:
+        """
+        :return: the trace being routed on this thread
+        """
+        return getattr(self.local, 'trace', None) if self.active > 0 else None
+
+    def mark(self, trace: dict, stage: str):
+        """
+        Records the first time a stage is reached
+        """
+        if stage not in trace:
+            trace[stage] = time.perf_counter()
+
+    def enqueued(self, trace: dict, frame: bytes):
+        """
+        Records that the encoded message was queued for one more recipient
+        """
+        self.mark(trace, 'enqueue')
+        trace['recipients'] += 1
+        self.pending_writes[id(frame)] = (frame, trace)
+        if len(self.pending_writes) > MAX_PENDING_WRITES:
+            # frames of recipients that left never get written
+            del self.pending_writes[next(iter(self.pending_writes))]
+
+    def written(self, frames: list):
+        """
+        Called by writers after a successful write while pending_writes is not empty
+        """
+        now = time.perf_counter()
+        for frame in frames:
+            entry = self.pending_writes.get(id(frame))
+            if entry is None or entry[0] is not frame:
+                continue
+            trace = entry[1]
+            trace.setdefault('write', now)
+            trace['last_write'] = now
+            trace['writes'] += 1
+            if trace['writes'] >= trace['recipients']:
+                self.pending_writes.pop(id(frame), None)
+
+    def dump(self) -> str:
+        """
+        :return: the buffered traces as json lines, oldest first. Stages are microseconds after receive
+        """
+        lines = []
+        for trace in list(self.traces):
+            stages = {stage: round((trace[stage] - trace['receive']) * 1e6, 1) for stage in STAGES if stage in trace}
+            lines.append(json.dumps({
+                'trace': trace['trace'],
+                'time': trace['time'],
+                'client': trace['client'],
+                'type': trace['type'],
+                'recipients': trace['recipients'],
+                'writes': trace['writes'],
+                'us': stages
+            }))
+        return ''.join(line + '\n' for line in lines)
@@ -1,3 +1,110 @@
+import argparse
+
+import AdmissionControl
+import AsyncChatServer
 import ChatServer
+import ClusterChatServer
+import Compression
+import OutboundQueue
+import RateLimiter
+import RosterJournal
+from EventLog import configure_logging
+
+ENGINES = {
+    'threaded': ChatServer.ChatServer,
+    'async': AsyncChatServer.AsyncChatServer,
+}
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Chat server')
+    parser.add_argument('--ip', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=4550)
+    parser.add_argument('--engine', choices=ENGINES.keys(), default='threaded',
+                        help='threaded: one OS thread per client, async: single asyncio event loop')
+    parser.add_argument('--cert', default=ChatServer.CERT_FILE)
+    parser.add_argument('--key', default=ChatServer.KEY_FILE)
+    parser.add_argument('--password', default=ChatServer.KEY_PASSWORD)
+    parser.add_argument('--queue-high-water', type=int, default=OutboundQueue.QUEUE_HIGH_WATER,
+                        help='queued bytes per client after which low priority frames are coalesced or dropped')
+    parser.add_argument('--queue-hard-limit', type=int, default=OutboundQueue.QUEUE_HARD_LIMIT,
+                        help='queued bytes per client after which the client is disconnected')
+    parser.add_argument('--flush-window', type=float, default=ChatServer.FLUSH_WINDOW,
+                        help='seconds a writer waits for more frames to write them together, 0 disables waiting')
+    parser.add_argument('--compression-threshold', type=int, default=Compression.COMPRESSION_THRESHOLD,
+                        help='bytes from which frames are compressed for clients that negotiated compression')
+    parser.add_argument('--roster-journal-size', type=int, default=RosterJournal.ROSTER_JOURNAL_SIZE,
+                        help='number of roster changes remembered for incremental roster sync')
+    parser.add_argument('--message-log', default=None, metavar='DIR',
+                        help='directory of the message log for history and offline delivery, disabled if not given')
+    parser.add_argument('--offline-retention', type=float, default=ChatServer.OFFLINE_RETENTION,
+                        help='seconds after a disconnect during which messages for the client are kept')
+    parser.add_argument('--resume-grace', type=float, default=ChatServer.RESUME_GRACE,
+                        help='seconds a disconnected client may resume its session, 0 disables resuming, '
+                             'always disabled with --workers')
+    parser.add_argument('--resume-key', default=None, metavar='FILE',
+                        help='key file that signs resume tokens so that they survive a restart, created if missing, '
+                             'defaults to resume.key in the message log directory')
+    parser.add_argument('--handshake-timeout', type=float, default=ChatServer.HANDSHAKE_TIMEOUT,
+                        help='seconds a client has to complete the TLS handshake')
+    parser.add_argument('--hello-timeout', type=float, default=ChatServer.HELLO_TIMEOUT,
+                        help='seconds the server waits for the hello of a new client before serving it as a legacy '
+                             'client')
+    parser.add_argument('--admin-port', type=int, default=None,
+                        help='serve metrics, traces and profiler control on http://127.0.0.1:PORT, workers use the '
+                             'following ports')
+    parser.add_argument('--trace-sample-rate', type=float, default=0.0,
+                        help='share of messages traced through the server, 0 to 1, see /traces on the admin port')
+    parser.add_argument('--ack-flush-delay', type=float, default=ChatServer.ACK_FLUSH_DELAY,
+                        help='seconds delivery and read acks are collected before they are forwarded together')
+    parser.add_argument('--limit-messages', type=float, default=RateLimiter.DEFAULT_LIMITS['messages'][0],
+                        help='frames per second a connection may send before reading from it slows down, 0 for '
+                             'no limit')
+    parser.add_argument('--limit-bytes', type=float, default=RateLimiter.DEFAULT_LIMITS['bytes'][0],
+                        help='bytes per second a connection may send before reading from it slows down, 0 for no limit')
+    parser.add_argument('--limit-names', type=float, default=RateLimiter.DEFAULT_LIMITS['names'][0] * 60,
+                        help='name changes per minute a connection may announce, later ones wait, 0 for no limit')
+    parser.add_argument('--max-cpu', type=float, default=0.0,
+                        help='share of one core from which new connections are held back, 0 for no limit')
+    parser.add_argument('--max-queued-bytes', type=int, default=0,
+                        help='bytes in all outbound queues from which new connections are held back, 0 for no limit')
+    parser.add_argument('--admission-delay', type=float, default=AdmissionControl.ADMISSION_DELAY,
+                        help='seconds a new connection is held back while overloaded before it is refused')
+    parser.add_argument('--presence-window', type=float, default=ChatServer.PRESENCE_WINDOW_MAX,
+                        help='longest window in seconds in which roster changes are merged into one broadcast, '
+                             '0 broadcasts every change at once')
+    parser.add_argument('--ping-interval', type=float, default=ChatServer.PING_INTERVAL,
+                        help='seconds a client may be silent before it is pinged, 0 disables heartbeats')
+    parser.add_argument('--ping-timeout', type=float, default=ChatServer.PING_TIMEOUT,
+                        help='seconds a client that answers pings may stay silent after a ping before it is dropped')
+    parser.add_argument('--log-level', choices=['DEBUG', 'INFO', 'WARNING', 'ERROR'], default='INFO')
+    parser.add_argument('--workers', type=int, default=1,
+                        help='number of async worker processes sharing the port, more than 1 needs Linux and '
+                             'disables resuming sessions')
+    args = parser.parse_args()
+    if not 0 <= args.trace_sample_rate <= 1:
+        parser.error('--trace-sample-rate must be between 0 and 1')
+    if args.workers > 1 and args.engine != 'async':
+        parser.error('--workers needs --engine async')
+    if args.workers > 1 and args.message_log is not None:
+        parser.error('--message-log is not supported with --workers')
+    if args.workers > 1 and args.resume_key is not None:
+        parser.error('--resume-key is not supported with --workers')
 
-ChatServer.ChatServer().start_serving('127.0.0.1', 4550)
+    server_kwargs = dict(cert_file=args.cert, key_file=args.key, key_password=args.password,
+                         queue_high_water=args.queue_high_water, queue_hard_limit=args.queue_hard_limit,
+                         flush_window=args.flush_window, compression_threshold=args.compression_threshold,
+                         roster_journal_size=args.roster_journal_size, message_log_dir=args.message_log,
+                         offline_retention=args.offline_retention, resume_grace=args.resume_grace,
+                         handshake_timeout=args.handshake_timeout, admin_port=args.admin_port,
+                         trace_sample_rate=args.trace_sample_rate, ack_flush_delay=args.ack_flush_delay,
+                         rate_limits={'messages': (args.limit_messages, None), 'bytes': (args.limit_bytes, None),
+                                      'names': (args.limit_names / 60, None)},
+                         max_cpu=args.max_cpu, max_queued_bytes=args.max_queued_bytes,
+                         admission_delay=args.admission_delay, presence_window_max=args.presence_window,
+                         ping_interval=args.ping_interval, ping_timeout=args.ping_timeout,
+                         hello_timeout=args.hello_timeout, resume_key_file=args.resume_key)
+    configure_logging(args.log_level)
+    if args.workers > 1:
+        ClusterChatServer.run_cluster(args.ip, args.port, args.workers, args.log_level, **server_kwargs)
+    else:
+        ENGINES[args.engine](**server_kwargs).start_serving(args.ip, args.port)
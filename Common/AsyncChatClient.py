@@ -0,0 +1,467 @@
+import asyncio
+import collections
+import itertools
+import random
+import ssl
+
+import Compression
+import Utils
+
+RECONNECT_DELAY = 0.5
+RECONNECT_DELAY_MAX = 30.0
+CONNECT_TIMEOUT = 1.0
+SHUTDOWN_TIMEOUT = 1.0
+ACK_DELAY = 0.2
+PING_INTERVAL = 30.0
+PING_TIMEOUT = 30.0
+MAX_DATA_SIZE = 1024 * 1024
+RECENT_MSG_IDS = 256
+
+
+class TLSSessionContext(ssl.SSLContext):
+    """
+    Client context that resumes the TLS session of the previous connection. asyncio can not be given a session, so
+    the context hands its own to the SSL objects it creates. The session belongs to one client, so every client needs
+    a context of its own
+    """
+    session: ssl.SSLSession | None = None
+
+    def wrap_bio(self, incoming, outgoing, server_side=False, server_hostname=None, session=None):
+        return super().wrap_bio(incoming, outgoing, server_side, server_hostname,
+                                session if session is not None else self.session)
+
+
+class AsyncChatClient:
+    """
+    Chat client on asyncio that needs nothing but the standard library and Common, for bots and services. The Qt
+    ChatClient is an adapter over it. It stays connected until closed, reconnecting with backoff and resuming its
+    session, keeps the roster in clients (id to name), acknowledges received messages and answers pings.
+
+    What happens is reported as events (kind, data), see events:
+    'connection' {'connected', 'attempt'} before every connection attempt and once connected,
+    'roster' {'clients': [{'id', 'name'}, ...]} when the whole roster is replaced,
+    'presence' {'updates': [{'id', 'name', 'info'}, ...]} roster changes, already applied to clients,
+    'message' a message as the server sent it, repeats of a message after a reconnect are dropped,
+    'delivery' {'msg_id', 'state'} with state 'sent' once written and 'failed' if the server could not deliver it,
+    'receipt' {'by', 'delivered', 'read'} the recipient got, or read, every message to it up to that msg_id,
+    'data' anything else the server sends, e.g. room events and history.
+
+    Its methods must be called on the event loop it runs on
+    """
+    ssl_context: ssl.SSLContext = None
+    client_id: int = None
+    codec: str = None
+    compression: str = None
+    resume_token: str = None
+
+    clients: dict = None
+    roster_epoch: int = None
+    roster_version: int = None
+    roster_pages: list = None
+
+    running: bool = None
+    stopping: asyncio.Event = None
+    session_started: asyncio.Event = None
+    writer: asyncio.StreamWriter | None = None
+    write_task: asyncio.Task | None = None
+    run_task: asyncio.Task | None = None
+
+    outbound: collections.deque = None
+    outbound_ready: asyncio.Event = None
+    msg_ids: itertools.count = None
+
+    received_msg_ids: dict = None
+    recent_msg_ids: dict = None
+    read_msg_ids: dict = None
+    pending_acks: dict = None
+    ack_timer: asyncio.TimerHandle | None = None
+
+    subscribers: list = None
+
+    def __init__(self, ssl_context: ssl.SSLContext | None = None):
+        """
+        :param ssl_context: context for the connections, by default a TLSSessionContext of this client that does
+        not authenticate the server, like before. Only a TLSSessionContext resumes the TLS session of the previous
+        connection, other contexts are used as they are
+        """
+        self.clients = {}
+        self.running = True
+        self.stopping = asyncio.Event()
+        self.session_started = asyncio.Event()
+        self.outbound = collections.deque()
+        self.outbound_ready = asyncio.Event()
+        self.msg_ids = itertools.count(1)
+        self.received_msg_ids = {}
+        self.recent_msg_ids = {}
+        self.read_msg_ids = {}
+        self.pending_acks = {}
+        self.subscribers = []
+        if ssl_context is None:
+            ssl_context = TLSSessionContext(ssl.PROTOCOL_TLS_CLIENT)
+            ssl_context.check_hostname = False
+            ssl_context.verify_mode = ssl.CERT_NONE
+        self.ssl_context = ssl_context
+
+    def get_id(self) -> int | None:
+        return self.client_id
+
+    def events(self, kinds: tuple | None = None):
+        """
+        Every iterator gets the events of its kinds from the time it is created on, the iteration ends when the
+        client is closed
+        :param kinds: kinds of events to get, all if None
+        :return: async iterator of (kind, data)
+        """
+        queue = asyncio.Queue()
+        subscriber = (kinds, queue)
+        self.subscribers.append(subscriber)
+        return self.__iterate__(subscriber, True)
+
+    def messages(self):
+        """
+        :return: async iterator of the data of 'message' events
+        """
+        subscriber = (('message',), asyncio.Queue())
+        self.subscribers.append(subscriber)
+        return self.__iterate__(subscriber, False)
+
+    def presence(self):
+        """
+        :return: async iterator of the data of 'roster' and 'presence' events
+        """
+        subscriber = (('roster', 'presence'), asyncio.Queue())
+        self.subscribers.append(subscriber)
+        return self.__iterate__(subscriber, False)
+
+    async def __iterate__(self, subscriber: tuple, with_kind: bool):
+        try:
+            while True:
+                event = await subscriber[1].get()
+                if event is None:
+                    return
+                yield event if with_kind else event[1]
+        finally:
+            self.subscribers.remove(subscriber)
+
+    def __emit__(self, kind: str, data: dict | None):
+        """
+        :param kind: None ends the iterators
+        """
+        for kinds, queue in self.subscribers:
+            if kind is None:
+                queue.put_nowait(None)
+            elif kinds is None or kind in kinds:
+                queue.put_nowait((kind, data))
+
+    async def connect(self, ip: str, port: int):
+        """
+        Starts run as a task and returns once the first session has started
+        """
+        self.run_task = asyncio.create_task(self.run(ip, port))
+        started = asyncio.create_task(self.session_started.wait())
+        await asyncio.wait([self.run_task, started], return_when=asyncio.FIRST_COMPLETED)
+        started.cancel()
+
+    async def run(self, ip: str, port: int):
+        """
+        Stays connected until close is called, reconnecting with exponential backoff and full jitter
+        :param ip: ip to connect to
+        :param port: the port
+        """
+        attempts = 0
+        while self.running:
+            attempts += 1
+            self.__emit__('connection', {'connected': False, 'attempt': attempts})
+            connection = await self.__open__(ip, port)
+            if connection is not None:
+                self.__emit__('connection', {'connected': True, 'attempt': attempts})
+                if await self.__serve__(*connection):
+                    attempts = 0
+                # else the server refused the connection, probably overloaded, keep backing off
+            if self.running:
+                await self.__wait_before_reconnect__(attempts)
+        self.__emit__(None, None)
+
+    async def __open__(self, ip: str, port: int) -> tuple | None:
+        """
+        :return: reader and writer of a new connection that has sent its hello, None if it failed
+        """
+        try:
+            async with asyncio.timeout(CONNECT_TIMEOUT):
+                reader, writer = await asyncio.open_connection(ip, port, ssl=self.ssl_context)
+        except (Exception, ):
+            return None
+        writer.write(Utils.encode_frame({'hello': {
+            'codecs': Utils.CODECS,
+            'compression': Compression.COMPRESSIONS,
+            'roster': {'epoch': self.roster_epoch, 'version': self.roster_version},
+            'resume': self.resume_token,
+            # we answer pings, the server may drop the connection if we go silent
+            'heartbeat': True
+        }}))
+        return reader, writer
+
+    async def __serve__(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter) -> bool:
+        """
+        Handles a connection until it ends
+        :return: True if the server started a session
+        """
+        self.client_id = None
+        self.codec = Utils.JSON_CODEC
+        self.compression = None
+        frame_reader = Utils.FrameReader(MAX_DATA_SIZE)
+        messages = []
+        try:
+            while messages is not None and self.running:
+                for data in messages:
+                    if self.client_id is None:
+                        self.__start_session__(data, writer)
+                    else:
+                        self.handle_data(data)
+                messages = await self.__receive__(reader, frame_reader)
+        except (Exception, ):
+            pass
+        started = self.client_id is not None
+        self.session_started.clear()
+        self.writer = None
+        self.outbound_ready.set()
+        if self.write_task is not None:
+            await self.write_task
+            self.write_task = None
+        writer.close()
+        return started
+
+    def __start_session__(self, data: dict, writer: asyncio.StreamWriter):
+        # the same id as before if the server resumed our session
+        self.client_id = data['id']
+        self.resume_token = data.get('resume')
+        # with TLS 1.3 the session ticket arrives after the handshake, it is there by now. It saves most of the next
+        # handshake if the server still knows it
+        if isinstance(self.ssl_context, TLSSessionContext):
+            self.ssl_context.session = writer.get_extra_info('ssl_object').session
+        self.codec = data.get('codec', Utils.JSON_CODEC)
+        self.compression = Compression.negotiate([data.get('compression')])
+        self.writer = writer
+        self.write_task = asyncio.create_task(self.__write_loop__(writer))
+        self.session_started.set()
+
+    async def __receive__(self, reader: asyncio.StreamReader, frame_reader: Utils.FrameReader) -> list | None:
+        """
+        Reads once. Pings the server once nothing was received for PING_INTERVAL and gives the connection up if it
+        stays silent PING_TIMEOUT longer, the server is gone without closing it
+        :return: list of json data, possibly empty. None if the connection is gone
+        """
+        try:
+            try:
+                async with asyncio.timeout(PING_INTERVAL):
+                    received = await reader.read(Utils.RECEIVE_BUFFER_SIZE)
+            except TimeoutError:
+                self.__enqueue__({'ping': True})
+                async with asyncio.timeout(PING_TIMEOUT):
+                    received = await reader.read(Utils.RECEIVE_BUFFER_SIZE)
+        except (Exception, ):
+            return None
+        if not received:
+            return None
+        return frame_reader.feed(received)
+
+    async def __write_loop__(self, writer: asyncio.StreamWriter):
+        """
+        Sends everything queued with one write while the connection lasts. Data whose write fails goes back to the
+        front of the queue and waits for the next connection. After close it ends once the queue is empty
+        """
+        while self.writer is writer:
+            if len(self.outbound) == 0:
+                if not self.running:
+                    return
+                self.outbound_ready.clear()
+                await self.outbound_ready.wait()
+                continue
+            batch = list(self.outbound)
+            self.outbound.clear()
+            try:
+                writer.write(b''.join(Utils.encode_frame(data, self.codec, self.compression) for data in batch))
+                await writer.drain()
+            except (Exception, ):
+                self.outbound.extendleft(reversed(batch))
+                return
+            for data in batch:
+                if 'msg_id' in data:
+                    self.__emit__('delivery', {'msg_id': data['msg_id'], 'state': 'sent'})
+
+    async def __wait_before_reconnect__(self, attempts: int):
+        """
+        Exponential backoff with full jitter, so that clients that lost the server at the same time do not all
+        come back at the same time
+        :param attempts: failed connection attempts since the last connection
+        """
+        try:
+            async with asyncio.timeout(random.uniform(0, min(RECONNECT_DELAY_MAX,
+                                                             RECONNECT_DELAY * 2 ** min(attempts, 16)))):
+                await self.stopping.wait()
+        except TimeoutError:
+            pass
+
+    async def close(self):
+        """
+        Stops reconnecting and ends the session for good once what is queued has been sent, or after
+        SHUTDOWN_TIMEOUT. The event iterators end
+        """
+        if self.ack_timer is not None:
+            self.ack_timer.cancel()
+        self.__send_acks__()
+        self.running = False
+        self.stopping.set()
+        writer = self.writer
+        if writer is not None:
+            # the server ends the session at once instead of keeping it for resuming
+            self.__enqueue__({'bye': True})
+            try:
+                async with asyncio.timeout(SHUTDOWN_TIMEOUT):
+                    await asyncio.shield(self.write_task)
+            except (Exception, ):
+                pass
+            writer.close()
+        if self.run_task is not None and self.run_task is not asyncio.current_task():
+            await self.run_task
+
+    def send(self, data: dict) -> int:
+        """
+        Queues data for the server and returns at once, it is sent while connected. Data queued while disconnected
+        is sent after reconnecting
+        :param data: json data to send
+        :return: msg_id of the data, one is assigned if it has none
+        """
+        data = dict(data)
+        if data.get('msg_id') is None:
+            data['msg_id'] = next(self.msg_ids)
+        self.__enqueue__(data)
+        return data['msg_id']
+
+    def send_name(self, name: str):
+        self.__enqueue__({'name': name})
+
+    def __enqueue__(self, data: dict):
+        self.outbound.append(data)
+        self.outbound_ready.set()
+
+    def mark_read(self, sender: int):
+        """
+        Tells the sender that every message received from it so far has been read
+        """
+        msg_id = self.received_msg_ids.get(sender)
+        if msg_id is None or msg_id <= self.read_msg_ids.get(sender, 0):
+            return
+        self.read_msg_ids[sender] = msg_id
+        self.__queue_ack__(sender, 'read', msg_id)
+
+    def __accept_message__(self, data: dict) -> bool:
+        """
+        Acknowledges a direct message. The last RECENT_MSG_IDS msg_ids of every sender are remembered, one of them
+        is a message the sender resent after a reconnect. A message that arrives after a later one is still taken
+        :return: False if the message was received before
+        """
+        sender, msg_id = data.get('from'), data.get('msg_id')
+        if 'room' in data or not isinstance(msg_id, int) or isinstance(msg_id, bool):
+            return True
+        # a dict keeps the order in which the msg_ids arrived, the oldest one is dropped first
+        recent = self.recent_msg_ids.setdefault(sender, {})
+        if msg_id in recent:
+            return False
+        recent[msg_id] = True
+        if len(recent) > RECENT_MSG_IDS:
+            del recent[next(iter(recent))]
+        self.received_msg_ids[sender] = max(self.received_msg_ids.get(sender, msg_id), msg_id)
+        self.__queue_ack__(sender, 'delivered', self.received_msg_ids[sender])
+        return True
+
+    def __queue_ack__(self, sender: int, kind: str, msg_id: int):
+        """
+        Acks are cumulative, so only the highest msg_id per sender and kind is kept until ACK_DELAY has passed and
+        all of them are sent in one frame
+        """
+        ack = self.pending_acks.setdefault(sender, {})
+        ack[kind] = max(ack.get(kind, msg_id), msg_id)
+        if self.ack_timer is None:
+            self.ack_timer = asyncio.get_running_loop().call_later(ACK_DELAY, self.__send_acks__)
+
+    def __send_acks__(self):
+        self.ack_timer = None
+        if len(self.pending_acks) == 0:
+            return
+        self.__enqueue__({'ack': [dict(ack, **{'from': sender}) for sender, ack in self.pending_acks.items()]})
+        self.pending_acks = {}
+
+    def handle_data(self, data: dict):
+        """
+        Handles one json object received from the server once the session has started
+        """
+        if 'ping' in data:
+            self.__enqueue__({'pong': data['ping']})
+        elif 'pong' in data:
+            pass
+        elif isinstance(data.get('resume'), str):
+            # the server renews the token of a long session before it expires
+            self.resume_token = data['resume']
+        elif isinstance(data.get('clients'), list):
+            self.__replace_roster__(data['clients'])
+        elif isinstance(data.get('roster'), dict):
+            self.__handle_roster__(data['roster'])
+        elif 'info' in data and data.get('id') is not None:
+            if self.__apply_client_update__(data):
+                self.__emit__('presence', {'updates': [data]})
+        elif 'info' in data and data.get('msg_id') is not None:
+            self.__emit__('delivery', {'msg_id': data['msg_id'], 'state': 'failed'})
+        elif isinstance(data.get('acks'), list):
+            for ack in data['acks']:
+                self.__emit__('receipt', ack)
+        elif 'text' in data:
+            if self.__accept_message__(data):
+                self.__emit__('message', data)
+        else:
+            self.__emit__('data', data)
+
+    def __replace_roster__(self, clients: list):
+        self.clients = {client['id']: client['name'] for client in clients}
+        self.__emit__('roster', {'clients': clients})
+
+    def __apply_client_update__(self, update: dict) -> bool:
+        """
+        :return: False if the update is already part of the roster we have
+        """
+        version = update.get('version')
+        if version is not None and self.roster_version is not None:
+            if version <= self.roster_version:
+                return False
+            self.roster_version = version
+
+        if update.get('info') == 'delete':
+            self.clients.pop(update.get('id'), None)
+        else:
+            self.clients[update.get('id')] = update.get('name')
+        return True
+
+    def __handle_roster__(self, roster: dict):
+        """
+        Applies versioned roster sync: either changes, since the version we sent in hello or merged by the server
+        for presence, or a snapshot that arrives in pages
+        """
+        changes = roster.get('changes')
+        if changes is not None:
+            if self.roster_version is not None and roster.get('epoch') == self.roster_epoch and \
+                    isinstance(roster.get('version'), int) and roster['version'] <= self.roster_version:
+                # a presence batch the roster we got on connecting already contains
+                return
+            for change in changes:
+                self.__apply_client_update__(change)
+            self.__emit__('presence', {'updates': changes})
+        else:
+            if roster.get('page', 0) == 0:
+                self.roster_pages = []
+            self.roster_pages += roster.get('snapshot', [])
+            if roster.get('page', 0) + 1 < roster.get('pages', 1):
+                return
+            self.__replace_roster__(self.roster_pages)
+            self.roster_pages = None
+        self.roster_epoch = roster.get('epoch')
+        self.roster_version = roster.get('version')
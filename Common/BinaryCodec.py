@@ -0,0 +1,408 @@
+"""
+Compact binary encoding of json data, a MessagePack-like layout tuned for the chat protocol.
+
+Every value starts with a tag byte:
+    0x00 - 0x7f  non negative int equal to the tag
+    0x80 None, 0x81 False, 0x82 True
+    0x83 uint32, 0x84 uint64, 0x85 uint128 (client ids), 0x86 int64, 0x87 big int (1 byte length + signed bytes)
+    0x88 float64
+    0x89 str with 1 byte length, 0x8a str with 4 bytes length
+    0x8b list with 4 bytes count, 0x8c dict with 4 bytes count
+    0xa0 - 0xbf  one of KNOWN_STRINGS, so protocol keys and common values take a single byte
+    0xc0 - 0xdf  str of up to 31 bytes
+    0xe0 - 0xef  list of up to 15 items
+    0xf0 - 0xff  dict of up to 15 items, keys and values follow alternately
+All integers are little endian. KNOWN_STRINGS must never change, peers decode with their own copy of it
+
+The frames that make up most of the traffic skip the tagged layout, walking it value by value costs more in python
+than json does in C. Their first byte is one of these tags followed by a fixed struct layout (ids are two uint64,
+low half first):
+    0x90 message {'from', 'text', 'msg_id'}: from, msg_id, the text up to the end
+    0x91 message {'from', 'text', 'msg_id', 'offset'}: from, msg_id, offset, the text up to the end
+    0x92 update {'id', 'name', 'info'}: id, info code, the name up to the end
+    0x93 roster changes {'roster': {'epoch', 'version', 'changes'}}: epoch, version, count, entries
+    0x94 roster snapshot {'roster': {'epoch', 'version', 'snapshot', 'page', 'pages'}}: epoch, version, page, pages,
+         count, entries
+    0x95 {'clients': [{'id', 'name'}, ...]}: count, entries
+    0x96 {'ack': [{'from', 'delivered', 'read'}, ...]}, 0x97 {'acks': [{'by', 'delivered', 'read'}, ...]}: count, then
+         per ack the id, a byte with 1 if delivered and 2 if read is present, delivered and read as uint64
+Entries are stored column by column: all ids, one code byte per entry (info code, 0x80 if the name is None), then the
+names joined by NUL up to the end. Info codes index INFOS. Frames that don't fit a layout exactly take the tagged one
+"""
+import struct
+
+KNOWN_STRINGS = [
+    'id', 'name', 'info', 'from', 'text', 'msg_id', 'recipients', 'clients',
+    'add', 'update', 'delete', 'Could not send message', 'hello', 'codecs', 'codec'
+]
+KNOWN_STRING_TAGS = {value: 0xa0 + index for index, value in enumerate(KNOWN_STRINGS)}
+
+UINT32 = struct.Struct('<BI')
+UINT64 = struct.Struct('<BQ')
+INT64 = struct.Struct('<Bq')
+FLOAT64 = struct.Struct('<Bd')
+UINT32_VALUE = struct.Struct('<I')
+UINT64_VALUE = struct.Struct('<Q')
+INT64_VALUE = struct.Struct('<q')
+FLOAT64_VALUE = struct.Struct('<d')
+
+INFOS = ['add', 'update', 'delete']
+INFO_CODES = {value: code for code, value in enumerate(INFOS)}
+NO_NAME = 0x80
+UINT128_LIMIT = 1 << 128
+UINT64_LIMIT = 1 << 64
+UINT64_MASK = UINT64_LIMIT - 1
+MESSAGE = struct.Struct('<BQQQ')
+MESSAGE_WITH_OFFSET = struct.Struct('<BQQQQ')
+UPDATE = struct.Struct('<BQQB')
+ROSTER_CHANGES = struct.Struct('<BQQI')
+ROSTER_SNAPSHOT = struct.Struct('<BQQIII')
+ACK = struct.Struct('<QQBQQ')
+
+
+def encode(data) -> bytes:
+    """
+    :param data: json data (dict, list, str, int, float, bool or None)
+    :return: the encoded bytes
+    """
+    if type(data) is dict:
+        encoded = __encode_frame__(data)
+        if encoded is not None:
+            return encoded
+    out = bytearray()
+    __encode_value__(out, data)
+    return bytes(out)
+
+
+def decode(buffer):
+    """
+    :param buffer: bytes-like object holding exactly one encoded value
+    :return: the decoded json data
+    """
+    tag = buffer[0]
+    if 0x90 <= tag < 0x90 + len(FRAME_DECODERS):
+        return FRAME_DECODERS[tag - 0x90](buffer)
+    value, offset = __decode_value__(buffer, 0)
+    if offset != len(buffer):
+        raise ValueError('trailing bytes after binary value')
+    return value
+
+
+def __encode_value__(out: bytearray, value):
+    if isinstance(value, str):
+        tag = KNOWN_STRING_TAGS.get(value)
+        if tag is not None:
+            out.append(tag)
+            return
+        data = value.encode('utf-8', errors='ignore')
+        if len(data) < 32:
+            out.append(0xc0 | len(data))
+        elif len(data) < 256:
+            out += bytes((0x89, len(data)))
+        else:
+            out += UINT32.pack(0x8a, len(data))
+        out += data
+    elif isinstance(value, bool):
+        out.append(0x82 if value else 0x81)
+    elif isinstance(value, int):
+        if 0 <= value < 0x80:
+            out.append(value)
+        elif 0 <= value < 1 << 32:
+            out += UINT32.pack(0x83, value)
+        elif 0 <= value < 1 << 64:
+            out += UINT64.pack(0x84, value)
+        elif 0 <= value < 1 << 128:
+            out.append(0x85)
+            out += value.to_bytes(16, byteorder='little', signed=False)
+        elif -(1 << 63) <= value < 0:
+            out += INT64.pack(0x86, value)
+        else:
+            length = (value.bit_length() + 8) // 8
+            out += bytes((0x87, length))
+            out += value.to_bytes(length, byteorder='little', signed=True)
+    elif value is None:
+        out.append(0x80)
+    elif isinstance(value, dict):
+        if len(value) < 16:
+            out.append(0xf0 | len(value))
+        else:
+            out += UINT32.pack(0x8c, len(value))
+        for key, item in value.items():
+            tag = KNOWN_STRING_TAGS.get(key)
+            if tag is not None:
+                out.append(tag)
+            else:
+                __encode_value__(out, str(key))
+            __encode_value__(out, item)
+    elif isinstance(value, (list, tuple)):
+        if len(value) < 16:
+            out.append(0xe0 | len(value))
+        else:
+            out += UINT32.pack(0x8b, len(value))
+        for item in value:
+            __encode_value__(out, item)
+    elif isinstance(value, float):
+        out += FLOAT64.pack(0x88, value)
+    else:
+        raise TypeError(f'cannot encode {type(value).__name__}')
+
+
+def __decode_value__(buffer, offset: int):
+    tag = buffer[offset]
+    offset += 1
+    if tag < 0x80:
+        return tag, offset
+    if tag >= 0xf0:
+        return __decode_dict__(buffer, offset, tag & 0x0f)
+    if tag >= 0xe0:
+        return __decode_list__(buffer, offset, tag & 0x0f)
+    if tag >= 0xc0:
+        end = offset + (tag & 0x1f)
+        return str(buffer[offset:end], encoding='utf-8'), end
+    if tag >= 0xa0:
+        return KNOWN_STRINGS[tag - 0xa0], offset
+    if tag == 0x80:
+        return None, offset
+    if tag == 0x81:
+        return False, offset
+    if tag == 0x82:
+        return True, offset
+    if tag == 0x83:
+        return UINT32_VALUE.unpack_from(buffer, offset)[0], offset + 4
+    if tag == 0x84:
+        return UINT64_VALUE.unpack_from(buffer, offset)[0], offset + 8
+    if tag == 0x85:
+        return int.from_bytes(buffer[offset:offset + 16], byteorder='little', signed=False), offset + 16
+    if tag == 0x86:
+        return INT64_VALUE.unpack_from(buffer, offset)[0], offset + 8
+    if tag == 0x87:
+        end = offset + 1 + buffer[offset]
+        return int.from_bytes(buffer[offset + 1:end], byteorder='little', signed=True), end
+    if tag == 0x88:
+        return FLOAT64_VALUE.unpack_from(buffer, offset)[0], offset + 8
+    if tag == 0x89:
+        end = offset + 1 + buffer[offset]
+        return str(buffer[offset + 1:end], encoding='utf-8'), end
+    if tag == 0x8a:
+        end = offset + 4 + UINT32_VALUE.unpack_from(buffer, offset)[0]
+        return str(buffer[offset + 4:end], encoding='utf-8'), end
+    if tag == 0x8b:
+        return __decode_list__(buffer, offset + 4, UINT32_VALUE.unpack_from(buffer, offset)[0])
+    if tag == 0x8c:
+        return __decode_dict__(buffer, offset + 4, UINT32_VALUE.unpack_from(buffer, offset)[0])
+    raise ValueError(f'unknown binary tag {tag:#x}')
+
+
+def __decode_list__(buffer, offset: int, count: int):
+    result = []
+    for _ in range(count):
+        item, offset = __decode_value__(buffer, offset)
+        result.append(item)
+    return result, offset
+
+
+def __decode_dict__(buffer, offset: int, count: int):
+    result = {}
+    for _ in range(count):
+        tag = buffer[offset]
+        if 0xa0 <= tag < 0xc0:
+            key, offset = KNOWN_STRINGS[tag - 0xa0], offset + 1
+        else:
+            key, offset = __decode_value__(buffer, offset)
+        result[key], offset = __decode_value__(buffer, offset)
+    return result, offset
+
+
+def __is_uint__(value, limit: int) -> bool:
+    return type(value) is int and 0 <= value < limit
+
+
+def __info_code__(info) -> int | None:
+    return INFO_CODES.get(info) if type(info) is str else None
+
+
+def __encode_frame__(data: dict) -> bytes | None:
+    """
+    :return: data in its fixed layout, None if it has none
+    """
+    if len(data) == 1:
+        if 'roster' in data:
+            return __encode_roster__(data['roster'])
+        if 'clients' in data:
+            entries = __encode_entries__(data['clients'], False)
+            return None if entries is None else UINT32.pack(0x95, entries[0]) + entries[1]
+        if 'ack' in data:
+            return __encode_acks__(0x96, 'from', data['ack'])
+        if 'acks' in data:
+            return __encode_acks__(0x97, 'by', data['acks'])
+        return None
+    if 'text' in data:
+        return __encode_message__(data)
+    if 'info' in data and len(data) == 3:
+        return __encode_update__(data)
+    return None
+
+
+def __encode_message__(data: dict) -> bytes | None:
+    sender, text, msg_id = data.get('from'), data.get('text'), data.get('msg_id')
+    if type(text) is not str or not __is_uint__(sender, UINT128_LIMIT) or not __is_uint__(msg_id, UINT64_LIMIT):
+        return None
+    if len(data) == 3:
+        header = MESSAGE.pack(0x90, sender & UINT64_MASK, sender >> 64, msg_id)
+    elif len(data) == 4 and __is_uint__(data.get('offset'), UINT64_LIMIT):
+        header = MESSAGE_WITH_OFFSET.pack(0x91, sender & UINT64_MASK, sender >> 64, msg_id, data['offset'])
+    else:
+        return None
+    return header + text.encode('utf-8', errors='ignore')
+
+
+def __encode_update__(data: dict) -> bytes | None:
+    client_id, name, code = data.get('id'), data.get('name'), __info_code__(data.get('info'))
+    if code is None or not __is_uint__(client_id, UINT128_LIMIT):
+        return None
+    if name is None and 'name' in data:
+        code, name = code | NO_NAME, ''
+    elif type(name) is not str:
+        return None
+    return UPDATE.pack(0x92, client_id & UINT64_MASK, client_id >> 64, code) + name.encode('utf-8', errors='ignore')
+
+
+def __encode_roster__(roster) -> bytes | None:
+    if type(roster) is not dict:
+        return None
+    epoch, version = roster.get('epoch'), roster.get('version')
+    if not __is_uint__(epoch, UINT64_LIMIT) or not __is_uint__(version, UINT64_LIMIT):
+        return None
+    if len(roster) == 3 and 'changes' in roster:
+        entries = __encode_entries__(roster['changes'], True)
+        return None if entries is None else ROSTER_CHANGES.pack(0x93, epoch, version, entries[0]) + entries[1]
+    page, pages = roster.get('page'), roster.get('pages')
+    if len(roster) == 5 and 'snapshot' in roster and __is_uint__(page, 1 << 32) and __is_uint__(pages, 1 << 32):
+        entries = __encode_entries__(roster['snapshot'], False)
+        if entries is not None:
+            return ROSTER_SNAPSHOT.pack(0x94, epoch, version, page, pages, entries[0]) + entries[1]
+    return None
+
+
+def __encode_entries__(entries, with_info: bool) -> tuple | None:
+    """
+    :param entries: list of {'id', 'name'} or {'id', 'name', 'info'}
+    :return: (count, encoded entries), None if an entry doesn't fit the layout
+    """
+    if type(entries) is not list:
+        return None
+    size = 3 if with_info else 2
+    ids, codes, names = [], bytearray(), []
+    for entry in entries:
+        if type(entry) is not dict or len(entry) != size:
+            return None
+        client_id, name = entry.get('id'), entry.get('name')
+        code = __info_code__(entry.get('info')) if with_info else 0
+        if code is None or type(client_id) is not int or not 0 <= client_id < UINT128_LIMIT:
+            return None
+        if type(name) is str:
+            if '\0' in name:
+                return None
+        elif name is None and 'name' in entry:
+            code, name = code | NO_NAME, ''
+        else:
+            return None
+        ids += (client_id & UINT64_MASK, client_id >> 64)
+        codes.append(code)
+        names.append(name)
+    return len(codes), struct.pack(f'<{len(ids)}Q', *ids) + codes + '\0'.join(names).encode('utf-8', errors='ignore')
+
+
+def __encode_acks__(tag: int, key: str, acks) -> bytes | None:
+    if type(acks) is not list:
+        return None
+    out = bytearray(UINT32.pack(tag, len(acks)))
+    for ack in acks:
+        if type(ack) is not dict or not __is_uint__(ack.get(key), UINT128_LIMIT):
+            return None
+        client_id, delivered, read = ack[key], ack.get('delivered', 0), ack.get('read', 0)
+        flags = ('delivered' in ack) | ('read' in ack) << 1
+        if len(ack) != 1 + flags.bit_count() or not __is_uint__(delivered, UINT64_LIMIT) or \
+                not __is_uint__(read, UINT64_LIMIT):
+            return None
+        out += ACK.pack(client_id & UINT64_MASK, client_id >> 64, flags, delivered, read)
+    return bytes(out)
+
+
+def __decode_message__(buffer) -> dict:
+    _, low, high, msg_id = MESSAGE.unpack_from(buffer)
+    return {'from': low | high << 64, 'text': str(buffer[MESSAGE.size:], encoding='utf-8'), 'msg_id': msg_id}
+
+
+def __decode_message_with_offset__(buffer) -> dict:
+    _, low, high, msg_id, offset = MESSAGE_WITH_OFFSET.unpack_from(buffer)
+    return {'from': low | high << 64, 'text': str(buffer[MESSAGE_WITH_OFFSET.size:], encoding='utf-8'),
+            'msg_id': msg_id, 'offset': offset}
+
+
+def __decode_update__(buffer) -> dict:
+    _, low, high, code = UPDATE.unpack_from(buffer)
+    name = str(buffer[UPDATE.size:], encoding='utf-8')
+    return {'id': low | high << 64, 'name': None if code & NO_NAME else name, 'info': INFOS[code & ~NO_NAME]}
+
+
+def __decode_roster_changes__(buffer) -> dict:
+    _, epoch, version, count = ROSTER_CHANGES.unpack_from(buffer)
+    changes = __decode_entries__(buffer, ROSTER_CHANGES.size, count, True)
+    return {'roster': {'epoch': epoch, 'version': version, 'changes': changes}}
+
+
+def __decode_roster_snapshot__(buffer) -> dict:
+    _, epoch, version, page, pages, count = ROSTER_SNAPSHOT.unpack_from(buffer)
+    snapshot = __decode_entries__(buffer, ROSTER_SNAPSHOT.size, count, False)
+    return {'roster': {'epoch': epoch, 'version': version, 'snapshot': snapshot, 'page': page, 'pages': pages}}
+
+
+def __decode_clients__(buffer) -> dict:
+    return {'clients': __decode_entries__(buffer, 5, UINT32_VALUE.unpack_from(buffer, 1)[0], False)}
+
+
+def __decode_entries__(buffer, offset: int, count: int, with_info: bool) -> list:
+    names_offset = offset + 17 * count
+    if names_offset > len(buffer):
+        raise ValueError('truncated binary entries')
+    ids = struct.unpack_from(f'<{2 * count}Q', buffer, offset)
+    codes = bytes(buffer[names_offset - count:names_offset])
+    names = str(buffer[names_offset:], encoding='utf-8')
+    names = names.split('\0') if count > 0 or len(names) > 0 else []
+    if len(names) != count:
+        raise ValueError('binary entry names do not match their count')
+    client_ids = [low | high << 64 for low, high in zip(ids[0::2], ids[1::2])]
+    if with_info:
+        return [{'id': client_id, 'name': None if code & NO_NAME else name, 'info': INFOS[code & ~NO_NAME]}
+                for client_id, code, name in zip(client_ids, codes, names)]
+    return [{'id': client_id, 'name': None if code & NO_NAME else name}
+            for client_id, code, name in zip(client_ids, codes, names)]
+
+
+def __decode_ack_list__(buffer, key: str) -> list:
+    if len(buffer) != 5 + UINT32_VALUE.unpack_from(buffer, 1)[0] * ACK.size:
+        raise ValueError('truncated binary acks')
+    acks = []
+    for low, high, flags, delivered, read in ACK.iter_unpack(buffer[5:]):
+        ack = {key: low | high << 64}
+        if flags & 1:
+            ack['delivered'] = delivered
+        if flags & 2:
+            ack['read'] = read
+        acks.append(ack)
+    return acks
+
+
+def __decode_ack__(buffer) -> dict:
+    return {'ack': __decode_ack_list__(buffer, 'from')}
+
+
+def __decode_acks__(buffer) -> dict:
+    return {'acks': __decode_ack_list__(buffer, 'by')}
+
+
+FRAME_DECODERS = [
+    __decode_message__, __decode_message_with_offset__, __decode_update__, __decode_roster_changes__,
+    __decode_roster_snapshot__, __decode_clients__, __decode_ack__, __decode_acks__
+]
@@ -0,0 +1,73 @@
+"""
+Per-frame deflate compression with preset dictionaries.
+
+A compressed body is one byte with the id of the dictionary followed by a raw deflate stream, so the receiver knows
+how to inflate it from the body alone. Peers announce the dictionaries they have by name in their hello and only
+a negotiated one is ever used for sending
+"""
+import zlib
+
+COMPRESSION_LEVEL = 6
+COMPRESSION_THRESHOLD = 512
+
+# Substrings of typical chat, presence and roster frames in both codecs. Deflate references the end of
+# the dictionary most cheaply, so the most common content goes last
+DICTIONARY_1 = (
+    b'https://www. http:// .com .org .net the and for you that this with have are not but what'
+    b' was all can just your about when they there will would from like know think here time then'
+    b' now good see get one out yes no ok okay thanks thank you please sorry hello hi hey '
+    b'Could not send message\xab\xa5 \xa0\xa1\xa2update\xa0\xa1\xa2add\xa0\xa1\xa2delete'
+    b'\xa7\xf2\xa0\x85\xa1\xf2\xa0\x85\xa1'
+    b'{"info": "Could not send message", "msg_id": '
+    b'{"id": , "name": null, "info": "add"}{"id": , "name": null, "info": "delete"}'
+    b'{"id": , "name": "", "info": "update"}'
+    b'{"clients": [{"id": , "name": ""}, {"id": , "name": ""}, {"id": , "name": ""}]}'
+    b'{"recipients": [], "text": "", "msg_id": }'
+    b'{"from": , "text": "", "msg_id": }'
+)
+
+DICTIONARIES = {
+    'zlib': (0, b''),
+    'zlib-d1': (1, DICTIONARY_1),
+}
+DICTIONARIES_BY_ID = {dictionary_id: dictionary for dictionary_id, dictionary in DICTIONARIES.values()}
+# compression methods this side understands, most preferred first
+COMPRESSIONS = ['zlib-d1', 'zlib']
+
+
+def compress(data: bytes, compression: str, level: int = COMPRESSION_LEVEL) -> bytes:
+    """
+    :param data: body to compress
+    :param compression: name of a negotiated entry of DICTIONARIES
+    :param level: zlib compression level
+    :return: compressed body, dictionary id included
+    """
+    dictionary_id, dictionary = DICTIONARIES[compression]
+    compressor = zlib.compressobj(level, zlib.DEFLATED, -zlib.MAX_WBITS, zdict=dictionary) if dictionary else \
+        zlib.compressobj(level, zlib.DEFLATED, -zlib.MAX_WBITS)
+    return bytes((dictionary_id,)) + compressor.compress(data) + compressor.flush()
+
+
+def decompress(body, max_size: int) -> bytes:
+    """
+    :param body: bytes-like object holding a compressed body
+    :param max_size: max accepted size of the inflated data
+    :return: the inflated data
+    """
+    dictionary = DICTIONARIES_BY_ID[body[0]]
+    decompressor = zlib.decompressobj(-zlib.MAX_WBITS, zdict=dictionary) if dictionary else \
+        zlib.decompressobj(-zlib.MAX_WBITS)
+    data = decompressor.decompress(body[1:], max_size)
+    if decompressor.unconsumed_tail or not decompressor.eof:
+        raise ValueError('compressed body is truncated or inflates beyond max size')
+    return data
+
+
+def negotiate(offered) -> str | None:
+    """
+    :param offered: compression names announced by the peer
+    :return: the first of them this side supports, None if none
+    """
+    if not isinstance(offered, list):
+        return None
+    return next((compression for compression in offered if compression in DICTIONARIES), None)
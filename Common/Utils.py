@@ -1,57 +1,215 @@
 import json
 import socket
+import time
 
+import BinaryCodec
+import Compression
 
-def receive_n_bytes(s: socket.socket, n: int) -> bytes:
-    """
-    Receives exactly n bytes from socket
-    :param s: the socket
-    :param n: number of bytes
-    :return: bytes received. If zero bytes are returned then connection should be closed
-    """
-    result = b''
-    remaining = n
-    try:
-        while remaining > 0:
-            data = s.recv(remaining)
-            if data is None or len(data) == 0:
-                return b''
-            remaining -= len(data)
-            result += data
-    except (Exception,):
-        return b''
-    return result
+RECEIVE_BUFFER_SIZE = 64 * 1024
+
+JSON_CODEC = 'json'
+BINARY_CODEC = 'binary'
+# codecs this side understands, most preferred first
+CODECS = [BINARY_CODEC, JSON_CODEC]
+
+# the 4 bytes header holds the length in its lower 3 bytes and flags in the upper byte.
+# Flags are only set once the peer has negotiated them, legacy peers only ever see 0 flags
+LENGTH_MASK = 0x00ffffff
+FLAG_BINARY = 0x01
+FLAG_COMPRESSED = 0x02
 
 
 def bytes_to_uint32(data: bytes) -> int:
     return int.from_bytes(data, byteorder='little', signed=False)
 
 
-def send_json_data(s: socket.socket, data: dict) -> bool:
-    if s is None or data is None:
+def send_frames(s: socket.socket, frames: list) -> bool:
+    """
+    Writes already framed data with a single buffer, partial writes are continued until everything is sent
+    :param s: the socket
+    :param frames: list of frames (bytes)
+    :return: True on success
+    """
+    if s is None:
         return False
-
-    data_bytes = bytes(json.dumps(data), encoding='utf-8', errors='ignore')
-    length = len(data_bytes)
-    length_bytes = length.to_bytes(4, byteorder='little', signed=False)
     try:
-        if s.send(length_bytes) != 4:
-            return False
-        if s.send(data_bytes) != length:
-            return False
+        s.sendall(frames[0] if len(frames) == 1 else b''.join(frames))
     except (Exception, ):
         return False
     return True
 
 
-def receive_json_data(s: socket.socket, max_size: int):
-    if s is None:
-        return None
-    data_length = bytes_to_uint32(receive_n_bytes(s, 4))
-    if data_length == 0 or data_length > max_size:
-        return None
-    raw_data = receive_n_bytes(s, data_length)
-    if len(raw_data) == 0:
-        return None
-
-    return json.loads(raw_data)
+def send_json_data(s: socket.socket, data: dict, codec: str = JSON_CODEC, compression: str = None) -> bool:
+    if s is None or data is None:
+        return False
+    return send_frames(s, [encode_frame(data, codec, compression)])
+
+
+def encode_frame(data: dict, codec: str = JSON_CODEC, compression: str = None,
+                 compression_threshold: int = Compression.COMPRESSION_THRESHOLD) -> bytes:
+    """
+    Encodes json data the way it travels on the wire: 4 bytes header (length and flags) followed by the body
+    :param data: json data
+    :param codec: JSON_CODEC or BINARY_CODEC, BINARY_CODEC only if the peer has negotiated it
+    :param compression: compression negotiated with the peer or None
+    :param compression_threshold: bodies smaller than this are never compressed
+    :return: the framed bytes
+    """
+    if codec == BINARY_CODEC:
+        data_bytes = BinaryCodec.encode(data)
+        flags = FLAG_BINARY
+    else:
+        data_bytes = bytes(json.dumps(data), encoding='utf-8', errors='ignore')
+        flags = 0
+    if compression is not None and len(data_bytes) >= compression_threshold:
+        compressed = Compression.compress(data_bytes, compression)
+        if len(compressed) < len(data_bytes):
+            data_bytes = compressed
+            flags |= FLAG_COMPRESSED
+    return (len(data_bytes) | flags << 24).to_bytes(4, byteorder='little', signed=False) + data_bytes
+
+
+def decode_body(flags: int, body, max_size: int):
+    """
+    :param flags: flags from the frame header
+    :param body: bytes-like object holding the frame body
+    :param max_size: max accepted size of an inflated body
+    :return: the decoded json data
+    """
+    if flags & FLAG_COMPRESSED:
+        body = Compression.decompress(body, max_size)
+        flags &= ~FLAG_COMPRESSED
+    if flags == FLAG_BINARY:
+        return BinaryCodec.decode(body)
+    if flags == 0:
+        return json.loads(str(body, encoding='utf-8'))
+    raise ValueError(f'unsupported frame flags {flags:#x}')
+
+
+class Frame:
+    """
+    Json data that is framed at most once per codec and compression no matter how many recipients it has.
+    The same Frame object is handed to every recipient's send path
+    """
+    data: dict = None
+    encoded: dict = None
+
+    def __init__(self, data: dict):
+        self.data = data
+        self.encoded = {}
+
+    def get_bytes(self, codec: str = JSON_CODEC, compression: str = None,
+                  compression_threshold: int = Compression.COMPRESSION_THRESHOLD) -> bytes:
+        encoded = self.encoded.get((codec, compression))
+        if encoded is None:
+            encoded = self.encoded[(codec, compression)] = \
+                encode_frame(self.data, codec, compression, compression_threshold)
+        return encoded
+
+
+class FrameReader:
+    """
+    Buffered reader of length prefixed frames, bodies are decoded according to the flags in their header.
+
+    Data is read in large chunks straight into a reusable bytearray and every complete frame found in it is decoded
+    from a memoryview, without copying the frame out of the buffer first. Once the length of a frame is known the
+    buffer is grown to hold it whole, so big frames cause at most one reallocation.
+    The sizes of the frames of the last read and the time spent decoding them are kept for metrics
+    """
+    buffer: bytearray = None
+    start: int = None
+    end: int = None
+    max_size: int = None
+    buffer_size: int = None
+    frame_sizes: list = None
+    decode_time: float = None
+
+    def __init__(self, max_size: int, buffer_size: int = RECEIVE_BUFFER_SIZE):
+        """
+        :param max_size: max accepted size of json data
+        :param buffer_size: size of the buffer when no big frame is pending
+        """
+        self.max_size = max_size
+        self.buffer_size = buffer_size
+        self.buffer = bytearray(buffer_size)
+        self.start = 0
+        self.end = 0
+        self.frame_sizes = []
+        self.decode_time = 0.0
+
+    def receive(self, s: socket.socket) -> list | None:
+        """
+        Reads once from the socket and decodes all complete frames
+        :param s: the socket
+        :return: list of json data, possibly empty. None if connection should be closed
+        """
+        if s is None:
+            return None
+        self.__make_room__(1)
+        try:
+            with memoryview(self.buffer) as view, view[self.end:] as free:
+                received = s.recv_into(free)
+        except (Exception,):
+            return None
+        if received == 0:
+            return None
+        self.end += received
+        return self.decode_frames()
+
+    def feed(self, data: bytes) -> list | None:
+        """
+        Same as receive but for data that has already been read, e.g. by an asyncio stream
+        :param data: received bytes
+        :return: list of json data, possibly empty. None if connection should be closed
+        """
+        self.__make_room__(len(data))
+        self.buffer[self.end:self.end + len(data)] = data
+        self.end += len(data)
+        return self.decode_frames()
+
+    def decode_frames(self) -> list | None:
+        messages = []
+        self.frame_sizes = []
+        start = time.perf_counter()
+        try:
+            with memoryview(self.buffer) as view:
+                while self.end - self.start >= 4:
+                    header = bytes_to_uint32(view[self.start:self.start + 4])
+                    data_length = header & LENGTH_MASK
+                    if data_length == 0 or data_length > self.max_size:
+                        return None
+                    if self.end - self.start - 4 < data_length:
+                        break
+                    with view[self.start + 4:self.start + 4 + data_length] as body:
+                        messages.append(decode_body(header >> 24, body, self.max_size))
+                    self.frame_sizes.append(4 + data_length)
+                    self.start += 4 + data_length
+        except (Exception,):
+            return None
+        self.decode_time = time.perf_counter() - start
+        if self.start == self.end:
+            self.start, self.end = 0, 0
+            if len(self.buffer) > self.buffer_size:
+                self.buffer = bytearray(self.buffer_size)
+        return messages
+
+    def __make_room__(self, needed: int):
+        """
+        Makes sure there are at least needed free bytes after the buffered data and that the pending frame fits
+        in the buffer as a whole. Pending data is moved to the front once half of the buffer has been consumed
+        """
+        pending = self.end - self.start
+        required = pending + needed
+        if pending >= 4:
+            header = bytes_to_uint32(self.buffer[self.start:self.start + 4])
+            frame_length = 4 + min(header & LENGTH_MASK, self.max_size)
+            required = max(required, frame_length)
+        if required > len(self.buffer):
+            buffer = bytearray(max(required, self.buffer_size))
+            buffer[:pending] = self.buffer[self.start:self.end]
+            self.buffer = buffer
+        elif len(self.buffer) - self.start < required or self.start >= len(self.buffer) // 2:
+            self.buffer[:pending] = self.buffer[self.start:self.end]
+        else:
+            return
+        self.start, self.end = 0, pending